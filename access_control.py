@@ -1,26 +1,126 @@
+import heapq
+import secrets
+import threading
 import time
 import logging
+from collections import defaultdict
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class KeyRegistry:
+    """
+    Temporary keys indexed by key, by device and by expiration time.
+
+    Expirations live in a min-heap, so removing every expired key pops only
+    those keys: each key is pushed and popped once, O(log n) amortized. Sweeps
+    run on every issue and, optionally, from a background thread, so keys that
+    are never used again do not accumulate.
+    """
+
+    def __init__(self):
+        self._keys = {}  # key -> (device_id, expiration)
+        self._by_device = defaultdict(set)
+        self._expiry = []  # heap of (expiration, key); revoked keys are skipped when popped
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sweeper = None
+
+    def __len__(self):
+        return len(self._keys)
+
+    def issue(self, device_id, duration):
+        now = time.time()
+        with self._lock:
+            self._sweep(now)
+            key = f"temp_{device_id}_{secrets.token_urlsafe(12)}"
+            while key in self._keys:
+                key = f"temp_{device_id}_{secrets.token_urlsafe(12)}"
+            expiration = now + duration
+            self._keys[key] = (device_id, expiration)
+            self._by_device[device_id].add(key)
+            heapq.heappush(self._expiry, (expiration, key))
+        return key
+
+    def validate(self, key):
+        """Return the device a key grants access to, or None if it is unknown or expired."""
+        entry = self._keys.get(key)
+        if entry is None:
+            return None
+        device_id, expiration = entry
+        if time.time() < expiration:
+            return device_id
+        with self._lock:
+            self._remove(key)
+        logger.info(f"Key {key} has expired and been removed")
+        return None
+
+    def revoke(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def keys_for(self, device_id):
+        """Return the unexpired keys issued for a device."""
+        now = time.time()
+        with self._lock:
+            return [key for key in self._by_device.get(device_id, ()) if self._keys[key][1] > now]
+
+    def sweep(self):
+        """Remove every expired key. Returns the number removed."""
+        with self._lock:
+            return self._sweep(time.time())
+
+    def _sweep(self, now):
+        removed = 0
+        while self._expiry and self._expiry[0][0] <= now:
+            expiration, key = heapq.heappop(self._expiry)
+            entry = self._keys.get(key)
+            if entry is not None and entry[1] == expiration:
+                self._remove(key)
+                removed += 1
+        # Revoked keys leave stale heap entries behind; rebuild once they dominate the heap
+        if len(self._expiry) > 2 * len(self._keys) + 64:
+            self._expiry = [(expiration, key) for key, (_, expiration) in self._keys.items()]
+            heapq.heapify(self._expiry)
+        return removed
+
+    def _remove(self, key):
+        entry = self._keys.pop(key, None)
+        if entry is None:
+            return
+        keys = self._by_device.get(entry[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_device[entry[0]]
+
+    def start_sweeper(self, interval=60):
+        """Sweep expired keys every ``interval`` seconds on a daemon thread."""
+        if self._sweeper is not None and self._sweeper.is_alive():
+            return
+        self._stop.clear()
+
+        def run():
+            while not self._stop.wait(interval):
+                removed = self.sweep()
+                if removed:
+                    logger.info(f"Swept {removed} expired keys")
+
+        self._sweeper = threading.Thread(target=run, name="key-sweeper", daemon=True)
+        self._sweeper.start()
+
+    def stop_sweeper(self):
+        self._stop.set()
+
 # This should be replaced with a secure database in a production environment
-temp_keys = {}
+registry = KeyRegistry()
+registry.start_sweeper()
 
 def generate_temp_key(device_id, duration=1800):  # Default duration: 30 minutes
-    key = f"temp_{device_id}_{int(time.time())}"
-    expiration = time.time() + duration
-    temp_keys[key] = {"device_id": device_id, "expiration": expiration}
-    return key
+    return registry.issue(device_id, duration)
 
 def validate_key(key):
-    if key in temp_keys:
-        if time.time() < temp_keys[key]["expiration"]:
-            return temp_keys[key]["device_id"]
-        else:
-            del temp_keys[key]
-            logger.info(f"Key {key} has expired and been removed")
-    return None
+    return registry.validate(key)
 
 def check_access(key, device_id):
     valid_device = validate_key(key)
@@ -32,7 +132,7 @@ def check_access(key, device_id):
 if __name__ == "__main__":
     # Generate a temporary key
     device_id = "microscope1"
-    temp_key = generate_temp_key(device_id)
+    temp_key = generate_temp_key(device_id, duration=2)
     print(f"Generated temporary key: {temp_key}")
 
     # Check access (should be True)
@@ -42,8 +142,13 @@ if __name__ == "__main__":
     print(f"Access granted: {check_access(temp_key, 'microscope2')}")
 
     # Wait for key to expire (for testing purposes)
-    time.sleep(5)
-    temp_keys[temp_key]["expiration"] = time.time() - 1
+    time.sleep(3)
 
     # Check access after expiration (should be False)
-    print(f"Access granted after expiration: {check_access(temp_key, device_id)}")
\ No newline at end of file
+    print(f"Access granted after expiration: {check_access(temp_key, device_id)}")
+
+    # Keys that are never checked again are swept as well
+    for _ in range(1000):
+        generate_temp_key(device_id, duration=0)
+    registry.sweep()
+    print(f"Keys left after sweep: {len(registry)}")
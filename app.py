@@ -1,43 +1,59 @@
+import startup
 import gradio as gr
 import logging
 import asyncio
 import tenacity
-from mqtt_client import MQTTClient
-from key_request import generate_access_key
+startup.checkpoint("import gradio")
+from connections import get_mqtt_client
+from key_request import show as show_key_request
 from device_status import get_device_status, show as show_device_status
 from documentation import show as show_documentation
 import download
+import metrics
 import gui_control
 import livestream
+import scan_viewer
 from access_control import check_access, generate_temp_key
 import os
 from dotenv import load_dotenv
+startup.checkpoint("import tab modules")
 
 load_dotenv()
 
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-# Create MQTT client
-mqtt_client = MQTTClient()
+# DEBUG also logs (truncated) MQTT payloads; only turn it on while diagnosing
+log_level = os.getenv("LOG_LEVEL", "INFO").upper()
 try:
-    mqtt_client.connect()
-except Exception as e:
-    logger.error(f"Connection failed: {e}")
+    logging.getLogger().setLevel(log_level)
+except ValueError:
+    logging.getLogger().setLevel(logging.INFO)
+    logger.warning(f"Unknown LOG_LEVEL {log_level!r}; logging at INFO")
 
 def about():
     return "This is a request site for credentials to use remote access to Openflexure Microscopes in the AC lab. You can either control the microscopes over python or the GUI with the help of a temporary key. You can view the live camera feed on a livestream. One person can use a microscope at once. Currently only Microscope2 is functional, but they will all be functional in the future"
 
-@tenacity.retry(stop=tenacity.stop_after_attempt(3), wait=tenacity.wait_fixed(2))
-def send_command_with_retry(command):
-    mqtt_client.publish("command/topic", command)
+async def send_command_with_retry(command, attempts=3, attempt_timeout=5):
+    # Backoff sleeps are awaited, so retries never block the event loop or other requests
+    async for attempt in tenacity.AsyncRetrying(
+        stop=tenacity.stop_after_attempt(attempts),
+        wait=tenacity.wait_exponential(multiplier=0.5, max=4),
+        retry=tenacity.retry_if_exception_type((ConnectionError, asyncio.TimeoutError)),
+        reraise=True,
+    ):
+        with attempt:
+            return await get_mqtt_client().publish_async("command/topic", command, timeout=attempt_timeout)
 
 async def send_command_with_timeout(command, timeout=10):
     try:
+        # The deadline covers every attempt and backoff; hitting it cancels the retry loop
         return await asyncio.wait_for(send_command_with_retry(command), timeout=timeout)
     except asyncio.TimeoutError:
         logger.error(f"Command timed out after {timeout} seconds")
         return None
+    except ConnectionError as e:
+        logger.error(f"Command failed: {e}")
+        return None
     
 # Use access control in your application logic
 def some_protected_function(key, device_id):
@@ -54,12 +70,7 @@ with gr.Blocks() as demo:
         gr.Markdown(about())
     
     with gr.Tab("Request Key"):
-        gr.Interface(
-            fn=generate_access_key,
-            inputs=gr.Textbox(label="Enter any text"),
-            outputs="text",
-            description="Generate a temporary access key"
-        )
+        show_key_request()
     
     with gr.Tab("Device Status"):
         show_device_status()
@@ -72,6 +83,9 @@ with gr.Blocks() as demo:
     
     with gr.Tab("GUI Control"):
         gui_control.show()
+
+    with gr.Tab("Scan Viewer"):
+        scan_viewer.show()
     
     with gr.Tab("Python Documentation"):
         show_documentation()
@@ -81,5 +95,15 @@ with gr.Blocks() as demo:
         refresh_button = gr.Button("Refresh Status")
         refresh_button.click(get_device_status, inputs=[], outputs=[status_output])
 
+    with gr.Tab("Metrics"):
+        metrics_output = gr.Textbox(label="Prometheus metrics", lines=20)
+        metrics_refresh = gr.Button("Refresh Metrics")
+        metrics_refresh.click(metrics.render, inputs=[], outputs=[metrics_output])
+
+startup.checkpoint("build interface")
+startup.report()
+
 if __name__ == "__main__":
+    # Also expose /metrics for Prometheus when METRICS_PORT is set
+    metrics.serve()
     demo.launch()
@@ -0,0 +1,124 @@
+import asyncio
+import logging
+from typing import Any, Callable, Optional
+
+import metrics
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+QUEUE_DEPTH = metrics.gauge("bridge_queue_depth", "Messages waiting to be handled on the event loop")
+DROPPED = metrics.counter("bridge_dropped_total", "Messages dropped because the bridge was stopped or full")
+
+class AsyncBridge:
+    """
+    Hand items from paho's network thread to an asyncio event loop.
+
+    Items posted from any thread are queued on the owning loop through
+    ``asyncio.run_coroutine_threadsafe`` and handed to ``handler`` one at a time by a
+    single consumer task. The queue is bounded: when it is full, ``post`` blocks
+    the network thread, which stops paho reading from the socket and pushes the
+    backpressure back to the broker instead of growing memory without limit.
+    """
+
+    def __init__(self, handler: Callable[[Any], Any], maxsize: int = 100, put_timeout: float = 30.0):
+        """
+        Initialize the bridge.
+
+        Args:
+            handler (Callable[[Any], Any]): Called on the event loop for every item. May be a coroutine function.
+            maxsize (int, optional): Maximum number of queued items. Defaults to 100.
+            put_timeout (float, optional): Seconds ``post`` waits for queue space before dropping. Defaults to 30.
+        """
+        self.handler = handler
+        self.maxsize = maxsize
+        self.put_timeout = put_timeout
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.queue: Optional[asyncio.Queue] = None
+        self._consumer: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Bind the bridge to the running event loop and start the consumer. Safe to call repeatedly."""
+        if self._consumer is not None and not self._consumer.done():
+            return
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=self.maxsize)
+        self._consumer = self.loop.create_task(self._consume())
+
+    def qsize(self) -> int:
+        return self.queue.qsize() if self.queue is not None else 0
+
+    def post(self, item: Any) -> bool:
+        """
+        Queue an item for the event loop. Thread-safe.
+
+        Returns:
+            bool: False if the item was dropped because the bridge is not running or stayed full.
+        """
+        loop = self.loop
+        if loop is None or not loop.is_running() or self._consumer is None or self._consumer.done():
+            DROPPED.inc()
+            logger.warning("Dropping message received while the bridge is not running")
+            return False
+
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            # Already on the loop thread (e.g. an in-process transport), so blocking is not an option
+            try:
+                self.queue.put_nowait(item)
+                QUEUE_DEPTH.inc()
+                return True
+            except asyncio.QueueFull:
+                DROPPED.inc()
+                logger.warning("Bridge queue full, dropping message")
+                return False
+
+        future = asyncio.run_coroutine_threadsafe(self._put(item), loop)
+        try:
+            future.result(timeout=self.put_timeout)
+            return True
+        except Exception as e:
+            future.cancel()
+            DROPPED.inc()
+            logger.warning(f"Bridge queue stayed full for {self.put_timeout}s, dropping message: {e!r}")
+            return False
+
+    async def _put(self, item: Any):
+        await self.queue.put(item)
+        QUEUE_DEPTH.inc()
+
+    async def _consume(self):
+        while True:
+            item = await self.queue.get()
+            QUEUE_DEPTH.dec()
+            try:
+                result = self.handler(item)
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as e:
+                logger.error(f"Error handling bridged message: {e}")
+
+    def close(self):
+        """Stop the consumer task. Queued items are discarded."""
+        if self._consumer is not None:
+            if self.loop is not None and not self.loop.is_closed():
+                self.loop.call_soon_threadsafe(self._discard, self._consumer, self.queue)
+            else:
+                self._discard(self._consumer, self.queue)
+            self._consumer = None
+
+    @staticmethod
+    def _discard(consumer: asyncio.Task, queue: asyncio.Queue):
+        # Runs on the loop thread, as asyncio queues are not thread-safe
+        consumer.cancel()
+        discarded = 0
+        while not queue.empty():
+            queue.get_nowait()
+            discarded += 1
+        if discarded:
+            QUEUE_DEPTH.dec(discarded)
+            DROPPED.inc(discarded)
+            logger.warning(f"Discarded {discarded} queued messages on close")
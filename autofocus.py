@@ -0,0 +1,222 @@
+import asyncio
+import logging
+import math
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import metrics
+from image_transport import BytesLike, open_image
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SCORE_SECONDS = metrics.histogram(
+    "autofocus_score_seconds", "Time to score the sharpness of one frame", ["metric"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25),
+)
+
+GOLDEN = (math.sqrt(5) - 1) / 2
+
+def laplacian_variance(gray: np.ndarray) -> float:
+    """Variance of the 4-neighbour Laplacian; rises as edges get sharper."""
+    laplacian = (
+        gray[:-2, 1:-1] + gray[2:, 1:-1] + gray[1:-1, :-2] + gray[1:-1, 2:] - 4 * gray[1:-1, 1:-1]
+    )
+    return float(laplacian.var())
+
+def brenner(gray: np.ndarray) -> float:
+    """Brenner gradient: mean squared difference between pixels two apart, in both directions."""
+    dx = gray[:, 2:] - gray[:, :-2]
+    dy = gray[2:, :] - gray[:-2, :]
+    return float((dx * dx).mean() + (dy * dy).mean())
+
+SHARPNESS_METRICS: Dict[str, Callable[[np.ndarray], float]] = {
+    "laplacian": laplacian_variance,
+    "brenner": brenner,
+}
+
+def grayscale(data: BytesLike, downsample: int = 2) -> np.ndarray:
+    """Decode an encoded frame to a float32 grayscale array, scaled down by ``downsample`` while decoding."""
+    with open_image(data) as image:
+        full_width = image.width
+        if downsample > 1:
+            image.draft("L", (image.width // downsample, image.height // downsample))
+        gray = image.convert("L")
+        factor = gray.width * downsample // full_width
+        if factor > 1:
+            gray = gray.reduce(factor)
+        return np.asarray(gray, dtype=np.float32)
+
+def sharpness(data: BytesLike, metric: str = "laplacian", downsample: int = 2) -> float:
+    """
+    Score how sharp an encoded frame is; higher is sharper.
+
+    Args:
+        data (BytesLike): Encoded image, normally a JPEG.
+        metric (str, optional): "laplacian" (variance of the Laplacian) or "brenner". Defaults to "laplacian".
+        downsample (int, optional): Reduction applied while decoding. Defaults to 2.
+
+    Returns:
+        float: Sharpness score, comparable only between frames scored the same way.
+    """
+    with SCORE_SECONDS.time(metric=metric):
+        return SHARPNESS_METRICS[metric](grayscale(data, downsample))
+
+class Autofocus:
+    """
+    Find the sharpest stage height by capturing and scoring frames on this side.
+
+    Each sweep is a single batch sent to the device (move, capture, move,
+    capture, ...), so it costs one broker round-trip. Frames are scored on a
+    thread pool as they stream back, which overlaps scoring frame n with the
+    device capturing frame n + 1. Coarse-to-fine search sweeps ever narrower
+    ranges around the best height. Golden-section search needs fewer frames
+    for a smooth, single-peaked focus curve, but its steps depend on each
+    other and so cost one round-trip each.
+    """
+
+    def __init__(
+        self,
+        microscope,
+        metric: str = "laplacian",
+        resolution: str = "preview",
+        downsample: int = 1,
+        workers: int = 2,
+    ):
+        """
+        Initialize the autofocus engine.
+
+        Args:
+            microscope (MicroscopeDemo): Connected client of the microscope to focus.
+            metric (str, optional): Sharpness metric, "laplacian" or "brenner". Defaults to "laplacian".
+            resolution (str, optional): Capture resolution; previews are plenty for focusing. Defaults to "preview".
+            downsample (int, optional): Further reduction applied before scoring. Defaults to 1.
+            workers (int, optional): Scoring threads. Defaults to 2.
+        """
+        if metric not in SHARPNESS_METRICS:
+            raise ValueError(f"Unknown sharpness metric {metric!r}; expected one of {tuple(SHARPNESS_METRICS)}")
+        self.microscope = microscope
+        self.metric = metric
+        self.resolution = resolution
+        self.downsample = downsample
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="autofocus")
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    def _score(self, result: Dict) -> float:
+        try:
+            return sharpness(result["data"], self.metric, self.downsample)
+        finally:
+            frame = result.get("frame")
+            if frame is not None:
+                frame.release()
+
+    async def sweep(self, zs: Sequence[int], origin: Optional[Dict[str, int]] = None) -> List[Tuple[int, float]]:
+        """
+        Capture and score a frame at each stage height, in the order given.
+
+        Args:
+            zs (Sequence[int]): Absolute z positions.
+            origin (Optional[Dict[str, int]], optional): x and y to stay at. Defaults to the current position.
+
+        Returns:
+            List[Tuple[int, float]]: (z, sharpness) for each position.
+        """
+        origin = origin or await self.microscope.get_pos()
+        steps = []
+        for z in zs:
+            steps.append({"command": "move", "x": origin["x"], "y": origin["y"], "z": int(z)})
+            steps.append({"command": "take_image"})
+        loop = asyncio.get_running_loop()
+        scores = []
+        async for result in self.microscope.batch(steps, resolution=self.resolution):
+            if "error" in result:
+                raise RuntimeError(f"Autofocus step {result.get('step')} failed: {result['error']}")
+            if "data" in result:
+                z = int(zs[result["step"] // 2])
+                scores.append((z, loop.run_in_executor(self._executor, self._score, result)))
+        return [(z, await score) for z, score in scores]
+
+    async def coarse_to_fine(
+        self, span: int = 2000, steps: int = 9, levels: int = 2, tolerance: int = 20
+    ) -> Tuple[int, float]:
+        """
+        Sweep ``span`` around the current height, then sweep again around the best point, narrower each time.
+
+        Args:
+            span (int, optional): z range of the first sweep. Defaults to 2000.
+            steps (int, optional): Frames per sweep. Defaults to 9.
+            levels (int, optional): Number of sweeps. Defaults to 2.
+            tolerance (int, optional): Stop once sweep points are this close together. Defaults to 20.
+
+        Returns:
+            Tuple[int, float]: Best z and its sharpness. The stage is left at that height.
+        """
+        origin = await self.microscope.get_pos()
+        center, best = origin["z"], None
+        for level in range(levels):
+            zs = sorted({int(round(z)) for z in np.linspace(center - span / 2, center + span / 2, steps)})
+            for z, score in await self.sweep(zs, origin):
+                if best is None or score > best[1]:
+                    best = (z, score)
+            center = best[0]
+            # The next sweep covers one step either side of the best point
+            span = 2 * span / (steps - 1)
+            logger.info(f"Autofocus level {level}: best z {best[0]} (score {best[1]:.1f})")
+            if span / (steps - 1) < tolerance:
+                break
+        await self.microscope.move(origin["x"], origin["y"], best[0])
+        return best
+
+    async def golden_section(self, low: int, high: int, tolerance: int = 20) -> Tuple[int, float]:
+        """
+        Golden-section search for the sharpest height between ``low`` and ``high``.
+
+        Assumes a single focus peak in the range; use coarse_to_fine first if unsure.
+
+        Returns:
+            Tuple[int, float]: Best z and its sharpness. The stage is left at that height.
+        """
+        origin = await self.microscope.get_pos()
+        a, b = float(low), float(high)
+        c, d = b - GOLDEN * (b - a), a + GOLDEN * (b - a)
+        # The two starting points go out in one batch
+        (_, fc), (_, fd) = await self.sweep([int(round(c)), int(round(d))], origin)
+        while b - a > tolerance:
+            if fc > fd:
+                b, d, fd = d, c, fc
+                c = b - GOLDEN * (b - a)
+                [(_, fc)] = await self.sweep([int(round(c))], origin)
+            else:
+                a, c, fc = c, d, fd
+                d = a + GOLDEN * (b - a)
+                [(_, fd)] = await self.sweep([int(round(d))], origin)
+        best = (int(round(c)), fc) if fc > fd else (int(round(d)), fd)
+        await self.microscope.move(origin["x"], origin["y"], best[0])
+        return best
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+# Example usage, against the simulator
+async def main():
+    from microscope_demo_client import MicroscopeDemo
+    from simulator import LoopbackBroker, LoopbackClient, SimulatedMicroscope
+
+    broker = LoopbackBroker()
+    client = LoopbackClient(broker)
+    client.connect()
+    with SimulatedMicroscope(broker, latency=0.01, focal_plane=430) as device:
+        async with MicroscopeDemo("loopback", 0, "user", "key", device.name, client=client) as microscope:
+            async with Autofocus(microscope) as autofocus:
+                print(f"Coarse to fine: {await autofocus.coarse_to_fine()}")
+                print(f"Golden section: {await autofocus.golden_section(0, 1000)}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,150 @@
+import argparse
+import asyncio
+import json
+import logging
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List
+
+from frame_buffer import FrameRing
+from microscope_demo_client import MicroscopeDemo
+from simulator import LoopbackBroker, LoopbackClient, SimulatedMicroscope
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return float("nan")
+    index = min(int(round(q / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+async def _call(microscope: MicroscopeDemo, command: str) -> int:
+    """Run one command and return the number of images it produced."""
+    if command == "take_image":
+        (await microscope.take_image()).load()
+        return 1
+    if command == "scan":
+        count = 0
+        async for tile in microscope.scan_iter([0, 0], [2000, 2000], ov=800):
+            tile.image.load()
+            tile.release()
+            count += 1
+        return count
+    if command == "batch":
+        # A 3x3 grid of move-and-capture steps sent as one message
+        steps = []
+        for y in range(3):
+            for x in range(3):
+                steps += [{"command": "move", "x": x * 800, "y": y * 800}, {"command": "take_image"}]
+        count = 0
+        async for result in microscope.batch(steps):
+            if "data" in result:
+                count += 1
+        return count
+    if command == "move":
+        await microscope.move(100, 100, relative=True)
+    else:
+        await getattr(microscope, command)()
+    return 0
+
+async def _run_level(options: Dict, concurrency: int) -> Dict:
+    broker = LoopbackBroker()
+    client = LoopbackClient(broker)
+    client.connect()
+    device = SimulatedMicroscope(
+        broker,
+        latency=options["latency"],
+        focus_latency=options["latency"],
+        image_size=tuple(options["image_size"]),
+        workers=options["device_workers"],
+    )
+    device.jpeg()
+    latencies: List[float] = []
+    images = 0
+    gate = asyncio.Semaphore(concurrency)
+    try:
+        async with MicroscopeDemo(
+            "loopback", 0, "bench", "bench", device.name, client=client, binary=options["binary"],
+            frame_ring=FrameRing(slots=max(concurrency, 8)) if options["frame_ring"] else None,
+        ) as microscope:
+
+            async def one():
+                nonlocal images
+                async with gate:
+                    start = time.perf_counter()
+                    produced = await _call(microscope, options["command"])
+                    images += produced
+                    latencies.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            await asyncio.gather(*(one() for _ in range(options["requests"])))
+            elapsed = time.perf_counter() - start
+    finally:
+        device.close()
+        client.disconnect()
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "requests_per_s": len(latencies) / elapsed,
+        "images_per_s": images / elapsed,
+        "wire_mb": broker.bytes_published / 1e6,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def run_level(options: Dict, concurrency: int) -> Dict:
+    return asyncio.run(_run_level(options, concurrency))
+
+def run(options: Dict, levels: List[int]) -> List[Dict]:
+    """Run each concurrency level in a fresh process so peak RSS is measured per level."""
+    results = []
+    for concurrency in levels:
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            results.append(pool.submit(run_level, options, concurrency).result())
+    return results
+
+def format_table(results: List[Dict]) -> str:
+    header = f"{'conc':>5} {'reqs':>6} {'p50 ms':>9} {'p99 ms':>9} {'req/s':>9} {'img/s':>8} {'wire MB':>9} {'RSS MB':>8}"
+    rows = [
+        f"{r['concurrency']:>5} {r['requests']:>6} {r['p50_ms']:>9.1f} {r['p99_ms']:>9.1f} "
+        f"{r['requests_per_s']:>9.1f} {r['images_per_s']:>8.1f} {r['wire_mb']:>9.2f} {r['peak_rss_mb']:>8.1f}"
+        for r in results
+    ]
+    return "\n".join([header, *rows])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark MicroscopeDemo against a simulated microscope.")
+    parser.add_argument("--command", default="take_image", choices=["get_pos", "move", "focus", "take_image", "scan", "batch"])
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--concurrency", default="1,4,16", help="Comma-separated concurrency levels")
+    parser.add_argument("--latency", type=float, default=0.01, help="Simulated device seconds per command")
+    parser.add_argument("--image-size", default="1640x1232", help="WIDTHxHEIGHT of simulated images")
+    parser.add_argument("--device-workers", type=int, default=4, help="Commands the simulated device runs at once")
+    parser.add_argument("--binary", action="store_true", help="Use binary image frames instead of base64 JSON")
+    parser.add_argument("--frame-ring", action="store_true", help="Receive images into a preallocated frame ring")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON for regression tracking")
+    args = parser.parse_args(argv)
+
+    options = {
+        "command": args.command,
+        "requests": args.requests,
+        "latency": args.latency,
+        "image_size": [int(v) for v in args.image_size.lower().split("x")],
+        "device_workers": args.device_workers,
+        "binary": args.binary,
+        "frame_ring": args.frame_ring,
+    }
+    results = run(options, [int(level) for level in args.concurrency.split(",")])
+    print(json.dumps(results, indent=2) if args.json else format_table(results))
+    return results
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    main()
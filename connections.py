@@ -0,0 +1,41 @@
+import logging
+import os
+import threading
+
+from dotenv import load_dotenv
+
+from mqtt_client import MQTTClient
+
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# One connection per backend for the whole process, opened the first time something asks for it
+_lock = threading.Lock()
+_mqtt_client = None
+_mongo_clients = {}
+
+def get_mqtt_client():
+    """Return the shared MQTT client. The first call starts connecting in the background and returns at once."""
+    global _mqtt_client
+    with _lock:
+        if _mqtt_client is None:
+            _mqtt_client = MQTTClient()
+            _mqtt_client.connect_async()
+        return _mqtt_client
+
+def get_mongo_collection(database_name, collection_name):
+    """Return a collection on the shared MongoDB client, or None if MONGODB_URI is not set."""
+    uri = os.getenv("MONGODB_URI")
+    if not uri:
+        return None
+    with _lock:
+        client = _mongo_clients.get(uri)
+        if client is None:
+            # pymongo is slow to import, so it is only loaded once a collection is actually needed
+            from pymongo.mongo_client import MongoClient
+
+            client = MongoClient(uri)
+            _mongo_clients[uri] = client
+    return client[database_name][collection_name]
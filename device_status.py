@@ -2,7 +2,9 @@ import gradio as gr
 import json
 import logging
 import secrets
-from mqtt_client import MQTTClient
+import time
+from datetime import datetime
+from connections import get_mqtt_client
 from os import environ
 from dotenv import load_dotenv
 
@@ -11,20 +13,74 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# 创建 MQTT 客户端
-mqtt_client = MQTTClient()
+DEVICES = ["microscope", "microscope2", "deltastagetransmission", "deltastagereflection"]
+STATUS_TOPICS = ["+/status", "+/heartbeat"]
+STALE_AFTER = 90  # seconds without a heartbeat before a device is reported offline
+
+class StatusCache:
+    """
+    Latest status reported by each device, kept in memory.
+
+    Devices publish to ``<device>/status`` or ``<device>/heartbeat``; the MQTT
+    network thread writes each report here and readers never touch the broker.
+    """
+
+    def __init__(self, devices, stale_after=STALE_AFTER):
+        self.stale_after = stale_after
+        # device -> (status, details, received_at); each entry is replaced whole, so readers never see a torn update
+        self._entries = {device: None for device in devices}
+
+    def update(self, device, payload):
+        try:
+            details = json.loads(payload)
+        except ValueError:
+            details = payload.decode("utf-8", errors="replace") if isinstance(payload, bytes) else payload
+        if not isinstance(details, dict):
+            details = {"status": str(details).strip() or "online"}
+        self._entries[device] = (details.get("status", "online"), details, time.time())
+
+    def on_message(self, client, userdata, message):
+        device = message.topic.split("/", 1)[0]
+        self.update(device, message.payload)
+
+    def get(self, device):
+        entry = self._entries.get(device)
+        if entry is None:
+            return {"status": "unknown", "last_seen": None}
+        status, details, received_at = entry
+        age = time.time() - received_at
+        if age > self.stale_after:
+            status = "offline"
+        return {
+            **details,
+            "status": status,
+            "last_seen": datetime.fromtimestamp(received_at).isoformat(timespec="seconds"),
+            "age_seconds": round(age, 1),
+        }
+
+    def snapshot(self):
+        return {device: self.get(device) for device in list(self._entries)}
+
+status_cache = StatusCache(DEVICES)
+_tracking = False
+
+def start_status_tracking():
+    """Subscribe the shared MQTT client to device heartbeats. Safe to call repeatedly."""
+    global _tracking
+    if _tracking:
+        return
+    _tracking = True
+    mqtt_client = get_mqtt_client()
+    for topic in STATUS_TOPICS:
+        mqtt_client.add_handler(topic, status_cache.on_message)
+        mqtt_client.subscribe(topic, qos=1)
 
 def get_device_status():
-    # 这里应该实现获取设备状态的逻辑
-    # 现在我们只返回一个模拟的状态
-    return json.dumps({
-        "microscope1": "online",
-        "microscope2": "offline",
-        "deltastagetransmission": "online",
-        "deltastagereflection": "maintenance"
-    }, indent=2)
+    start_status_tracking()
+    return json.dumps(status_cache.snapshot(), indent=2)
 
 def show():
+    start_status_tracking()
     with gr.Blocks() as demo:
         gr.Markdown("# Device Status")
         
@@ -31,7 +31,7 @@ def show():
         
         gr.Markdown("""
         - [AC GitHub Repository](https://github.com/AccelerationConsortium/ac-training-lab/tree/main/src%2Fac_training_lab%2Fopenflexure)
-        - [OpenFlexure Stitching Library](https://gitlab.com/openflexure/openflexure-stitching) (Required for image stitching functionality)
+        - [OpenFlexure Stitching Library](https://gitlab.com/openflexure/openflexure-stitching) (Optional; scans are now stitched in-process)
         """)
         
         gr.Markdown("""
@@ -0,0 +1,366 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+import metrics
+from frame_buffer import FrameRing
+from image_transport import Tile
+from microscope_demo_client import MicroscopeDemo
+from mqtt_client import MQTTClient
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MICROSCOPES = ["microscope", "microscope2", "deltastagetransmission", "deltastagereflection"]
+
+FLEET_COMMANDS = metrics.counter(
+    "fleet_commands_total", "Commands fanned out to fleet devices by outcome (ok, error)", ["device", "result"]
+)
+FLEET_SECONDS = metrics.histogram(
+    "fleet_command_seconds", "Time each device took over a fanned-out command", ["device"]
+)
+
+class DeviceResult(NamedTuple):
+    """What one device returned for a fanned-out command, or the error it raised."""
+
+    device: str
+    value: Any = None
+    error: Optional[BaseException] = None
+    seconds: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+class _DeviceStats:
+    def __init__(self):
+        self.commands = 0
+        self.errors = 0
+        self.images = 0
+        self.bytes = 0
+        self.busy = 0.0
+        self.first_started: Optional[float] = None
+        self.last_finished: Optional[float] = None
+
+    def record(self, started: float, ok: bool, images: int = 0, nbytes: int = 0):
+        finished = time.perf_counter()
+        self.commands += 1
+        self.errors += 0 if ok else 1
+        self.images += images
+        self.bytes += nbytes
+        self.busy += finished - started
+        self.first_started = started if self.first_started is None else min(self.first_started, started)
+        self.last_finished = finished
+
+class Fleet:
+    """
+    Run the same commands on several microscopes at once, over one broker connection.
+
+    The fleet subscribes once to ``+/return`` (and ``+/return/image`` for
+    binary images) rather than once per device. Each device gets its own
+    MicroscopeDemo on the shared client, which picks out its own replies.
+    A fanned-out command runs on every device concurrently, so a protocol
+    takes as long as the slowest stage rather than the sum of all of them.
+    One device failing never stops the others: results come back per
+    device, with the error in place of a value. throughput() reports
+    commands, images and bytes per second for each device. The shared
+    credentials must be allowed to use every device's topics.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        username: str,
+        password: str,
+        microscopes: Sequence[str] = MICROSCOPES,
+        timeout: float = 60.0,
+        binary: bool = False,
+        client: Optional[MQTTClient] = None,
+        frame_ring: Optional[FrameRing] = None,
+    ):
+        """
+        Initialize the fleet and subscribe to every device's replies.
+
+        Args:
+            host (str): MQTT broker host.
+            port (int): MQTT broker port.
+            username (str): MQTT username.
+            password (str): MQTT password.
+            microscopes (Sequence[str], optional): Microscope identifiers. Defaults to the four lab devices.
+            timeout (float, optional): Default seconds to wait for each reply. Defaults to 60.
+            binary (bool, optional): Ask for images as raw JPEG frames. Defaults to False.
+            client (Optional[MQTTClient], optional): Already-connected client to share. Defaults to a new connection.
+            frame_ring (Optional[FrameRing], optional): Ring every device receives images into. Defaults to None.
+        """
+        self._owns_client = client is None
+        # A unique client ID, so two fleets (or processes) do not keep knocking each other off the broker
+        self.client = client or MQTTClient(host, port, f"microscope-fleet-{os.urandom(4).hex()}", username, password)
+        if self._owns_client:
+            try:
+                self.client.connect()
+                logger.info("Connected to MQTT broker")
+            except Exception as e:
+                logger.error(f"Failed to connect to MQTT broker: {e}")
+        self.client.subscribe("+/return", qos=2)
+        if binary:
+            self.client.subscribe("+/return/image", qos=1)
+        self.devices: Dict[str, MicroscopeDemo] = {
+            name: MicroscopeDemo(
+                host, port, username, password, name, timeout=timeout, binary=binary,
+                client=self.client, frame_ring=frame_ring, subscribe=False,
+            )
+            for name in microscopes
+        }
+        self._stats: Dict[str, _DeviceStats] = {name: _DeviceStats() for name in microscopes}
+
+    def _select(self, devices: Optional[Sequence[str]]) -> List[str]:
+        names = list(self.devices) if devices is None else list(devices)
+        unknown = [name for name in names if name not in self.devices]
+        if unknown:
+            raise KeyError(f"Not in this fleet: {', '.join(unknown)}")
+        return names
+
+    async def run(
+        self,
+        command: Callable[[MicroscopeDemo], Awaitable[Any]],
+        devices: Optional[Sequence[str]] = None,
+        timeout: Optional[float] = None,
+        count: Optional[Callable[[Any], Tuple[int, int]]] = None,
+    ) -> Dict[str, DeviceResult]:
+        """
+        Run a command on several devices concurrently and collect each device's result.
+
+        Args:
+            command (Callable[[MicroscopeDemo], Awaitable[Any]]): Called with each device's client,
+                e.g. ``lambda m: m.move(100, 0, relative=True)``.
+            devices (Optional[Sequence[str]], optional): Devices to run on. Defaults to the whole fleet.
+            timeout (Optional[float], optional): Seconds each device may take in total. Defaults to no limit.
+            count (Optional[Callable[[Any], Tuple[int, int]]], optional): Returns the (images, bytes) in a result,
+                for throughput(). Defaults to counting nothing.
+
+        Returns:
+            Dict[str, DeviceResult]: Result per device, in the order given.
+        """
+        names = self._select(devices)
+
+        async def one(name: str) -> DeviceResult:
+            started = time.perf_counter()
+            try:
+                value = await asyncio.wait_for(command(self.devices[name]), timeout)
+            except Exception as e:
+                logger.error(f"{name} failed: {e!r}")
+                self._record(name, started, False)
+                return DeviceResult(name, error=e, seconds=time.perf_counter() - started)
+            images, nbytes = count(value) if count is not None else (0, 0)
+            self._record(name, started, True, images, nbytes)
+            return DeviceResult(name, value, seconds=time.perf_counter() - started)
+
+        results = await asyncio.gather(*(one(name) for name in names))
+        return dict(zip(names, results))
+
+    def _record(self, name: str, started: float, ok: bool, images: int = 0, nbytes: int = 0):
+        self._stats[name].record(started, ok, images, nbytes)
+        FLEET_COMMANDS.inc(device=name, result="ok" if ok else "error")
+        FLEET_SECONDS.observe(time.perf_counter() - started, device=name)
+
+    async def get_pos(self, devices: Optional[Sequence[str]] = None) -> Dict[str, DeviceResult]:
+        """Positions of every device."""
+        return await self.run(lambda m: m.get_pos(), devices)
+
+    async def move(
+        self, x: int, y: int, z: Optional[int] = None, relative: bool = False, devices: Optional[Sequence[str]] = None
+    ) -> Dict[str, DeviceResult]:
+        """Move every device, as MicroscopeDemo.move."""
+        return await self.run(lambda m: m.move(x, y, z, relative=relative), devices)
+
+    async def focus(
+        self, amount: Union[str, int] = "fast", devices: Optional[Sequence[str]] = None
+    ) -> Dict[str, DeviceResult]:
+        """Autofocus every device."""
+        return await self.run(lambda m: m.focus(amount), devices)
+
+    async def take_image(
+        self, resolution: str = "full", devices: Optional[Sequence[str]] = None
+    ) -> Dict[str, DeviceResult]:
+        """Capture on every device; each value is the encoded image as bytes."""
+        return await self.run(
+            lambda m: m.capture(resolution=resolution), devices, count=lambda data: (1, len(data))
+        )
+
+    async def batch(
+        self, steps: List[Dict], resolution: str = "full", devices: Optional[Sequence[str]] = None
+    ) -> Dict[str, DeviceResult]:
+        """
+        Run the same batch of steps on every device; see MicroscopeDemo.batch.
+
+        Each value is the list of step replies. With a frame ring, release the
+        ``frame`` of each capture once done with its data.
+        """
+        async def collect(microscope: MicroscopeDemo) -> List[Dict]:
+            return [reply async for reply in microscope.batch(steps, resolution=resolution)]
+
+        def count(replies: List[Dict]) -> Tuple[int, int]:
+            captures = [reply["data"] for reply in replies if "data" in reply]
+            return len(captures), sum(memoryview(data).nbytes for data in captures)
+
+        return await self.run(collect, devices, count=count)
+
+    async def scan_iter(
+        self,
+        c1: Union[str, List[int]],
+        c2: Union[str, List[int]],
+        ov: int = 1200,
+        foc: int = 0,
+        resolution: str = "full",
+        window: int = 4,
+        devices: Optional[Sequence[str]] = None,
+    ) -> AsyncIterator[Tuple[str, Tile]]:
+        """
+        Scan the same area on every device at once, yielding (device, tile) as tiles arrive from any of them.
+
+        A device whose scan fails is logged and counted in throughput(); the
+        other scans carry on. Release each tile when done with it. Tiles still
+        queued when the iterator is closed early are released for you.
+        """
+        names = self._select(devices)
+        queue: asyncio.Queue = asyncio.Queue(maxsize=window * len(names))
+
+        async def pump(name: str):
+            started, images, nbytes, ok = time.perf_counter(), 0, 0, False
+            try:
+                async for tile in self.devices[name].scan_iter(c1, c2, ov, foc, window=window, resolution=resolution):
+                    images += 1
+                    nbytes += memoryview(tile.data).nbytes
+                    try:
+                        await queue.put((name, tile))
+                    except asyncio.CancelledError:
+                        tile.release()
+                        raise
+                ok = True
+            except Exception as e:
+                logger.error(f"Scan on {name} failed: {e!r}")
+            finally:
+                self._record(name, started, ok, images, nbytes)
+            # Not reached when cancelled: nobody is reading, and a full queue would never make room
+            await queue.put((name, None))
+
+        pumps = [asyncio.create_task(pump(name)) for name in names]
+        try:
+            running = len(pumps)
+            while running:
+                name, tile = await queue.get()
+                if tile is None:
+                    running -= 1
+                    continue
+                yield name, tile
+        finally:
+            for task in pumps:
+                task.cancel()
+            # Hand back tiles that will not be read. This also leaves room for each pump's final marker
+            self._discard(queue)
+            await asyncio.gather(*pumps, return_exceptions=True)
+            self._discard(queue)
+
+    @staticmethod
+    def _discard(queue: asyncio.Queue):
+        while not queue.empty():
+            _, tile = queue.get_nowait()
+            if tile is not None:
+                tile.release()
+
+    async def scan_and_stitch(
+        self,
+        c1: Union[str, List[int]],
+        c2: Union[str, List[int]],
+        directory: str,
+        ov: int = 1200,
+        foc: int = 0,
+        devices: Optional[Sequence[str]] = None,
+        **kwargs,
+    ) -> Dict[str, DeviceResult]:
+        """
+        Scan and stitch the same area on every device, writing ``<directory>/<device>.jpeg``.
+
+        Tiles go to ``<directory>/<device>/``. Other keyword arguments are
+        passed on to MicroscopeDemo.scan_and_stitch. Each value is the path
+        of the stitched image.
+        """
+        async def scan(microscope: MicroscopeDemo) -> str:
+            output = os.path.join(directory, f"{microscope.microscope}.jpeg")
+            temp = os.path.join(directory, microscope.microscope)
+            await microscope.scan_and_stitch(c1, c2, temp, ov, foc, output=output, **kwargs)
+            return output
+
+        return await self.run(scan, devices)
+
+    def throughput(self) -> Dict[str, Dict[str, float]]:
+        """
+        Work done by each device so far.
+
+        Rates are per second of busy time, the time the device spent running
+        fanned-out commands, so idle gaps between runs do not dilute them.
+        ``utilisation`` is the busy share of the time from the device's first
+        command starting to its last one finishing.
+        """
+        report = {}
+        for name, stats in self._stats.items():
+            rate = 1 / stats.busy if stats.busy > 0 else 0.0
+            elapsed = (stats.last_finished - stats.first_started) if stats.commands else 0.0
+            report[name] = {
+                "commands": stats.commands,
+                "errors": stats.errors,
+                "images": stats.images,
+                "bytes": stats.bytes,
+                "commands_per_second": stats.commands * rate,
+                "images_per_second": stats.images * rate,
+                "megabytes_per_second": stats.bytes * rate / 1e6,
+                "utilisation": min(stats.busy / elapsed, 1.0) if elapsed > 0 else 0.0,
+            }
+        return report
+
+    def end_connection(self):
+        for microscope in self.devices.values():
+            microscope.end_connection()
+        if self._owns_client:
+            self.client.disconnect()
+
+    async def __aenter__(self):
+        for microscope in self.devices.values():
+            await microscope.__aenter__()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.end_connection()
+
+# Example usage, against the simulator: the same grid protocol on four stages, one after another and then at once
+async def main():
+    from simulator import LoopbackBroker, LoopbackClient, SimulatedMicroscope
+
+    broker = LoopbackBroker()
+    client = LoopbackClient(broker)
+    client.connect()
+    steps = []
+    for x in range(0, 3000, 1000):
+        steps += [{"command": "move", "x": x, "y": 0}, {"command": "take_image"}]
+    devices = [SimulatedMicroscope(broker, name, latency=0.05) for name in MICROSCOPES]
+    try:
+        async with Fleet("loopback", 0, "user", "key", client=client) as fleet:
+            started = time.perf_counter()
+            for name in MICROSCOPES:
+                await fleet.batch(steps, resolution="preview", devices=[name])
+            sequential = time.perf_counter() - started
+            started = time.perf_counter()
+            results = await fleet.batch(steps, resolution="preview")
+            print(f"Sequential: {sequential:.2f}s, fanned out: {time.perf_counter() - started:.2f}s")
+            print({name: result.ok for name, result in results.items()})
+            for name, stats in fleet.throughput().items():
+                print(f"{name}: {stats['images_per_second']:.1f} images/s, utilisation {stats['utilisation']:.0%}")
+    finally:
+        for device in devices:
+            device.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,165 @@
+import base64
+import binascii
+import logging
+import threading
+from collections import deque
+from multiprocessing import shared_memory
+from typing import Optional, Union
+
+import metrics
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SLOTS_IN_USE = metrics.gauge("frame_ring_slots_in_use", "Frame ring slots holding a frame")
+FALLBACKS = metrics.counter(
+    "frame_ring_fallbacks_total", "Frames copied to the heap because no ring slot was free or large enough"
+)
+
+# Base64 is decoded in pieces of this many characters (a multiple of 4), so no full-size temporary is made
+BASE64_CHUNK = 256 * 1024
+
+class Frame:
+    """
+    One received frame. ``data`` is a read-only view of its bytes.
+
+    Frames held in a ring slot return it on release(), or when the frame is
+    garbage collected. Views derived from ``data`` (for example by a PIL
+    image still reading it) do not keep the slot, so release a frame only
+    once everything reading it is done.
+    """
+
+    def __init__(self, data: memoryview, ring: Optional["FrameRing"] = None, slot: Optional[int] = None):
+        self.data = data
+        self._ring = ring
+        self._slot = slot
+
+    def __len__(self):
+        return self.data.nbytes if self.data is not None else 0
+
+    def release(self):
+        if self.data is None:
+            return
+        # Using the view after release now raises instead of reading whatever frame reuses the slot
+        self.data.release()
+        self.data = None
+        if self._ring is not None:
+            self._ring._free(self._slot)
+            self._ring = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def __del__(self):
+        self.release()
+
+class FrameRing:
+    """
+    A preallocated ring of fixed-size slots that received frames are written into once.
+
+    Decoders, the frame cache, tile writers and the Gradio handlers all read
+    views of a slot instead of copies, and memory stays bounded however many
+    frames arrive. Base64 images are decoded straight into a slot. When every
+    slot is in use, or a frame is larger than a slot, the frame is kept on
+    the heap instead, so the receive thread never waits.
+
+    With ``shared=True`` the slots live in multiprocessing shared memory, and
+    other processes can attach to ``name`` to read a frame at
+    ``slot * slot_size``. The memory is allocated by the first write.
+    """
+
+    def __init__(self, slots: int = 8, slot_size: int = 8 * 1024 * 1024, shared: bool = False):
+        """
+        Initialize the ring.
+
+        Args:
+            slots (int, optional): Frames held at once. Defaults to 8.
+            slot_size (int, optional): Largest frame a slot holds, in bytes. Defaults to 8 MiB.
+            shared (bool, optional): Allocate the slots in shared memory. Defaults to False.
+        """
+        self.slots = slots
+        self.slot_size = slot_size
+        self.shared = shared
+        self._shm: Optional[shared_memory.SharedMemory] = None
+        self._buffer: Optional[memoryview] = None
+        self._views = []
+        self._free_slots = deque(range(slots))
+        self._lock = threading.Lock()
+
+    def _allocate(self):
+        if self.shared:
+            self._shm = shared_memory.SharedMemory(create=True, size=self.slots * self.slot_size)
+            self._buffer = memoryview(self._shm.buf)
+        else:
+            self._buffer = memoryview(bytearray(self.slots * self.slot_size))
+        size = self.slot_size
+        self._views = [self._buffer[i * size:(i + 1) * size] for i in range(self.slots)]
+
+    @property
+    def name(self) -> Optional[str]:
+        """Shared memory block name, or None for a process-local ring (or before the first write)."""
+        return self._shm.name if self._shm is not None else None
+
+    @property
+    def in_use(self) -> int:
+        return self.slots - len(self._free_slots)
+
+    def write(self, data) -> Frame:
+        """Copy encoded frame bytes into a free slot."""
+        length = memoryview(data).nbytes
+        slot = self._acquire(length)
+        if slot is None:
+            return Frame(memoryview(bytes(data)).toreadonly())
+        view = self._views[slot]
+        view[:length] = memoryview(data).cast("B")
+        return Frame(view[:length].toreadonly(), self, slot)
+
+    def write_base64(self, encoded: Union[str, bytes]) -> Frame:
+        """Decode a base64 image straight into a free slot."""
+        slot = self._acquire(len(encoded) * 3 // 4)
+        if slot is None:
+            return Frame(memoryview(base64.b64decode(encoded)).toreadonly())
+        view = self._views[slot]
+        length = 0
+        try:
+            for start in range(0, len(encoded), BASE64_CHUNK):
+                decoded = binascii.a2b_base64(encoded[start:start + BASE64_CHUNK], strict_mode=True)
+                view[length:length + len(decoded)] = decoded
+                length += len(decoded)
+        except (binascii.Error, ValueError):
+            # Line breaks or other padding throw the pieces out of step; decode it in one go instead
+            self._free(slot)
+            return Frame(memoryview(base64.b64decode(encoded)).toreadonly())
+        return Frame(view[:length].toreadonly(), self, slot)
+
+    def close(self):
+        """Free the ring. Frames still held must not be used afterwards."""
+        for view in self._views:
+            view.release()
+        self._views = []
+        if self._buffer is not None:
+            self._buffer.release()
+            self._buffer = None
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    def _acquire(self, length: int) -> Optional[int]:
+        if length <= self.slot_size:
+            with self._lock:
+                if self._buffer is None:
+                    self._allocate()
+                if self._free_slots:
+                    SLOTS_IN_USE.inc()
+                    return self._free_slots.popleft()
+        FALLBACKS.inc()
+        return None
+
+    def _free(self, slot: int):
+        with self._lock:
+            self._free_slots.append(slot)
+            SLOTS_IN_USE.dec()
@@ -0,0 +1,127 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import metrics
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+CACHE_RESULTS = metrics.counter(
+    "frame_cache_results_total", "take_image calls by cache outcome (hit, not_modified, miss)", ["result"]
+)
+
+class CachedFrame(NamedTuple):
+    etag: str
+    data: bytes
+    pos: Optional[Dict]
+    captured_at: float
+    generation: int
+
+class FrameCache:
+    """
+    Recently captured frames of one microscope, least recently used evicted first.
+
+    Frames are keyed by stage position (z being the focus) and camera
+    settings, and bounded by their total encoded size. A frame is served
+    without asking the device while it is younger than ``max_age`` and the
+    stage has not been moved or refocused since it was captured; older frames
+    are only reused after the device confirms, by etag, that they still match.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, max_age: float = 2.0, max_etags: int = 8):
+        """
+        Initialize the cache.
+
+        Args:
+            max_bytes (int, optional): Total encoded bytes kept. Defaults to 64 MiB.
+            max_age (float, optional): Seconds a frame is served without asking the device. Defaults to 2.
+            max_etags (int, optional): Cached etags offered to the device per capture. Defaults to 8.
+        """
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_etags = max_etags
+        self.generation = 0
+        self.size = 0
+        self._frames: "OrderedDict[Tuple, CachedFrame]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._frames)
+
+    @staticmethod
+    def key(pos: Optional[Dict], settings: Dict) -> Tuple:
+        pos = pos or {}
+        return (pos.get("x"), pos.get("y"), pos.get("z"), tuple(sorted(settings.items())))
+
+    def invalidate(self):
+        """Record that the stage moved or refocused, so no frame is served without revalidation."""
+        with self._lock:
+            self.generation += 1
+
+    def fresh(self, settings: Dict) -> Optional[CachedFrame]:
+        """Return the latest frame with these settings if it can be served without asking the device."""
+        now = time.monotonic()
+        with self._lock:
+            for key in reversed(self._frames):
+                frame = self._frames[key]
+                if key[3] != tuple(sorted(settings.items())):
+                    continue
+                if frame.generation == self.generation and now - frame.captured_at < self.max_age:
+                    self._frames.move_to_end(key)
+                    return frame
+                return None
+        return None
+
+    def etags(self, settings: Dict) -> List[str]:
+        """Etags of the most recently used frames with these settings, newest first."""
+        wanted = tuple(sorted(settings.items()))
+        with self._lock:
+            found = [frame.etag for key, frame in reversed(self._frames.items()) if key[3] == wanted]
+        return found[:self.max_etags]
+
+    def revalidate(self, etag: str, generation: int) -> Optional[CachedFrame]:
+        """Mark the frame with this etag as current again after the device answered "not modified"."""
+        with self._lock:
+            for key, frame in self._frames.items():
+                if frame.etag == etag:
+                    frame = frame._replace(captured_at=time.monotonic(), generation=generation)
+                    self._frames[key] = frame
+                    self._frames.move_to_end(key)
+                    return frame
+        return None
+
+    def put(self, etag: str, data, pos: Optional[Dict], settings: Dict, generation: int) -> Optional[CachedFrame]:
+        """Store a newly captured frame, evicting the least recently used ones to stay within max_bytes."""
+        if len(data) > self.max_bytes:
+            return None
+        frame = CachedFrame(etag, bytes(data), pos, time.monotonic(), generation)
+        key = self.key(pos, settings)
+        with self._lock:
+            old = self._frames.pop(key, None)
+            if old is not None:
+                self.size -= len(old.data)
+            self._frames[key] = frame
+            self.size += len(frame.data)
+            while self.size > self.max_bytes:
+                _, evicted = self._frames.popitem(last=False)
+                self.size -= len(evicted.data)
+        return frame
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self.size = 0
+
+_caches: Dict[str, FrameCache] = {}
+_caches_lock = threading.Lock()
+
+def frame_cache_for(microscope: str) -> FrameCache:
+    """Return the frame cache shared by every session on ``microscope``."""
+    with _caches_lock:
+        cache = _caches.get(microscope)
+        if cache is None:
+            cache = _caches[microscope] = FrameCache()
+        return cache
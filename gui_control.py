@@ -1,11 +1,18 @@
 import gradio as gr
 from os import environ
-from microscope_demo_client import MicroscopeDemo
+from session_pool import SessionPool
+from frame_buffer import FrameRing
 import asyncio
+import hashlib
 import os
-from mqtt_client import MQTTClient
+import tempfile
+from collections import OrderedDict
+from connections import get_mqtt_client
+from contextlib import asynccontextmanager
+from key_request import scheduler, validate_access_key
 from dotenv import load_dotenv
 import secrets
+import threading
 
 load_dotenv()
 
@@ -15,60 +22,82 @@ port = int(os.getenv("HIVEMQ_PORT", 8883))
 username = os.getenv("MQTT_USERNAME")
 password = os.getenv("MQTT_PASSWORD")
 
-# Create MQTT client
-mqtt_client = MQTTClient()
-try:
-    mqtt_client.connect()
-    print("Connected to HiveMQ Cloud")
-except Exception as e:
-    print(f"Connection failed: {e}")
+# Keeps each user's microscope connection open between clicks instead of a TLS handshake per button press.
+# Captures are cached per microscope, so a class clicking "Take image" at an unchanged stage shares one frame.
+# Received images land in one shared ring of buffers and are written to disk from there without copying.
+session_pool = SessionPool(broker, port, cache_frames=True, frame_ring=FrameRing())
+
+@asynccontextmanager
+async def leased_session(microscope_selection, access_key):
+    """Borrow a session for one command, provided the key holds the microscope's lease; commands run in order."""
+    # The key store is checked as well, so a key revoked or expired there stops working here too
+    if not await asyncio.to_thread(validate_access_key, microscope_selection, access_key):
+        raise gr.Error(f"This key is not valid for {microscope_selection}; request access and wait for your turn")
+    try:
+        async with scheduler.command(microscope_selection, access_key):
+            async with session_pool.session(microscope_selection, access_key) as microscope:
+                yield microscope
+    except PermissionError as e:
+        raise gr.Error(str(e))
 
 async def get_pos(microscope_selection, access_key):
-    async with MicroscopeDemo(
-        HIVEMQ_BROKER,
-        HIVEMQ_PORT,
-        f"{microscope_selection}clientuser",
-        access_key,
-        microscope_selection
-    ) as microscope:
+    async with leased_session(microscope_selection, access_key) as microscope:
         pos = await microscope.get_pos()
         return f"x: {pos['x']}, y: {pos['y']}, z: {pos['z']}"
 
-async def take_image(microscope_selection, access_key):
-    async with MicroscopeDemo(
-        HIVEMQ_BROKER,
-        HIVEMQ_PORT,
-        f"{microscope_selection}clientuser",
-        access_key,
-        microscope_selection
-    ) as microscope:
-        image = await microscope.take_image()
-        return image
+# Frames are handed to gr.Image as JPEG files, which Gradio serves as they are instead of re-encoding a PIL image
+FRAME_DIR = os.path.join(tempfile.gettempdir(), "openflexure-frames")
+MAX_FRAME_FILES = 64
+_frame_files = OrderedDict()
+# Frames are saved from worker threads, so the index and the files it names change under this lock
+_frame_lock = threading.Lock()
+
+def _save_frame(data):
+    """Write encoded frame bytes to a file named by their hash, so cached frames map to the same file."""
+    path = os.path.join(FRAME_DIR, hashlib.sha1(data).hexdigest() + ".jpeg")
+    with _frame_lock:
+        if path not in _frame_files:
+            os.makedirs(FRAME_DIR, exist_ok=True)
+            # Written beside the target and renamed over it, so Gradio never serves a half-written frame
+            fd, tmp = tempfile.mkstemp(dir=FRAME_DIR, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, path)
+            except BaseException:
+                os.remove(tmp)
+                raise
+        _frame_files[path] = True
+        _frame_files.move_to_end(path)
+        while len(_frame_files) > MAX_FRAME_FILES:
+            old, _ = _frame_files.popitem(last=False)
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+    return path
+
+async def take_image(microscope_selection, access_key, resolution="preview"):
+    async with leased_session(microscope_selection, access_key) as microscope:
+        frame = await microscope.capture_frame(resolution=resolution)
+    with frame:
+        return await asyncio.to_thread(_save_frame, frame.data)
+
+async def take_full_image(microscope_selection, access_key):
+    return await take_image(microscope_selection, access_key, resolution="full")
 
 async def focus(microscope_selection, access_key, focus_amount):
-    async with MicroscopeDemo(
-        HIVEMQ_BROKER,
-        HIVEMQ_PORT,
-        f"{microscope_selection}clientuser",
-        access_key,
-        microscope_selection
-    ) as microscope:
+    async with leased_session(microscope_selection, access_key) as microscope:
         await microscope.focus(focus_amount)
         return "Autofocus complete"
 
 async def move(microscope_selection, access_key, x_move, y_move):
-    async with MicroscopeDemo(
-        HIVEMQ_BROKER,
-        HIVEMQ_PORT,
-        f"{microscope_selection}clientuser",
-        access_key,
-        microscope_selection
-    ) as microscope:
+    async with leased_session(microscope_selection, access_key) as microscope:
         await microscope.move(x_move, y_move)
         return "Move complete"
 
 def send_command(command):
-    mqtt_client.publish("microscope/command", command)
+    get_mqtt_client().publish("microscope/command", command)
     return f"Command sent: {command}"
 
 def show():
@@ -85,9 +114,13 @@ def show():
             get_pos_button.click(fn=get_pos, inputs=[microscope_selection, access_key], outputs=pos_output)
         
         with gr.Tab("Image"):
-            take_image_button = gr.Button("Take image")
-            image_output = gr.Image(label="Microscope Image")
+            with gr.Row():
+                take_image_button = gr.Button("Take image")
+                full_image_button = gr.Button("Full resolution")
+            image_output = gr.Image(label="Microscope Image", type="filepath")
+            # A small preview comes back quickly; the full frame is only sent when asked for
             take_image_button.click(fn=take_image, inputs=[microscope_selection, access_key], outputs=image_output)
+            full_image_button.click(fn=take_full_image, inputs=[microscope_selection, access_key], outputs=image_output)
         
         with gr.Tab("Focus"):
             focus_amount = gr.Slider(minimum=1, maximum=5000, step=100, value=1000, label="Autofocus amount")
@@ -0,0 +1,194 @@
+import base64
+import io
+import json
+import struct
+from typing import Any, Dict, NamedTuple, Optional, Tuple, Union
+
+from PIL import Image
+
+# Binary frames are a 4-byte big-endian header length, a UTF-8 JSON header, then the raw JPEG bytes
+HEADER_LENGTH = struct.Struct("!I")
+JPEG_MAGIC = b"\xff\xd8"
+
+# Resolution tiers accepted by take_image and scan; previews fit within PREVIEW_SIZE
+RESOLUTIONS = ("preview", "full")
+PREVIEW_SIZE = (640, 480)
+
+BytesLike = Union[bytes, bytearray, memoryview]
+
+# EXIF sub-IFD and the UserComment tag in it, where OpenFlexure keeps its capture metadata
+EXIF_IFD = 0x8769
+USER_COMMENT = 0x9286
+
+class MemoryViewReader(io.RawIOBase):
+    """Read-only, seekable file object over a buffer, so PIL can decode it without copying it first."""
+
+    def __init__(self, data: BytesLike):
+        self._view = memoryview(data).cast("B")
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        chunk = self._view[self._pos:self._pos + len(buffer)]
+        n = len(chunk)
+        buffer[:n] = chunk
+        self._pos += n
+        return n
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = len(self._view) + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        self._pos = max(self._pos, 0)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+def encode_frame(metadata: Dict, data: BytesLike) -> bytes:
+    """
+    Pack metadata and raw image bytes into a single binary frame.
+
+    Args:
+        metadata (Dict): JSON-serialisable metadata, e.g. request_id and index.
+        data (BytesLike): Encoded image bytes, normally a JPEG.
+
+    Returns:
+        bytes: Frame ready to publish.
+    """
+    header = json.dumps(metadata).encode("utf-8")
+    return HEADER_LENGTH.pack(len(header)) + header + bytes(data)
+
+def decode_frame(payload: BytesLike, properties=None) -> Tuple[Dict, memoryview]:
+    """
+    Split a binary frame into its metadata and a view of the image bytes.
+
+    A payload that is a bare JPEG carries its metadata in MQTT v5 user
+    properties instead of a header.
+
+    Args:
+        payload (BytesLike): Message payload.
+        properties (optional): paho message properties, consulted for user properties.
+
+    Returns:
+        Tuple[Dict, memoryview]: Metadata and a zero-copy view of the image bytes.
+    """
+    view = memoryview(payload)
+    metadata: Dict = {}
+    user_properties = getattr(properties, "UserProperty", None) or []
+    if view[:2] == JPEG_MAGIC:
+        data = view
+    else:
+        if len(view) < HEADER_LENGTH.size:
+            raise ValueError("Frame is too short to hold a header")
+        (length,) = HEADER_LENGTH.unpack_from(view)
+        start = HEADER_LENGTH.size
+        metadata = json.loads(view[start:start + length].tobytes())
+        data = view[start + length:]
+    for name, value in user_properties:
+        # User properties are always strings, so numbers and positions arrive JSON-encoded
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+        metadata.setdefault(name, value)
+    return metadata, data
+
+def decode_base64_image(encoded: Union[str, bytes]) -> bytes:
+    """Decode a base64 image string from the JSON reply format."""
+    return base64.b64decode(encoded)
+
+def open_image(data: BytesLike, formats: Optional[Tuple[str, ...]] = None) -> Image.Image:
+    """Open encoded image bytes as a PIL image without copying the buffer."""
+    return Image.open(MemoryViewReader(data), formats=formats)
+
+def preview_image(data: BytesLike, max_size: Tuple[int, int] = PREVIEW_SIZE) -> Image.Image:
+    """
+    Decode an image scaled down to fit within ``max_size``.
+
+    draft() makes the JPEG decoder scale by 1/2, 1/4 or 1/8 while decoding and
+    reduce() bins by a further whole factor, so the full frame is never decoded;
+    only the last, small step is resampled.
+    """
+    image = open_image(data)
+    image.draft("RGB", max_size)
+    factor = min(image.width // max_size[0], image.height // max_size[1])
+    if factor > 1:
+        image = image.reduce(factor)
+    scale = min(max_size[0] / image.width, max_size[1] / image.height)
+    if scale < 1:
+        image = image.resize((round(image.width * scale), round(image.height * scale)), Image.BILINEAR)
+    return image
+
+def preview_jpeg(data: BytesLike, max_size: Tuple[int, int] = PREVIEW_SIZE, quality: int = 75) -> bytes:
+    """Return a JPEG preview fitting within ``max_size``; images already that small are returned as they are."""
+    with open_image(data) as image:
+        if image.width <= max_size[0] and image.height <= max_size[1]:
+            return bytes(data)
+    buffer = io.BytesIO()
+    preview_image(data, max_size).convert("RGB").save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+def exif_stage_position(data: BytesLike) -> Optional[Dict[str, int]]:
+    """
+    Read the stage position an OpenFlexure server stored in a capture's EXIF.
+
+    The server writes its metadata as JSON into the UserComment tag, with the
+    position under ``instrument.state.stage.position``. Only the header is read.
+
+    Returns:
+        Optional[Dict[str, int]]: x, y and z, or None if the image carries no position.
+    """
+    try:
+        with open_image(data) as image:
+            comment = image.getexif().get_ifd(EXIF_IFD).get(USER_COMMENT)
+    except (OSError, SyntaxError, ValueError):
+        return None
+    if comment is None:
+        return None
+    if isinstance(comment, bytes):
+        # The tag may start with an 8-byte character code; OpenFlexure writes bare JSON
+        if comment[:8] == b"UNICODE\0":
+            comment = comment[8:].decode("utf-16", errors="replace")
+        else:
+            if comment[:8] in (b"ASCII\0\0\0", b"\0" * 8):
+                comment = comment[8:]
+            comment = comment.decode("utf-8", errors="replace")
+    try:
+        position = json.loads(comment.strip("\0"))["instrument"]["state"]["stage"]["position"]
+        return {"x": int(position["x"]), "y": int(position["y"]), "z": int(position.get("z", 0))}
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+class Tile(NamedTuple):
+    """
+    One scan tile: its index in the scan, stage position and encoded image bytes.
+
+    When the bytes live in a frame ring slot, ``frame`` holds the slot; the
+    tile's data stays valid until release() is called or the tile is dropped.
+    """
+
+    index: int
+    pos: Optional[Dict[str, int]]
+    data: BytesLike
+    frame: Optional[Any] = None
+
+    def release(self):
+        """Return the tile's frame ring slot, if it has one. The tile's data must not be used afterwards."""
+        if self.frame is not None:
+            self.frame.release()
+
+    @property
+    def image(self) -> Image.Image:
+        """Decode the tile. Each access opens a new image, so keep the result if you need it twice."""
+        return open_image(self.data)
@@ -2,9 +2,11 @@ import gradio as gr
 import logging
 import secrets
 import string
-from datetime import datetime, timedelta
-from pymongo.mongo_client import MongoClient
-from os import environ
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from connections import get_mongo_collection
+from scheduler import DeviceScheduler
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -12,59 +14,244 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-MONGODB_URI = environ["MONGODB_URI"]
-
 database_name = "openflexure-microscope"
 collection_name = "Cluster0"
 microscopes = ["microscope", "microscope2", "deltastagetransmission", "deltastagereflection"]
 access_time = 180  # 3 minutes
 
-client = MongoClient(MONGODB_URI)
-db = client[database_name]
-collection = db[collection_name]
+class InMemoryCollection:
+    """
+    Dict-backed stand-in for the few pymongo Collection methods KeyStore uses.
+
+    For tests and local runs without MongoDB; mongomock works just as well.
+    """
+
+    def __init__(self):
+        self._documents = {}
+        self._lock = threading.Lock()
+        self.indexes = []
+
+    def create_index(self, keys, **kwargs):
+        self.indexes.append((keys, kwargs))
+        return keys if isinstance(keys, str) else "_".join(f"{k}_{d}" for k, d in keys)
+
+    def _live(self, document):
+        expires_at = document.get("expires_at")
+        return expires_at is None or _as_utc(expires_at) > datetime.now(timezone.utc)
+
+    def find_one(self, query):
+        with self._lock:
+            document = self._documents.get(query["variable_name"])
+            return dict(document) if document is not None and self._live(document) else None
+
+    def find(self, query):
+        names = query["variable_name"]["$in"]
+        with self._lock:
+            documents = [self._documents.get(name) for name in names]
+            return [dict(d) for d in documents if d is not None and self._live(d)]
+
+    def update_one(self, query, update, upsert=False):
+        with self._lock:
+            name = query["variable_name"]
+            if name in self._documents:
+                self._documents[name].update(update["$set"])
+            elif upsert:
+                self._documents[name] = {"variable_name": name, **update["$set"]}
+
+def _as_utc(moment):
+    # pymongo hands back naive datetimes that are already in UTC
+    return moment.replace(tzinfo=timezone.utc) if moment.tzinfo is None else moment
+
+def _document_value(document):
+    """Return a document's value, with the expiration of keys stored before KeyStore made timezone-aware."""
+    if document is None:
+        return None
+    value = document.get("value")
+    if "expires_at" not in document and isinstance(value, dict) and isinstance(value.get("expiration"), datetime):
+        # Older records have no expires_at and hold a naive expiration in the server's local time
+        if value["expiration"].tzinfo is None:
+            value = {**value, "expiration": value["expiration"].astimezone(timezone.utc)}
+    return value
+
+class KeyStore:
+    """
+    Access keys stored one document per ``variable_name`` with a short-lived local cache.
+
+    ``variable_name`` has a unique index so lookups are a single index probe,
+    and ``expires_at`` has a TTL index so MongoDB removes expired keys itself.
+    Reads go through a cache that holds each value for ``cache_ttl`` seconds,
+    so validating a key on every command does not cost a network round-trip.
+    """
+
+    def __init__(self, collection, cache_ttl=5.0, index_retry=60.0):
+        self.collection = collection
+        self.cache_ttl = cache_ttl
+        self.index_retry = index_retry
+        self._cache = {}
+        self._indexed = False
+        self._index_failed_at = None
+        self._lock = threading.Lock()
+
+    def _index_backoff(self):
+        return self._index_failed_at is not None and time.monotonic() - self._index_failed_at < self.index_retry
+
+    def ensure_indexes(self):
+        """Create the indexes once; after a failure, wait ``index_retry`` seconds before trying again."""
+        if self._indexed or self._index_backoff():
+            return
+        with self._lock:
+            if self._indexed or self._index_backoff():
+                return
+            try:
+                self.collection.create_index("variable_name", unique=True)
+                self.collection.create_index("expires_at", expireAfterSeconds=0)
+            except Exception as e:
+                # Reads and writes still work without the indexes, so they go ahead and only the failure is logged
+                if self._index_failed_at is None:
+                    logger.error(f"Error creating key indexes, retrying every {self.index_retry:g}s: {e}")
+                self._index_failed_at = time.monotonic()
+                return
+            if self._index_failed_at is not None:
+                logger.info("Created key indexes after an earlier failure")
+            self._indexed = True
+
+    def get(self, variable_name):
+        cached = self._cache.get(variable_name)
+        if cached is not None and time.monotonic() - cached[1] < self.cache_ttl:
+            return cached[0]
+        self.ensure_indexes()
+        value = _document_value(self.collection.find_one({"variable_name": variable_name}))
+        self._cache[variable_name] = (value, time.monotonic())
+        return value
+
+    def prefetch(self, variable_names):
+        """Load several values into the cache with a single query."""
+        self.ensure_indexes()
+        found = {
+            document["variable_name"]: _document_value(document)
+            for document in self.collection.find({"variable_name": {"$in": list(variable_names)}})
+        }
+        now = time.monotonic()
+        for name in variable_names:
+            self._cache[name] = (found.get(name), now)
+
+    def set(self, variable_name, value, expires_at=None):
+        self.ensure_indexes()
+        fields = {"value": value}
+        if expires_at is not None:
+            fields["expires_at"] = expires_at
+        self.collection.update_one({"variable_name": variable_name}, {"$set": fields}, upsert=True)
+        self._cache[variable_name] = (value, time.monotonic())
+
+    def validate_key(self, microscope, key):
+        """Return True if ``key`` is the current, unexpired key for ``microscope``."""
+        value = self.get(f"{microscope}_key")
+        if not value or not key:
+            return False
+        # The TTL monitor only runs about once a minute, so expiry is checked here as well
+        if _as_utc(value["expiration"]) <= datetime.now(timezone.utc):
+            return False
+        return secrets.compare_digest(value["key"], key)
+
+_key_store = None
+_key_store_lock = threading.Lock()
+
+def get_key_store():
+    """Return the shared KeyStore, connecting to MongoDB on first use."""
+    global _key_store
+    with _key_store_lock:
+        if _key_store is None:
+            collection = get_mongo_collection(database_name, collection_name)
+            if collection is None:
+                logger.warning("MONGODB_URI is not set; access keys are kept in memory only")
+                collection = InMemoryCollection()
+            _key_store = KeyStore(collection)
+        return _key_store
 
 def check_variable(variable_name):
     try:
-        document = collection.find_one({"variable_name": variable_name})
-        return document.get("value") if document else None
+        return get_key_store().get(variable_name)
     except Exception as e:
         logger.error(f"Error checking variable: {e}")
         return None
 
-def update_variable(variable_name, new_value):
+def update_variable(variable_name, new_value, expires_at=None):
     try:
-        collection.update_one(
-            {"variable_name": variable_name},
-            {"$set": {"value": new_value}},
-            upsert=True
-        )
+        get_key_store().set(variable_name, new_value, expires_at)
     except Exception as e:
         logger.error(f"Error updating variable: {e}")
 
-def generate_access_key(microscope):
+def validate_access_key(microscope, key):
+    try:
+        return get_key_store().validate_key(microscope, key)
+    except Exception as e:
+        logger.error(f"Error validating key: {e}")
+        return False
+
+def _issue_key(microscope, seconds):
     # Generate a random key
     key = ''.join(secrets.choice(string.ascii_letters + string.digits) for _ in range(20))
     
     # Set expiration time (e.g., 3 minutes from now)
-    expiration_time = datetime.now() + timedelta(minutes=3)
+    expiration_time = datetime.now(timezone.utc) + timedelta(seconds=seconds)
     
     # Store the key in MongoDB (you might want to encrypt it in a real application)
-    update_variable(f"{microscope}_key", {"key": key, "expiration": expiration_time})
-    
-    logger.info(f"Generated key for {microscope}, expires at {expiration_time}")
-    
-    return f"Your temporary access key for {microscope} is: {key}\nIt will expire at {expiration_time}"
+    update_variable(f"{microscope}_key", {"key": key, "expiration": expiration_time}, expires_at=expiration_time)
+    logger.info(f"Generated key for {microscope}")
+    return key
+
+def _revoke_key(microscope):
+    now = datetime.now(timezone.utc)
+    update_variable(f"{microscope}_key", {"key": "", "expiration": now}, expires_at=now)
+
+# Keys are only handed out in turn: one lease per microscope, everyone else queued round-robin
+scheduler = DeviceScheduler(_issue_key, _revoke_key, lease_seconds=access_time)
+
+def _user(request):
+    # Gradio identifies each browser session; plain Python callers share one identity
+    return getattr(request, "session_hash", None) or "anonymous"
+
+def _format_wait(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes} min {seconds} s" if minutes else f"{seconds} s"
+
+def generate_access_key(microscope, request: gr.Request = None):
+    ticket = scheduler.request(microscope, _user(request))
+    if ticket.status == "waiting":
+        return (
+            f"{microscope} is in use. You are number {ticket.position} in the queue, "
+            f"estimated wait {_format_wait(ticket.wait)}.\n"
+            f"Click again to check your place. When your turn comes you have "
+            f"{_format_wait(scheduler.claim_seconds)} to collect your key."
+        )
+    if ticket.status == "ready":
+        return f"It is your turn on {microscope}; your key is being prepared. Click again in a moment to collect it."
+    if ticket.status == "released":
+        return f"You released {microscope} before your key was ready. Click again to rejoin the queue."
+    local_expiration = datetime.fromtimestamp(ticket.expires_at).astimezone().strftime("%Y-%m-%d %H:%M:%S")
+    return f"Your temporary access key for {microscope} is: {ticket.key}\nIt will expire at {local_expiration}"
+
+def release_access_key(microscope, request: gr.Request = None):
+    if scheduler.release(microscope, _user(request)):
+        return f"Released {microscope}; the next person in the queue can use it now."
+    return f"You do not hold or wait for {microscope}."
 
 def show():
     with gr.Blocks() as demo:
         gr.Markdown("# Request Temporary Access Key")
-        gr.Markdown(f"Keys will last {access_time/60} minutes before being overridable.")
+        gr.Markdown(
+            f"Keys last {access_time/60} minutes. If the microscope is in use you join a queue; "
+            "people take turns, and the estimated wait is shown below."
+        )
         
         microscope_dropdown = gr.Dropdown(choices=microscopes, label="Choose a microscope:", value="microscope2")
         output = gr.Textbox(label="Access Key or Wait Time")
         
-        generate_button = gr.Button("Request temporary access")
+        with gr.Row():
+            generate_button = gr.Button("Request temporary access")
+            release_button = gr.Button("Release access")
         generate_button.click(generate_access_key, inputs=[microscope_dropdown], outputs=[output])
+        release_button.click(release_access_key, inputs=[microscope_dropdown], outputs=[output])
         
     return demo
 
@@ -1,20 +1,56 @@
-import base64
-import io
+import contextlib
+import functools
 import json
 import os
-import shutil
 import time
+import uuid
 import asyncio
-from io import BytesIO
-from typing import List, Dict, Union, Optional
+from typing import AsyncIterator, List, Dict, Union, Optional
 import logging
 
+import metrics
+from async_bridge import AsyncBridge
+from frame_buffer import Frame, FrameRing
+from frame_cache import CACHE_RESULTS, FrameCache
+from image_transport import (
+    RESOLUTIONS, Tile, decode_base64_image, decode_frame, exif_stage_position, open_image, preview_jpeg
+)
 from mqtt_client import MQTTClient
+from tile_sink import TileSink
 from PIL import Image
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Commands the device can run as steps of a batch
+BATCH_COMMANDS = ("move", "focus", "get_pos", "take_image")
+# Most chunks a split tile may claim; more means a corrupt or hostile header
+MAX_CHUNKS = 1024
+
+REQUEST_SECONDS = metrics.histogram(
+    "microscope_request_seconds", "Time from publishing a command to its last reply", ["command"]
+)
+REQUESTS_IN_FLIGHT = metrics.gauge("microscope_requests_in_flight", "Commands awaiting a reply")
+TIMEOUTS = metrics.counter("microscope_timeouts_total", "Commands that timed out", ["command"])
+DECODE_SECONDS = metrics.histogram(
+    "microscope_decode_seconds", "Time spent decoding replies", ["stage"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+
+class _Stream(asyncio.Queue):
+    """
+    Replies to one streaming request, waiting to be read.
+
+    The device sends items only against credit, which the client returns one
+    per item read, so at most ``window`` items are ever held here.
+    """
+
+    def __init__(self, window: int):
+        super().__init__()
+        self.window = window
+        self.held = 0  # items (not the done message) waiting to be read
+        self.failed = False
+
 class MicroscopeDemo:
     def __init__(
         self,
@@ -24,6 +60,13 @@ class MicroscopeDemo:
         password: str,
         microscope: str,
         path_to_openflexure_stitching: str = "OPTIONAL",
+        timeout: float = 60.0,
+        max_queued: int = 100,
+        binary: bool = False,
+        client: Optional[MQTTClient] = None,
+        frame_cache: Optional[FrameCache] = None,
+        frame_ring: Optional[FrameRing] = None,
+        subscribe: bool = True,
     ):
         """
         Initialize the MicroscopeDemo client.
@@ -34,7 +77,20 @@ class MicroscopeDemo:
             username (str): MQTT username.
             password (str): MQTT password.
             microscope (str): Microscope identifier.
-            path_to_openflexure_stitching (str, optional): Path to OpenFlexure stitching software.
+            path_to_openflexure_stitching (str, optional): Unused; stitching now runs in-process. Kept for compatibility.
+            timeout (float, optional): Default seconds to wait for a reply to each command. Defaults to 60.
+            max_queued (int, optional): Replies buffered before the network thread is held back. Defaults to 100.
+            binary (bool, optional): Ask for images as raw JPEG frames on ``<microscope>/return/image``
+                instead of base64 inside the JSON reply. Needs firmware support. Defaults to False.
+            client (Optional[MQTTClient], optional): Already-connected client (or compatible transport) to use
+                instead of opening a new connection. It is left open by end_connection. Defaults to None.
+            frame_cache (Optional[FrameCache], optional): Cache of recent captures, normally shared by every
+                client of the same microscope. take_image then reuses a frame while the stage is unchanged.
+                Defaults to None (no caching).
+            frame_ring (Optional[FrameRing], optional): Preallocated slots received images are written into once,
+                and read from as views, keeping memory bounded. Can be shared between clients. Defaults to None.
+            subscribe (bool, optional): Subscribe to this microscope's reply topics. Pass False when ``client``
+                already holds a wildcard subscription covering them, as a Fleet's does. Defaults to True.
         """
         self.host = host
         self.port = port
@@ -42,25 +98,67 @@ class MicroscopeDemo:
         self.password = password
         self.microscope = microscope
         self.path_to_openflexure_stitching = path_to_openflexure_stitching
+        self.timeout = timeout
+        self.binary = binary
+        self.frame_cache = frame_cache
+        self.frame_ring = frame_ring
 
-        self.client = MQTTClient(host, port, f"microscope-demo-{microscope}", username, password)
+        self._owns_client = client is None
+        # Brokers drop a connection when another arrives with its client ID, so every instance gets its own
+        client_id = f"microscope-demo-{microscope}-{os.urandom(4).hex()}"
+        self.client = client or MQTTClient(host, port, client_id, username, password)
 
-        self.receiveq = asyncio.Queue()
+        # Replies are matched to callers by request ID, so several commands can be in flight at once.
+        # Single-reply commands wait on a future, streamed scans on a queue bounded by their credit window.
+        self._pending: Dict[str, Union[asyncio.Future, _Stream]] = {}
+        # request ID -> (command name, perf_counter at publish), for latency metrics
+        self._started: Dict[str, tuple] = {}
+        # Tiles too large for one broker message arrive in chunks, keyed by (request ID, tile index)
+        self._chunks: Dict[tuple, List] = {}
+        # paho calls on_message from its own network thread, so replies cross over to the event loop here
+        self._bridge = AsyncBridge(self._route_reply, maxsize=max_queued)
 
         def on_message(client, userdata, message):
-            received = json.loads(message.payload.decode("utf-8"))
-            asyncio.create_task(self.receiveq.put(received))
-            logger.debug(f"Received message: {received}")
+            try:
+                with DECODE_SECONDS.time(stage="json"):
+                    received = json.loads(message.payload)
+            except ValueError as e:
+                logger.error(f"Discarding malformed reply on {message.topic}: {e}")
+                return
+            if self.frame_ring is not None and isinstance(received.get("image"), str):
+                # Decode on this thread straight into a ring slot; the event loop only sees a view
+                with DECODE_SECONDS.time(stage="base64"):
+                    frame = self.frame_ring.write_base64(received.pop("image"))
+                received["data"], received["frame"] = frame.data, frame
+            self._bridge.post(received)
 
-        self.client.client.on_message = on_message
+        def on_image(client, userdata, message):
+            try:
+                with DECODE_SECONDS.time(stage="frame"):
+                    metadata, data = decode_frame(message.payload, getattr(message, "properties", None))
+            except ValueError as e:
+                logger.error(f"Discarding malformed frame on {message.topic}: {e}")
+                return
+            if self.frame_ring is not None:
+                frame = self.frame_ring.write(data)
+                metadata["frame"] = frame
+                data = frame.data
+            self._bridge.post({**metadata, "data": data})
 
-        try:
-            self.client.connect()
-            logger.info("Connected to MQTT broker")
-        except Exception as e:
-            logger.error(f"Failed to connect to MQTT broker: {e}")
+        self.client.add_handler(self.microscope + "/return", on_message)
+        self.client.add_handler(self.microscope + "/return/image", on_image)
+
+        if self._owns_client:
+            try:
+                self.client.connect()
+                logger.info("Connected to MQTT broker")
+            except Exception as e:
+                logger.error(f"Failed to connect to MQTT broker: {e}")
 
-        self.client.subscribe(self.microscope + "/return", qos=2)
+        if subscribe:
+            self.client.subscribe(self.microscope + "/return", qos=2)
+            if self.binary:
+                self.client.subscribe(self.microscope + "/return/image", qos=1)
 
     async def scan_and_stitch(
         self, 
@@ -69,7 +167,12 @@ class MicroscopeDemo:
         temp: str, 
         ov: int = 1200, 
         foc: int = 0, 
-        output: str = "Downloads/stitched.jpeg"
+        output: str = "Downloads/stitched.jpeg",
+        timeout: Optional[float] = None,
+        pixels_per_step: Optional[float] = None,
+        plan=None,
+        archive=None,
+        pyramid: Optional[str] = None,
     ) -> None:
         """
         Scan an area and stitch the resulting images.
@@ -77,46 +180,59 @@ class MicroscopeDemo:
         Args:
             c1 (Union[str, List[int]]): First corner coordinates.
             c2 (Union[str, List[int]]): Second corner coordinates.
-            temp (str): Temporary directory for storing images.
+            temp (str): Directory the received tiles and their manifest.json are written to.
             ov (int, optional): Overlap between images. Defaults to 1200.
             foc (int, optional): Focus adjustment between images. Defaults to 0.
             output (str, optional): Output path for stitched image. Defaults to "Downloads/stitched.jpeg".
+            timeout (Optional[float], optional): Seconds to wait for each tile. Defaults to the client timeout.
+            pixels_per_step (Optional[float], optional): Stage-to-pixel scale. Defaults to fitting it from the tile overlaps.
+            plan (Optional[ScanPlan], optional): A plan from scan_planner.ScanPlanner to capture instead of
+                rastering c1 to c2 at overlap ov. Defaults to None.
+            archive (Optional[ScanArchive], optional): Archive to also store the tiles in, so the scan can be
+                stitched again later without the microscope. Defaults to None.
+            pyramid (Optional[str], optional): Directory to write a DeepZoom pyramid to, named after ``output``,
+                instead of the single stitched JPEG. The pyramid is written tile by tile, so use it for scans
+                too large to compose in memory. Defaults to None.
         """
-        command = json.dumps(
-            {"command": "scan", "c1": c1, "c2": c2, "ov": ov, "foc": foc}
-        )
-        self.client.publish(
-            self.microscope + "/command", command, qos=2
-        )
-        image = await self.receiveq.get()
-        image_list = image["images"]
-        if os.path.isdir(temp):
-            shutil.rmtree(temp)
-        os.makedirs(temp)
-        for i, img_data in enumerate(image_list):
-            image_bytes = base64.b64decode(img_data)
-            with io.BytesIO(image_bytes) as buffer:
-                img = Image.open(buffer)
-                img.save(
-                    os.path.join(temp, f"{i}.jpeg"),
-                    format="JPEG",
-                    exif=img.info.get("exif"),
-                )
-        
-        # Run OpenFlexure stitching
-        stitch_command = (
-            f"cd {self.path_to_openflexure_stitching} && "
-            "python -m venv .venv && "
-            ".\.venv\Scripts\activate && "
-            f"openflexure-stitch {temp}"
-        )
-        os.system(stitch_command)
+        if plan is not None:
+            from scan_planner import execute
+
+            received = execute(self, plan, timeout=timeout)
+        else:
+            received = self.scan_iter(c1, c2, ov, foc, timeout=timeout)
+        recorder = None
+        if archive is not None:
+            name = os.path.splitext(os.path.basename(output))[0]
+            recorder = archive.recorder(name, self.microscope, {"c1": c1, "c2": c2, "ov": ov, "foc": foc})
+        tiles = []
+        # Tiles are written as received, off the event loop; the manifest says which files belong to this scan
+        async with TileSink(temp) as sink:
+            async for tile in received:
+                tiles.append(tile)
+                await sink.put(tile)
+                if recorder is not None:
+                    await recorder.put(tile)
+        if recorder is not None:
+            await recorder.close()
+
+        # numpy and the stitcher are only imported by the first scan that needs them, keeping app startup light
+        from stitching import stitch_to_file, stitch_to_pyramid
 
-        # Move stitched image to output location
-        stitched_file = f"{os.path.basename(temp)}_stitched.jpg"
-        shutil.move(os.path.join(temp, stitched_file), output)
+        if pyramid is not None:
+            name = os.path.splitext(os.path.basename(output))[0]
+            stitch = functools.partial(stitch_to_pyramid, tiles, pyramid, name, pixels_per_step=pixels_per_step)
+        else:
+            stitch = functools.partial(stitch_to_file, tiles, output, pixels_per_step=pixels_per_step)
+        # Stitch from the tiles already in memory; registration spreads over a process pool
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, stitch)
+        finally:
+            for tile in tiles:
+                tile.release()
 
-    async def move(self, x: int, y: int, z: Optional[int] = None, relative: bool = False) -> Dict:
+    async def move(
+        self, x: int, y: int, z: Optional[int] = None, relative: bool = False, timeout: Optional[float] = None
+    ) -> Dict:
         """
         Move the microscope to specified coordinates.
 
@@ -125,19 +241,28 @@ class MicroscopeDemo:
             y (int): Y coordinate.
             z (Optional[int], optional): Z coordinate. If None, Z won't change. Defaults to None.
             relative (bool, optional): If True, move relative to current position. Defaults to False.
+            timeout (Optional[float], optional): Seconds to wait for the reply. Defaults to the client timeout.
 
         Returns:
             Dict: Response from the microscope.
         """
-        command = json.dumps(
-            {"command": "move", "x": x, "y": y, "z": z, "relative": relative}
-        )
-        self.client.publish(
-            self.microscope + "/command", command, qos=2
-        )
-        return await self.receiveq.get()
+        self._invalidate_frames()
+        try:
+            return await self._request(
+                {"command": "move", "x": x, "y": y, "z": z, "relative": relative}, timeout
+            )
+        finally:
+            self._invalidate_frames()
 
-    async def scan(self, c1: Union[str, List[int]], c2: Union[str, List[int]], ov: int = 1200, foc: int = 0) -> List[Image.Image]:
+    async def scan(
+        self,
+        c1: Union[str, List[int]],
+        c2: Union[str, List[int]],
+        ov: int = 1200,
+        foc: int = 0,
+        timeout: Optional[float] = None,
+        resolution: str = "full",
+    ) -> List[Image.Image]:
         """
         Scan an area and return a list of images.
 
@@ -146,69 +271,509 @@ class MicroscopeDemo:
             c2 (Union[str, List[int]]): Second corner coordinates.
             ov (int, optional): Overlap between images. Defaults to 1200.
             foc (int, optional): Focus adjustment between images. Defaults to 0.
+            timeout (Optional[float], optional): Seconds to wait for each tile. Defaults to the client timeout.
+            resolution (str, optional): "preview" for small, fast tiles or "full". Defaults to "full".
 
         Returns:
             List[Image.Image]: List of scanned images.
         """
-        command = json.dumps(
-            {"command": "scan", "c1": c1, "c2": c2, "ov": ov, "foc": foc}
-        )
-        self.client.publish(
-            self.microscope + "/command", command, qos=2
-        )
-        image_l = await self.receiveq.get()
-        return [Image.open(BytesIO(base64.b64decode(img))) for img in image_l["images"]]
+        images = []
+        async for tile in self.scan_iter(c1, c2, ov, foc, timeout=timeout, resolution=resolution):
+            image = tile.image
+            # Decode now so the tile's buffer can be handed back
+            image.load()
+            tile.release()
+            images.append(image)
+        return images
 
-    async def focus(self, amount: Union[str, int] = "fast") -> Dict:
+    async def scan_iter(
+        self,
+        c1: Union[str, List[int]],
+        c2: Union[str, List[int]],
+        ov: int = 1200,
+        foc: int = 0,
+        window: int = 4,
+        timeout: Optional[float] = None,
+        resolution: str = "full",
+    ) -> AsyncIterator[Tile]:
+        """
+        Scan an area and yield each tile as soon as it arrives.
+
+        The device is asked to stream one message per tile (split into chunks
+        when a tile is larger than the broker allows), followed by a
+        ``{"done": true, "count": n}`` message. The device may send ``window``
+        tiles ahead of the consumer and is granted one more for each tile
+        read, so a slow consumer pauses the scan instead of filling memory,
+        and other commands can still be issued from inside the loop. Firmware
+        that still answers with a
+        single ``images`` reply is handled too: as it reports no positions,
+        each tile's is read from the OpenFlexure metadata in its EXIF, or failing
+        that assumed from the raster order the scan was taken in.
+
+        Args:
+            c1 (Union[str, List[int]]): First corner coordinates.
+            c2 (Union[str, List[int]]): Second corner coordinates.
+            ov (int, optional): Overlap between images. Defaults to 1200.
+            foc (int, optional): Focus adjustment between images. Defaults to 0.
+            window (int, optional): Tiles the device may send ahead of the consumer. Defaults to 4.
+            timeout (Optional[float], optional): Seconds to wait for each tile. Defaults to the client timeout.
+            resolution (str, optional): "preview" for tiles no larger than PREVIEW_SIZE, or "full". Defaults to "full".
+
+        Yields:
+            Tile: Tile index, stage position (if reported) and encoded image bytes.
+        """
+        command = {
+            "command": "scan", "c1": c1, "c2": c2, "ov": ov, "foc": foc,
+            "stream": True, "window": window, **self._image_options(), **self._image_settings(resolution),
+        }
+        async with contextlib.aclosing(self._stream(command, window, timeout)) as replies:
+            received = 0
+            async for message in replies:
+                if "images" in message:
+                    raster = None
+                    for i, img in enumerate(message["images"]):
+                        data = decode_base64_image(img)
+                        pos = exif_stage_position(data)
+                        if pos is None:
+                            if raster is None:
+                                raster = self._raster_positions(c1, c2, ov, data, len(message["images"]))
+                            pos = raster[i] if raster else None
+                        yield Tile(i, pos, self._at_resolution(data, resolution))
+                    return
+                tile = self._message_tile(message, received)
+                received += 1
+                if resolution == "preview":
+                    preview = self._at_resolution(tile.data, resolution)
+                    tile.release()
+                    tile = tile._replace(data=preview, frame=None)
+                yield tile
+
+    async def batch(
+        self,
+        steps: List[Dict],
+        window: int = 4,
+        timeout: Optional[float] = None,
+        resolution: str = "full",
+        stop_on_error: bool = True,
+    ) -> AsyncIterator[Dict]:
+        """
+        Run a list of commands on the device from a single message, yielding each result as it arrives.
+
+        A grid or time-lapse routine then costs one broker round-trip in total
+        instead of one per step. Results stream back like scan tiles.
+
+        Args:
+            steps (List[Dict]): Commands as they would be sent on their own, e.g.
+                ``{"command": "move", "x": 100, "y": 0, "relative": True}`` or ``{"command": "take_image"}``.
+                Allowed commands are move, focus, get_pos and take_image.
+            window (int, optional): Results the device may send ahead of the consumer. Defaults to 4.
+            timeout (Optional[float], optional): Seconds to wait for each result. Defaults to the client timeout.
+            resolution (str, optional): "preview" or "full" for every capture in the batch. Defaults to "full".
+            stop_on_error (bool, optional): Skip the remaining steps after one fails. Defaults to True.
+
+        Yields:
+            Dict: Reply to each step, with its ``step`` index and ``command``; failed steps carry ``error``.
+            Captures carry the encoded image under ``data``, which image_transport.open_image decodes.
+            With a frame ring, ``data`` is a view of the ring slot held by ``frame``: keep the
+            result while using the data, and call ``frame.release()`` when done.
+        """
+        for step in steps:
+            if step.get("command") not in BATCH_COMMANDS:
+                raise ValueError(f"{step.get('command')!r} cannot run in a batch; use one of {BATCH_COMMANDS}")
+        command = {
+            "command": "batch", "steps": steps, "stop_on_error": stop_on_error,
+            "stream": True, "window": window, **self._image_options(), **self._image_settings(resolution),
+        }
+        async with contextlib.aclosing(self._stream(command, window, timeout)) as replies:
+            async for message in replies:
+                if resolution == "preview" and ("data" in message or "image" in message):
+                    data = self._at_resolution(self._message_data(message), resolution)
+                    self._release(message)
+                    message = {k: v for k, v in message.items() if k not in ("image", "frame")}
+                    message["data"] = data
+                elif "image" in message:
+                    data = self._message_data(message)
+                    message = {k: v for k, v in message.items() if k != "image"}
+                    message["data"] = data
+                yield message
+
+    async def focus(self, amount: Union[str, int] = "fast", timeout: Optional[float] = None) -> Dict:
         """
         Focus the microscope.
 
         Args:
             amount (Union[str, int], optional): Focus amount. Can be "huge", "fast", "medium", "fine", or an integer. Defaults to "fast".
+            timeout (Optional[float], optional): Seconds to wait for the reply. Defaults to the client timeout.
 
         Returns:
             Dict: Response from the microscope.
         """
-        command = json.dumps({"command": "focus", "amount": amount})
-        self.client.publish(
-            self.microscope + "/command", command, qos=2
-        )
-        return await self.receiveq.get()
+        self._invalidate_frames()
+        try:
+            return await self._request({"command": "focus", "amount": amount}, timeout)
+        finally:
+            self._invalidate_frames()
 
-    async def get_pos(self) -> Dict[str, int]:
+    async def get_pos(self, timeout: Optional[float] = None) -> Dict[str, int]:
         """
         Get the current position of the microscope.
 
+        Args:
+            timeout (Optional[float], optional): Seconds to wait for the reply. Defaults to the client timeout.
+
         Returns:
             Dict[str, int]: Dictionary with x, y, and z coordinates.
         """
-        command = json.dumps({"command": "get_pos"})
-        self.client.publish(
-            self.microscope + "/command", command, qos=2
-        )
-        pos = await self.receiveq.get()
+        pos = await self._request({"command": "get_pos"}, timeout)
         return pos["pos"]
 
-    async def take_image(self) -> Image.Image:
+    async def take_image(self, timeout: Optional[float] = None, resolution: str = "full") -> Image.Image:
         """
         Take an image with the microscope.
 
+        With a frame cache, a frame captured moments ago is returned as long as
+        the stage has not moved or refocused since. Otherwise the etags of cached
+        frames are sent along, and the device can answer "not modified" instead
+        of sending the same image again.
+
+        Args:
+            timeout (Optional[float], optional): Seconds to wait for the reply. Defaults to the client timeout.
+            resolution (str, optional): "preview" for a small image that arrives quickly, or "full". Defaults to "full".
+
         Returns:
             Image.Image: Captured image.
         """
-        command = json.dumps({"command": "take_image"})
+        with await self.capture_frame(timeout, resolution) as frame:
+            image = open_image(frame.data)
+            with DECODE_SECONDS.time(stage="jpeg"):
+                image.load()
+        return image
+
+    async def capture(self, timeout: Optional[float] = None, resolution: str = "full") -> bytes:
+        """
+        Take an image and return it still encoded, e.g. to serve the JPEG without re-encoding it.
+
+        Args:
+            timeout (Optional[float], optional): Seconds to wait for the reply. Defaults to the client timeout.
+            resolution (str, optional): "preview" or "full". Defaults to "full".
+
+        Returns:
+            bytes: Encoded image, normally a JPEG.
+        """
+        with await self.capture_frame(timeout, resolution) as frame:
+            return bytes(frame.data)
+
+    async def capture_frame(self, timeout: Optional[float] = None, resolution: str = "full") -> Frame:
+        """
+        Like capture, but return the encoded image as a view of the buffer it was received into.
+
+        Use the result as a context manager, or call its release() method, once done with ``frame.data``.
+
+        Args:
+            timeout (Optional[float], optional): Seconds to wait for the reply. Defaults to the client timeout.
+            resolution (str, optional): "preview" or "full". Defaults to "full".
+
+        Returns:
+            Frame: The encoded image, normally a JPEG, as ``frame.data``.
+        """
+        frame = await self._capture(timeout, resolution)
+        if resolution != "preview":
+            return frame
+        with frame:
+            return Frame(memoryview(self._at_resolution(frame.data, resolution)))
+
+    async def _capture(self, timeout: Optional[float], resolution: str, revalidate: bool = True) -> Frame:
+        """Return a current frame, from the cache where possible."""
+        settings = self._image_settings(resolution)
+        command = {"command": "take_image", **self._image_options(), **settings}
+        cache = self.frame_cache
+        if cache is None:
+            return self._message_frame(await self._request(command, timeout))
+
+        cached = cache.fresh(settings)
+        if cached is not None:
+            CACHE_RESULTS.inc(result="hit")
+            return Frame(memoryview(cached.data))
+        generation = cache.generation
+        etags = cache.etags(settings) if revalidate else []
+        if etags:
+            command["if_none_match"] = etags
+        reply = await self._request(command, timeout)
+        if reply.get("not_modified"):
+            cached = cache.revalidate(reply.get("etag"), generation)
+            if cached is None:
+                # Evicted while the request was in flight; ask for the full frame
+                return await self._capture(timeout, resolution, revalidate=False)
+            CACHE_RESULTS.inc(result="not_modified")
+            return Frame(memoryview(cached.data))
+        CACHE_RESULTS.inc(result="miss")
+        frame = self._message_frame(reply)
+        if reply.get("etag"):
+            cache.put(reply["etag"], frame.data, reply.get("pos"), settings, generation)
+        return frame
+
+    def _image_options(self) -> Dict:
+        return {"binary": True} if self.binary else {}
+
+    def _image_settings(self, resolution: str = "full") -> Dict:
+        """Command options that change the captured image, and so take part in the frame cache key."""
+        if resolution not in RESOLUTIONS:
+            raise ValueError(f"Unknown resolution {resolution!r}; expected one of {RESOLUTIONS}")
+        # Full resolution is the default, so it is not sent and older firmware keeps working
+        return {"resolution": resolution} if resolution != "full" else {}
+
+    @staticmethod
+    def _at_resolution(data, resolution: str):
+        """Downscale on this side when the device sent a larger frame than a preview asked for."""
+        if resolution != "preview":
+            return data
+        with DECODE_SECONDS.time(stage="preview"):
+            return preview_jpeg(data)
+
+    def _invalidate_frames(self):
+        if self.frame_cache is not None:
+            self.frame_cache.invalidate()
+
+    @staticmethod
+    def _message_data(message: Dict):
+        """Return the encoded image bytes of a reply in either transport format."""
+        if "data" in message:
+            return message["data"]
+        with DECODE_SECONDS.time(stage="base64"):
+            return decode_base64_image(message["image"])
+
+    def _message_frame(self, message: Dict) -> Frame:
+        """Return the image of a reply as a Frame, holding its ring slot if it has one."""
+        frame = message.get("frame")
+        return frame if frame is not None else Frame(memoryview(self._message_data(message)))
+
+    def _raster_positions(
+        self, c1: Union[str, List[int]], c2: Union[str, List[int]], ov: int, data: bytes, count: int
+    ) -> Optional[List[Dict[str, int]]]:
+        """
+        Stage positions of a legacy scan, assuming the device rastered c1 to c2 row by row.
+
+        Fields are taken to be one image width minus the overlap apart, with a
+        stage step the size of a pixel. Only the grid matters to the stitcher,
+        which fits the real step size from the overlaps. Returns None if the
+        grid does not account for every image.
+        """
+        c1 = json.loads(c1) if isinstance(c1, str) else c1
+        c2 = json.loads(c2) if isinstance(c2, str) else c2
+        with open_image(data) as image:
+            step = max(image.width - ov, 1)
+        (x1, y1), (x2, y2) = c1[:2], c2[:2]
+        z = c1[2] if len(c1) > 2 else 0
+        xs = range(min(x1, x2), max(x1, x2) + 1, step)
+        ys = range(min(y1, y2), max(y1, y2) + 1, step)
+        positions = [{"x": x, "y": y, "z": z} for y in ys for x in xs]
+        if len(positions) != count:
+            logger.warning(f"Scan sent {count} images without positions, but the raster has {len(positions)} fields")
+            return None
+        logger.warning(f"Scan sent no positions; placing {count} images in raster order")
+        return positions
+
+    def _message_tile(self, message: Dict, default_index: int) -> Tile:
+        return Tile(
+            message.get("index", default_index), message.get("pos"), self._message_data(message), message.get("frame")
+        )
+
+    @staticmethod
+    def _release(message: Dict):
+        frame = message.get("frame")
+        if frame is not None:
+            frame.release()
+
+    async def _stream(self, command: Dict, window: int, timeout: Optional[float] = None) -> AsyncIterator[Dict]:
+        """
+        Publish a streaming command and yield its replies until the closing ``done`` message.
+
+        The device sends ``{"done": true, "count": n}`` once it has sent all n
+        replies, which may overtake the last of them. Flow control is by
+        credit: the device starts with ``window`` and gets one back, as a
+        ``{"command": "credit"}`` message, for every reply read here. The
+        dispatcher never waits on a stream, so a device that overruns its
+        credit fails the stream rather than stalling every other request. A
+        stream left early is cancelled on the device. The stage moves during
+        streams, so cached frames are invalidated before and after.
+        """
+        queue = _Stream(window)
+        self._invalidate_frames()
+        request_id = self._send(command, queue)
+        timeout = self.timeout if timeout is None else timeout
+        received, expected = 0, None
+        try:
+            while expected is None or received < expected:
+                message = await asyncio.wait_for(queue.get(), timeout)
+                if isinstance(message.get("exception"), BaseException):
+                    raise message["exception"]
+                if message.get("done"):
+                    expected = message.get("count", received)
+                    continue
+                queue.held -= 1
+                self._control("credit", request_id, credit=1)
+                expected = message.get("count", expected)
+                received += 1
+                yield message
+        except asyncio.TimeoutError:
+            TIMEOUTS.inc(command=command["command"])
+            logger.error(f"{command['command']} request {request_id} timed out after {received} replies")
+            raise
+        finally:
+            if expected is None or received < expected:
+                self._control("cancel", request_id)
+            self._forget(request_id)
+            self._invalidate_frames()
+
+    def _control(self, command: str, request_id: str, **fields):
+        """Publish a flow-control message (credit or cancel) for a running stream."""
         self.client.publish(
-            self.microscope + "/command", command, qos=2
+            self.microscope + "/command", json.dumps({"command": command, "request_id": request_id, **fields}), qos=1
         )
-        image = await self.receiveq.get()
-        image_bytes = base64.b64decode(image["image"])
-        return Image.open(BytesIO(image_bytes))
+
+    async def _request(self, command: Dict, timeout: Optional[float] = None) -> Dict:
+        """
+        Publish a command stamped with a fresh request ID and wait for its reply.
+
+        Args:
+            command (Dict): Command payload, without a request ID.
+            timeout (Optional[float], optional): Seconds to wait for the reply. Defaults to the client timeout.
+
+        Returns:
+            Dict: Reply from the microscope carrying the same request ID.
+
+        Raises:
+            asyncio.TimeoutError: If no reply arrives in time.
+        """
+        future = asyncio.get_running_loop().create_future()
+        request_id = self._send(command, future)
+        try:
+            return await asyncio.wait_for(future, self.timeout if timeout is None else timeout)
+        except asyncio.TimeoutError:
+            TIMEOUTS.inc(command=command["command"])
+            logger.error(f"{command['command']} request {request_id} timed out")
+            raise
+        finally:
+            self._forget(request_id)
+
+    def _send(self, command: Dict, waiter: Union[asyncio.Future, _Stream]) -> str:
+        """Register a waiter under a fresh request ID and publish the command. Returns the request ID."""
+        self._bridge.start()
+        request_id = uuid.uuid4().hex
+        self._pending[request_id] = waiter
+        self._started[request_id] = (command["command"], time.perf_counter())
+        REQUESTS_IN_FLIGHT.inc()
+        self.client.publish(
+            self.microscope + "/command", json.dumps({**command, "request_id": request_id}), qos=2
+        )
+        return request_id
+
+    def _forget(self, request_id: str):
+        waiter = self._pending.pop(request_id, None)
+        started = self._started.pop(request_id, None)
+        if started is not None:
+            command, start = started
+            seconds = time.perf_counter() - start
+            REQUESTS_IN_FLIGHT.dec()
+            REQUEST_SECONDS.observe(seconds, command=command)
+            metrics.profile(command, seconds, microscope=self.microscope, request_id=request_id)
+        if isinstance(waiter, _Stream):
+            # Hand back the ring slots of replies an abandoned stream will never read
+            while not waiter.empty():
+                self._release(waiter.get_nowait())
+        for key in [key for key in self._chunks if key[0] == request_id]:
+            del self._chunks[key]
+
+    async def _route_reply(self, reply: Dict):
+        """Hand a received reply to the request waiting for it. Runs on the event loop."""
+        request_id = reply.get("request_id")
+        if request_id is None and self._pending:
+            # Firmware without request IDs answers in order, so the oldest waiter owns the reply
+            request_id = next(iter(self._pending))
+        waiter = self._pending.get(request_id)
+        if waiter is None or (isinstance(waiter, asyncio.Future) and waiter.done()):
+            logger.warning(f"Dropping reply for unknown or expired request {request_id}")
+            self._release(reply)
+            return
+        if isinstance(waiter, _Stream) and waiter.failed:
+            self._release(reply)
+            return
+        if "chunks" in reply:
+            try:
+                reply = self._join_chunk(request_id, reply)
+            except ValueError as e:
+                self._release(reply)
+                self._fail(request_id, waiter, e)
+                return
+            if reply is None:
+                return
+        if isinstance(waiter, _Stream):
+            # Never wait here: the dispatcher is shared, so a full stream would stall every other request
+            if not reply.get("done"):
+                if waiter.held >= waiter.window:
+                    self._release(reply)
+                    self._fail(request_id, waiter, RuntimeError(f"Device overran its window of {waiter.window}"))
+                    return
+                waiter.held += 1
+            waiter.put_nowait(reply)
+        else:
+            waiter.set_result(reply)
+
+    def _fail(self, request_id: str, waiter: Union[asyncio.Future, _Stream], error: Exception):
+        """Fail a request from the dispatcher; a stream raises the error when its reader reaches it."""
+        logger.error(f"Request {request_id} failed: {error}")
+        if isinstance(waiter, _Stream):
+            waiter.failed = True
+            waiter.put_nowait({"request_id": request_id, "exception": error})
+        elif not waiter.done():
+            waiter.set_exception(error)
+        for key in [key for key in self._chunks if key[0] == request_id]:
+            del self._chunks[key]
+
+    def _join_chunk(self, request_id: str, chunk: Dict) -> Optional[Dict]:
+        """
+        Collect one chunk of a split tile. Returns the whole tile once every chunk is in.
+
+        Chunks may arrive in any order. A chunk whose ``chunk``/``chunks`` fields
+        are out of range, or disagree with its siblings, raises ValueError.
+        """
+        count, part = chunk.get("chunks"), chunk.get("chunk")
+        if type(count) is not int or not 0 < count <= MAX_CHUNKS:
+            raise ValueError(f"Invalid chunk count {count!r}")
+        if type(part) is not int or not 0 <= part < count:
+            raise ValueError(f"Invalid chunk {part!r} of {count}")
+        key = (request_id, chunk.get("index"))
+        parts = self._chunks.setdefault(key, [None] * count)
+        if len(parts) != count:
+            raise ValueError(f"Chunk count changed from {len(parts)} to {count}")
+        if parts[part] is not None:
+            raise ValueError(f"Chunk {part} of {count} arrived twice")
+        data = self._message_data(chunk)
+        # The chunk's ring slot is handed straight back, so keep a copy of its bytes
+        parts[part] = bytes(data) if "frame" in chunk else data
+        self._release(chunk)
+        if any(part is None for part in parts):
+            return None
+        del self._chunks[key]
+        tile = {k: v for k, v in chunk.items() if k not in ("chunk", "chunks", "image", "frame")}
+        tile["data"] = b"".join(parts)
+        return tile
+
+    def is_connected(self) -> bool:
+        """Return True while the underlying MQTT connection is up."""
+        return self.client.is_connected()
 
     def end_connection(self):
         """End the connection to the microscope."""
-        self.client.disconnect()
+        self._bridge.close()
+        if self._owns_client:
+            self.client.disconnect()
+        else:
+            self.client.remove_handler(self.microscope + "/return")
+            self.client.remove_handler(self.microscope + "/return/image")
 
     async def __aenter__(self):
+        self._bridge.start()
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
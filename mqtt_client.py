@@ -1,21 +1,81 @@
 import paho.mqtt.client as mqtt
+import asyncio
 import ssl
 import logging
+import threading
+import time
 import os
 from dotenv import load_dotenv
+import metrics
 
 load_dotenv()
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+MESSAGES_OUT = metrics.counter("mqtt_messages_published_total", "Messages published")
+BYTES_OUT = metrics.counter("mqtt_bytes_out_total", "Payload bytes published")
+MESSAGES_IN = metrics.counter("mqtt_messages_received_total", "Messages received")
+BYTES_IN = metrics.counter("mqtt_bytes_in_total", "Payload bytes received")
+RECONNECTS = metrics.counter("mqtt_reconnects_total", "Reconnection attempts after an unexpected disconnect")
+
+# Payload logging is DEBUG-only, truncated, and limited to a burst per interval: images are megabytes of base64
+LOG_PAYLOAD_BYTES = int(os.getenv("MQTT_LOG_PAYLOAD_BYTES", 200))
+LOG_RATE = int(os.getenv("MQTT_LOG_RATE", 10))  # payloads logged per LOG_INTERVAL seconds
+LOG_INTERVAL = 1.0
+
+class PayloadLogger:
+    """
+    Logs message payloads at DEBUG level as ``key=value`` records.
+
+    Nothing is decoded unless DEBUG is enabled; at most ``limit`` bytes of each
+    payload are shown, and at most ``rate`` records are written per
+    ``interval`` seconds, with a count of the records skipped.
+    """
+
+    def __init__(self, log, limit=LOG_PAYLOAD_BYTES, rate=LOG_RATE, interval=LOG_INTERVAL):
+        self.log = log
+        self.limit = limit
+        self.rate = rate
+        self.interval = interval
+        self._window_start = 0.0
+        self._logged = 0
+        self._suppressed = 0
+        self._lock = threading.Lock()
+
+    def _allow(self):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._window_start >= self.interval:
+                if self._suppressed:
+                    self.log.debug(f"event=payload_log_suppressed count={self._suppressed} interval={self.interval}")
+                self._window_start, self._logged, self._suppressed = now, 0, 0
+            if self._logged >= self.rate:
+                self._suppressed += 1
+                return False
+            self._logged += 1
+            return True
+
+    def __call__(self, event, topic, payload):
+        if not self.log.isEnabledFor(logging.DEBUG) or not self._allow():
+            return
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        preview = bytes(payload[:self.limit]).decode("utf-8", errors="replace")
+        truncated = " truncated=true" if len(payload) > self.limit else ""
+        self.log.debug(f"event={event} topic={topic} bytes={len(payload)}{truncated} payload={preview!r}")
+
 class MQTTClient:
-    def __init__(self):
-        self.broker = os.getenv("HIVEMQ_BROKER")
-        self.port = int(os.getenv("HIVEMQ_PORT", 8884))  # WebSocket port
-        self.username = os.getenv("HIVEMQ_USERNAME")
-        self.password = os.getenv("HIVEMQ_PASSWORD")
-        self.client_id = f"openflexure-microscope-{os.urandom(4).hex()}"
+    def __init__(self, broker=None, port=None, client_id=None, username=None, password=None):
+        self.broker = broker or os.getenv("HIVEMQ_BROKER")
+        self.port = int(port or os.getenv("HIVEMQ_PORT", 8884))  # WebSocket port
+        self.username = username or os.getenv("HIVEMQ_USERNAME")
+        self.password = password or os.getenv("HIVEMQ_PASSWORD")
+        self.client_id = client_id or f"openflexure-microscope-{os.urandom(4).hex()}"
+        # Topic -> qos, replayed after every (re)connect so subscriptions survive broker drops
+        self.subscriptions = {}
+        self.connected = threading.Event()
+        self.log_payload = PayloadLogger(logger)
 
         # 创建 MQTT 客户端
         self.client = mqtt.Client(client_id=self.client_id, transport="websockets")
@@ -35,49 +95,111 @@ class MQTTClient:
         except Exception as e:
             logger.error(f"Connection error: {e}")
 
+    def connect_async(self):
+        """Start connecting on paho's network thread and return immediately."""
+        try:
+            self.client.connect_async(self.broker, self.port, keepalive=60)
+            self.client.loop_start()
+            logger.info("Connecting to MQTT broker in the background...")
+        except Exception as e:
+            logger.error(f"Connection error: {e}")
+
     def on_connect(self, client, userdata, flags, rc):
         if rc == 0:
             logger.info("Connected successfully to MQTT broker")
+            self.connected.set()
             client.subscribe("test/topic", qos=1)
+            for topic, qos in self.subscriptions.items():
+                client.subscribe(topic, qos=qos)
         else:
             logger.error(f"Failed to connect, return code {rc}")
 
     def on_disconnect(self, client, userdata, rc):
+        self.connected.clear()
         logger.warning(f"Disconnected with return code {rc}")
         if rc != 0:
             self.reconnect()
 
     def on_message(self, client, userdata, msg):
-        logger.info(f"Received message on topic {msg.topic}: {msg.payload.decode()}")
+        MESSAGES_IN.inc()
+        BYTES_IN.inc(len(msg.payload))
+        self.log_payload("received", msg.topic, msg.payload)
 
     def reconnect(self):
+        RECONNECTS.inc()
         try:
             self.client.reconnect()
             logger.info("Reconnected successfully")
         except Exception as e:
             logger.error(f"Reconnection failed: {e}")
 
+    def run_forever(self):
+        """
+        Connect and handle network traffic on the calling thread until disconnect() or Ctrl+C.
+
+        Blocks in paho's select loop rather than polling, so an idle client uses no CPU.
+        """
+        try:
+            self.client.connect_async(self.broker, self.port, keepalive=60)
+            self.client.loop_forever(retry_first_connection=True)
+        except KeyboardInterrupt:
+            logger.info("Interrupted, disconnecting")
+        finally:
+            self.disconnect()
+
     def disconnect(self):
         self.client.loop_stop()
         self.client.disconnect()
         logger.info("Disconnected from MQTT broker")
 
-    def publish(self, topic, message):
-        self.client.publish(topic, message, qos=1)
-        logger.info(f"Published message to topic {topic}")
+    def is_connected(self):
+        return self.connected.is_set()
+
+    def wait_for_connection(self, timeout=None):
+        """Block until the broker has acknowledged the connection. Returns False on timeout."""
+        return self.connected.wait(timeout)
+
+    def subscribe(self, topic, qos=1):
+        self.subscriptions[topic] = qos
+        self.client.subscribe(topic, qos=qos)
+        logger.info(f"Subscribed to topic {topic}")
+
+    def add_handler(self, topic, callback):
+        """Route messages matching ``topic`` (wildcards allowed) to ``callback`` instead of on_message."""
+        def counted(client, userdata, message):
+            MESSAGES_IN.inc()
+            BYTES_IN.inc(len(message.payload))
+            callback(client, userdata, message)
+
+        self.client.message_callback_add(topic, counted)
+
+    def remove_handler(self, topic):
+        self.client.message_callback_remove(topic)
+
+    def publish(self, topic, message, qos=1):
+        info = self.client.publish(topic, message, qos=qos)
+        MESSAGES_OUT.inc()
+        BYTES_OUT.inc(len(message.encode("utf-8") if isinstance(message, str) else message))
+        self.log_payload("published", topic, message)
+        return info
+
+    async def publish_async(self, topic, message, qos=1, timeout=10):
+        """Publish and wait, without blocking the event loop, until the broker acknowledges the message."""
+        info = self.publish(topic, message, qos=qos)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            raise ConnectionError(f"Publish to {topic} failed: {mqtt.error_string(info.rc)}")
+        # paho only offers a blocking wait for PUBACK/PUBCOMP, so it runs on a worker thread
+        await asyncio.to_thread(info.wait_for_publish, timeout)
+        if not info.is_published():
+            raise asyncio.TimeoutError(f"No acknowledgement for message {info.mid} on {topic}")
+        return info.mid
 
 # 使用示例
 if __name__ == "__main__":
     client = MQTTClient()
-    client.connect()
 
     # 这里可以添加其他操作，比如发布消息
     # client.publish("test/topic", "Hello, HiveMQ!")
 
-    # 保持程序运行
-    try:
-        while True:
-            pass
-    except KeyboardInterrupt:
-        print("Exiting...")
-        client.disconnect()
+    # 保持程序运行，直到 Ctrl+C
+    client.run_forever()
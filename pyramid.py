@@ -0,0 +1,468 @@
+import asyncio
+import logging
+import math
+import os
+import threading
+import xml.etree.ElementTree as ElementTree
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image
+
+import metrics
+from image_transport import Tile, open_image
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+TILE_REQUESTS = metrics.counter(
+    "pyramid_tile_requests_total", "Pyramid tiles asked of the tile server by outcome (hit, miss, blank)", ["result"]
+)
+
+DZI_NAMESPACE = "http://schemas.microsoft.com/deepzoom/2008"
+
+class PyramidInfo(NamedTuple):
+    width: int
+    height: int
+    tile_size: int
+    levels: int
+    version: int  # changes whenever the pyramid is rewritten
+
+    @property
+    def top(self) -> int:
+        return self.levels - 1
+
+    def level_size(self, level: int) -> Tuple[int, int]:
+        scale = 2 ** (self.top - level)
+        return math.ceil(self.width / scale), math.ceil(self.height / scale)
+
+def level_count(width: int, height: int) -> int:
+    """Levels of a DeepZoom pyramid: level 0 is one pixel, each next level doubles, the last is full size."""
+    return math.ceil(math.log2(max(width, height, 1))) + 1
+
+class PyramidBuilder:
+    """
+    Write a DeepZoom pyramid (``<name>.dzi`` plus ``<name>_files/<level>/<col>_<row>.jpeg``) as images arrive.
+
+    Images are pasted onto full-resolution tiles, later images covering
+    earlier ones as in stitching.compose. Images announced with reserve()
+    hold the tiles they touch until they are added; any other tile is
+    written as soon as it is completely covered. A finished tile is halved
+    into its parent on the level above, which is written as soon as all its
+    children are done, and so on up to the single-pixel top. An image that
+    lands on a tile already written has the tile read back, pasted onto and
+    rewritten, with its parents patched to match. Only tiles still being
+    filled and halves waiting for their siblings are held in memory, so for
+    a scan delivered row by row that is about one row of tiles per level.
+    finish() writes whatever is left. Tiles that nothing was pasted onto
+    are never written; readers treat a missing tile as background.
+    Tiles do not overlap (Overlap="0").
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        name: str,
+        width: int,
+        height: int,
+        tile_size: int = 256,
+        quality: int = 85,
+        background: Tuple[int, int, int] = (0, 0, 0),
+    ):
+        """
+        Initialize the builder and write the .dzi descriptor, so the pyramid can be viewed while it grows.
+
+        Args:
+            directory (str): Directory for the pyramid; created if missing.
+            name (str): Pyramid name, used for the .dzi file and the tile directory.
+            width (int): Full-resolution width in pixels.
+            height (int): Full-resolution height in pixels.
+            tile_size (int, optional): Tile edge in pixels; must be even. Defaults to 256.
+            quality (int, optional): JPEG quality of the tiles. Defaults to 85.
+            background (Tuple[int, int, int], optional): Colour of uncovered pixels. Defaults to black.
+        """
+        if tile_size % 2:
+            raise ValueError("tile_size must be even")
+        self.directory = directory
+        self.name = name
+        self.info = PyramidInfo(width, height, tile_size, level_count(width, height), 0)
+        self.quality = quality
+        self.background = background
+        self.tiles_written = 0
+        self._pending: Dict[Tuple[int, int], Tuple[Image.Image, np.ndarray]] = {}
+        self._done = set()
+        # Reserved images not yet added, counted per full-resolution tile they touch
+        self._reserved: Dict[Tuple[int, int], int] = {}
+        # Halved children waiting for their siblings, keyed by parent; None marks a blank child
+        self._children: Dict[Tuple[int, int, int], Dict[Tuple[int, int], Optional[Image.Image]]] = {}
+        os.makedirs(os.path.join(directory, f"{name}_files"), exist_ok=True)
+        self._write_descriptor()
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.directory, f"{self.name}.dzi")
+
+    def grid(self, level: int) -> Tuple[int, int]:
+        """Columns and rows of tiles on a level."""
+        width, height = self.info.level_size(level)
+        size = self.info.tile_size
+        return math.ceil(width / size), math.ceil(height / size)
+
+    def _tile_box(self, level: int, col: int, row: int) -> Tuple[int, int, int, int]:
+        width, height = self.info.level_size(level)
+        size = self.info.tile_size
+        return col * size, row * size, min((col + 1) * size, width), min((row + 1) * size, height)
+
+    def _touched(self, x: int, y: int, width: int, height: int):
+        """Full-resolution tiles under an image, as (col, row), with the image's box clipped to the pyramid."""
+        size = self.info.tile_size
+        left, upper = max(x, 0), max(y, 0)
+        right, lower = min(x + width, self.info.width), min(y + height, self.info.height)
+        if left >= right or upper >= lower:
+            return [], None
+        tiles = [
+            (col, row)
+            for row in range(upper // size, (lower - 1) // size + 1)
+            for col in range(left // size, (right - 1) // size + 1)
+        ]
+        return tiles, (left, upper, right, lower)
+
+    def reserve(self, x: int, y: int, width: int, height: int):
+        """
+        Announce an image that add() will paste later, so the tiles under it are not written before it arrives.
+
+        Each reserved image must then be added. Reserving every image up front
+        writes each tile once, with the images in the order they are added.
+        """
+        for key in self._touched(x, y, width, height)[0]:
+            self._reserved[key] = self._reserved.get(key, 0) + 1
+
+    def add(self, image: Image.Image, x: int, y: int):
+        """Paste a full-resolution RGB image with its top-left corner at (x, y); later images cover earlier ones."""
+        top = self.info.top
+        tiles, clipped = self._touched(x, y, image.width, image.height)
+        for col, row in tiles:
+            box = self._tile_box(top, col, row)
+            pending = self._pending.get((col, row))
+            if pending is None:
+                pending = self._pending[(col, row)] = self._open(col, row, box)
+            canvas, covered = pending
+            # Part of the image inside this tile, in the image's and in the tile's coordinates
+            left, upper, right, lower = clipped
+            x0, y0 = max(left, box[0]), max(upper, box[1])
+            x1, y1 = min(right, box[2]), min(lower, box[3])
+            canvas.paste(image.crop((x0 - x, y0 - y, x1 - x, y1 - y)), (x0 - box[0], y0 - box[1]))
+            covered[y0 - box[1]:y1 - box[1], x0 - box[0]:x1 - box[0]] = True
+            waiting = self._reserved.get((col, row))
+            if waiting is not None:
+                # The last reserved image on a tile finishes it, covered or not
+                if waiting > 1:
+                    self._reserved[(col, row)] = waiting - 1
+                    continue
+                del self._reserved[(col, row)]
+            elif not covered.all():
+                continue
+            del self._pending[(col, row)]
+            self._complete(top, col, row, canvas)
+
+    def _open(self, col: int, row: int, box: Tuple[int, int, int, int]) -> Tuple[Image.Image, np.ndarray]:
+        """A canvas for a full-resolution tile and its coverage; a tile already written is read back to be pasted onto."""
+        top = self.info.top
+        size = (box[2] - box[0], box[3] - box[1])
+        if (top, col, row) in self._done:
+            self._done.discard((top, col, row))
+            return self._read_tile(top, col, row, size), np.ones((size[1], size[0]), dtype=bool)
+        return Image.new("RGB", size, self.background), np.zeros((size[1], size[0]), dtype=bool)
+
+    def finish(self) -> str:
+        """Write every remaining tile, and return the path of the .dzi descriptor."""
+        top = self.info.top
+        cols, rows = self.grid(top)
+        for row in range(rows):
+            for col in range(cols):
+                if (top, col, row) not in self._done:
+                    pending = self._pending.pop((col, row), None)
+                    self._complete(top, col, row, pending[0] if pending else None)
+        self._done.clear()
+        logger.info(f"Built pyramid {self.path}: {self.info.levels} levels, {self.tiles_written} tiles")
+        return self.path
+
+    def _complete(self, level: int, col: int, row: int, image: Optional[Image.Image]):
+        self._done.add((level, col, row))
+        if image is not None:
+            self._write_tile(level, col, row, image)
+        if level == 0:
+            return
+        parent = (level - 1, col // 2, row // 2)
+        half = None if image is None else image.resize(((image.width + 1) // 2, (image.height + 1) // 2), Image.BILINEAR)
+        half_size = self.info.tile_size // 2
+        if parent in self._done:
+            # A tile rewritten after its parent was built: patch its quarter of the parent and so on upwards
+            box = self._tile_box(*parent)
+            canvas = self._read_tile(*parent, (box[2] - box[0], box[3] - box[1]))
+            if half is not None:
+                canvas.paste(half, ((col % 2) * half_size, (row % 2) * half_size))
+            self._complete(*parent, canvas)
+            return
+        children = self._children.setdefault(parent, {})
+        children[(col % 2, row % 2)] = half
+        cols, rows = self.grid(level)
+        expected = sum(1 for dx in (0, 1) for dy in (0, 1) if 2 * parent[1] + dx < cols and 2 * parent[2] + dy < rows)
+        if len(children) < expected:
+            return
+        del self._children[parent]
+        if all(half is None for half in children.values()):
+            self._complete(*parent, None)
+            return
+        box = self._tile_box(*parent)
+        canvas = Image.new("RGB", (box[2] - box[0], box[3] - box[1]), self.background)
+        for (dx, dy), half in children.items():
+            if half is not None:
+                canvas.paste(half, (dx * half_size, dy * half_size))
+        self._complete(*parent, canvas)
+
+    def _tile_path(self, level: int, col: int, row: int) -> str:
+        return os.path.join(self.directory, f"{self.name}_files", str(level), f"{col}_{row}.jpeg")
+
+    def _read_tile(self, level: int, col: int, row: int, size: Tuple[int, int]) -> Image.Image:
+        try:
+            with Image.open(self._tile_path(level, col, row)) as encoded:
+                return encoded.convert("RGB")
+        except FileNotFoundError:
+            # Never written, as nothing was pasted onto it
+            return Image.new("RGB", size, self.background)
+
+    def _write_tile(self, level: int, col: int, row: int, image: Image.Image):
+        path = self._tile_path(level, col, row)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Viewers reading a growing pyramid never see a half-written tile
+        image.save(path + ".part", format="JPEG", quality=self.quality)
+        os.replace(path + ".part", path)
+        self.tiles_written += 1
+
+    def _write_descriptor(self):
+        root = ElementTree.Element(
+            "Image", xmlns=DZI_NAMESPACE, Format="jpeg", Overlap="0", TileSize=str(self.info.tile_size)
+        )
+        ElementTree.SubElement(root, "Size", Width=str(self.info.width), Height=str(self.info.height))
+        ElementTree.ElementTree(root).write(self.path + ".part", encoding="UTF-8", xml_declaration=True)
+        os.replace(self.path + ".part", self.path)
+
+def build_pyramid(
+    tiles: Sequence[Tile], positions: np.ndarray, directory: str, name: str, **kwargs
+) -> str:
+    """
+    Write stitched tiles as a pyramid instead of one large image.
+
+    Args:
+        tiles (Sequence[Tile]): Scan tiles.
+        positions (np.ndarray): (n, 2) pixel positions as (y, x), as from stitching.stitch_positions.
+        directory (str): Pyramid directory.
+        name (str): Pyramid name.
+        **kwargs: Passed on to PyramidBuilder.
+
+    Returns:
+        str: Path of the .dzi descriptor.
+    """
+    origins = np.rint(positions).astype(int)
+    width, height = tiles[0].image.size
+    builder = PyramidBuilder(
+        directory, name, int(origins[:, 1].max()) + width, int(origins[:, 0].max()) + height, **kwargs
+    )
+    # Pasted in the same order as stitching.compose, so the same tile wins where they overlap. Reserving
+    # every tile first keeps each pyramid tile until the last image on it is pasted, after which it leaves memory.
+    for y, x in origins:
+        builder.reserve(int(x), int(y), width, height)
+    for tile, (y, x) in zip(tiles, origins):
+        with tile.image as image:
+            builder.add(image.convert("RGB"), int(x), int(y))
+    return builder.finish()
+
+class PyramidSink:
+    """
+    Build a pyramid while a scan is still arriving, placing tiles by stage position.
+
+    Has the same put/close interface as TileSink. There is no registration,
+    so the result is only as good as the stage calibration; it is meant for
+    watching a scan come in, with stitching.stitch_to_pyramid for the final
+    result. The pyramid's size is fixed from ``extent`` and the first tile.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        name: str,
+        extent: Tuple[int, int, int, int],
+        pixels_per_step: float = 1.0,
+        **kwargs,
+    ):
+        """
+        Initialize the sink.
+
+        Args:
+            directory (str): Pyramid directory.
+            name (str): Pyramid name.
+            extent (Tuple[int, int, int, int]): Stage area (x1, y1, x2, y2) of the tile positions, e.g. the scan corners.
+            pixels_per_step (float, optional): Image pixels per stage step. Defaults to 1.
+            **kwargs: Passed on to PyramidBuilder.
+        """
+        self.directory = directory
+        self.name = name
+        x1, y1, x2, y2 = extent
+        self.extent = (min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))
+        self.pixels_per_step = pixels_per_step
+        self.builder: Optional[PyramidBuilder] = None
+        self._kwargs = kwargs
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pyramid")
+
+    async def put(self, tile: Tile):
+        """Add a tile, waiting until it is pasted; the tile's data can be released afterwards."""
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._add, tile)
+
+    def _add(self, tile: Tile):
+        x1, y1, x2, y2 = self.extent
+        scale = self.pixels_per_step
+        with open_image(tile.data) as image:
+            if self.builder is None:
+                width = round((x2 - x1) * scale) + image.width
+                height = round((y2 - y1) * scale) + image.height
+                self.builder = PyramidBuilder(self.directory, self.name, width, height, **self._kwargs)
+            pos = tile.pos or {"x": x1, "y": y1}
+            self.builder.add(image.convert("RGB"), round((pos["x"] - x1) * scale), round((pos["y"] - y1) * scale))
+
+    async def close(self) -> Optional[str]:
+        """Write the remaining tiles and return the .dzi path, or None if no tile arrived."""
+        try:
+            if self.builder is None:
+                return None
+            return await asyncio.get_running_loop().run_in_executor(self._executor, self.builder.finish)
+        finally:
+            self._executor.shutdown(wait=False)
+
+    async def abort(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            await self.close()
+        else:
+            await self.abort()
+
+class TileServer:
+    """
+    Serve views of the pyramids in a directory, reading only the tiles a view needs.
+
+    Decoded tiles are kept in an LRU cache bounded by their size in memory,
+    so panning around a region decodes each tile once. Pyramids that are
+    still being built can be viewed: missing tiles are drawn as background
+    and not cached, and a rewritten pyramid is noticed from its .dzi file.
+    """
+
+    def __init__(self, root: str, max_bytes: int = 64 * 1024 * 1024, background: Tuple[int, int, int] = (0, 0, 0)):
+        """
+        Initialize the server.
+
+        Args:
+            root (str): Directory holding ``<name>.dzi`` files and their tiles.
+            max_bytes (int, optional): Decoded tile bytes kept in the cache. Defaults to 64 MiB.
+            background (Tuple[int, int, int], optional): Colour drawn where there is no tile. Defaults to black.
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.background = background
+        self.size = 0
+        self._tiles: "OrderedDict[Tuple, Image.Image]" = OrderedDict()
+        self._info: Dict[str, PyramidInfo] = {}
+        self._lock = threading.Lock()
+
+    def pyramids(self) -> List[str]:
+        """Names of the pyramids under the root directory, newest first."""
+        if not os.path.isdir(self.root):
+            return []
+        paths = [entry for entry in os.scandir(self.root) if entry.name.endswith(".dzi")]
+        paths.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+        return [entry.name[:-len(".dzi")] for entry in paths]
+
+    def info(self, name: str) -> PyramidInfo:
+        """Size and layout of a pyramid, read from its .dzi descriptor."""
+        path = os.path.join(self.root, f"{name}.dzi")
+        version = os.stat(path).st_mtime_ns
+        info = self._info.get(name)
+        if info is None or info.version != version:
+            image = ElementTree.parse(path).getroot()
+            size = image.find(f"{{{DZI_NAMESPACE}}}Size")
+            if size is None:
+                size = image.find("Size")
+            width, height = int(size.get("Width")), int(size.get("Height"))
+            info = self._info[name] = PyramidInfo(
+                width, height, int(image.get("TileSize")), level_count(width, height), version
+            )
+        return info
+
+    def tile(self, name: str, level: int, col: int, row: int) -> Optional[Image.Image]:
+        """A decoded tile, or None where the pyramid has no tile (background)."""
+        key = (name, self.info(name).version, level, col, row)
+        with self._lock:
+            image = self._tiles.get(key)
+            if image is not None:
+                self._tiles.move_to_end(key)
+                TILE_REQUESTS.inc(result="hit")
+                return image
+        path = os.path.join(self.root, f"{name}_files", str(level), f"{col}_{row}.jpeg")
+        try:
+            with Image.open(path) as encoded:
+                image = encoded.convert("RGB")
+        except FileNotFoundError:
+            TILE_REQUESTS.inc(result="blank")
+            return None
+        TILE_REQUESTS.inc(result="miss")
+        nbytes = image.width * image.height * 3
+        with self._lock:
+            if key not in self._tiles:
+                self._tiles[key] = image
+                self.size += nbytes
+            while self.size > self.max_bytes and self._tiles:
+                _, evicted = self._tiles.popitem(last=False)
+                self.size -= evicted.width * evicted.height * 3
+        return image
+
+    def view(self, name: str, level: int, cx: float, cy: float, width: int, height: int) -> Image.Image:
+        """
+        Render the part of a pyramid level centred on a point.
+
+        Args:
+            name (str): Pyramid name.
+            level (int): Pyramid level; the highest is full resolution.
+            cx (float): Centre x, in full-resolution pixels.
+            cy (float): Centre y, in full-resolution pixels.
+            width (int): View width in pixels.
+            height (int): View height in pixels.
+
+        Returns:
+            Image.Image: The view, with background outside the image.
+        """
+        info = self.info(name)
+        level = min(max(level, 0), info.top)
+        scale = 2 ** (info.top - level)
+        level_width, level_height = info.level_size(level)
+        size = info.tile_size
+        left, top = round(cx / scale - width / 2), round(cy / scale - height / 2)
+        canvas = Image.new("RGB", (width, height), self.background)
+        first_col, last_col = max(left // size, 0), min((left + width - 1) // size, (level_width - 1) // size)
+        first_row, last_row = max(top // size, 0), min((top + height - 1) // size, (level_height - 1) // size)
+        for row in range(first_row, last_row + 1):
+            for col in range(first_col, last_col + 1):
+                image = self.tile(name, level, col, row)
+                if image is not None:
+                    canvas.paste(image, (col * size - left, row * size - top))
+        return canvas
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+            self.size = 0
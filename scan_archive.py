@@ -0,0 +1,380 @@
+import asyncio
+import io
+import json
+import logging
+import mmap
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+import metrics
+from image_transport import BytesLike, Tile, open_image
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+ARCHIVE_BYTES = metrics.counter("scan_archive_bytes_written_total", "Encoded bytes appended to scan archives")
+ARCHIVE_TILES = metrics.counter(
+    "scan_archive_tiles_total", "Tiles written to scan archives by kind (tile, level)", ["kind"]
+)
+
+DATA_NAME = "tiles.bin"
+INDEX_NAME = "index.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scans (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    microscope TEXT,
+    started_at REAL NOT NULL,
+    finished_at REAL,
+    metadata TEXT
+);
+CREATE TABLE IF NOT EXISTS tiles (
+    id INTEGER PRIMARY KEY,
+    scan_id INTEGER NOT NULL REFERENCES scans(id),
+    tile_index INTEGER NOT NULL,
+    x INTEGER, y INTEGER, z INTEGER,
+    focus REAL,
+    captured_at REAL NOT NULL,
+    width INTEGER, height INTEGER,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    exif BLOB
+);
+CREATE INDEX IF NOT EXISTS tiles_by_scan ON tiles (scan_id, tile_index);
+CREATE INDEX IF NOT EXISTS tiles_by_position ON tiles (x, y);
+CREATE INDEX IF NOT EXISTS tiles_by_time ON tiles (captured_at);
+CREATE TABLE IF NOT EXISTS levels (
+    tile_id INTEGER NOT NULL REFERENCES tiles(id),
+    level INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    PRIMARY KEY (tile_id, level)
+);
+"""
+
+TILE_COLUMNS = "id, scan_id, tile_index, x, y, z, focus, captured_at, width, height, offset, length"
+
+class ArchivedTile(NamedTuple):
+    """Index entry of one stored tile. Its bytes are read with ScanArchive.data."""
+
+    id: int
+    scan_id: int
+    index: int
+    pos: Dict[str, int]
+    focus: Optional[float]  # sharpness score at capture, comparable within a scan
+    captured_at: float
+    width: int
+    height: int
+    offset: int
+    length: int
+
+    @classmethod
+    def from_row(cls, row: Sequence) -> "ArchivedTile":
+        tile_id, scan_id, index, x, y, z, focus, captured_at, width, height, offset, length = row
+        return cls(tile_id, scan_id, index, {"x": x, "y": y, "z": z}, focus, captured_at, width, height, offset, length)
+
+class ScanArchive:
+    """
+    A directory holding every scanned tile, so scans can be revisited without going back to the slide.
+
+    Encoded tiles are appended, unchanged, to a single ``tiles.bin`` that is
+    never rewritten, and read back through a memory map: data() returns a
+    view of the mapped file, so opening one tile of a large scan reads only
+    that tile from disk. ``index.sqlite`` records each tile's scan, stage
+    position, focus score, capture time, size, EXIF and place in
+    ``tiles.bin``, indexed for lookup by scan, region and time. Reduced
+    copies of a tile (level n is 2^n times smaller) are made the first time
+    they are asked for and appended like any other tile.
+
+    Bytes are written before the index row that points at them, so a crash
+    can leave unreferenced bytes but never a tile without its data. One
+    process writes to an archive at a time; any number may read.
+    """
+
+    def __init__(self, directory: str = "scans"):
+        """
+        Open an archive, creating it if missing.
+
+        Args:
+            directory (str, optional): Archive directory. Defaults to "scans".
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._data = open(os.path.join(directory, DATA_NAME), "ab+")
+        self._map: Optional[mmap.mmap] = None
+        self._db = sqlite3.connect(os.path.join(directory, INDEX_NAME), check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+            self._data.close()
+            # Views handed out by data() keep the old map alive until they are released
+            self._map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def begin_scan(self, name: str, microscope: Optional[str] = None, metadata: Optional[Dict] = None) -> int:
+        """Start a new scan and return its ID."""
+        with self._lock, self._db:
+            cursor = self._db.execute(
+                "INSERT INTO scans (name, microscope, started_at, metadata) VALUES (?, ?, ?, ?)",
+                (name, microscope, time.time(), json.dumps(metadata or {})),
+            )
+        return cursor.lastrowid
+
+    def finish_scan(self, scan_id: int):
+        """Mark a scan complete and flush its tiles to disk."""
+        with self._lock:
+            os.fsync(self._data.fileno())
+            with self._db:
+                self._db.execute("UPDATE scans SET finished_at = ? WHERE id = ?", (time.time(), scan_id))
+
+    def add_tile(self, scan_id: int, tile: Tile, focus: Optional[float] = None) -> int:
+        """
+        Append a tile to a scan.
+
+        Args:
+            scan_id (int): Scan from begin_scan.
+            tile (Tile): Tile with its encoded bytes and stage position.
+            focus (Optional[float], optional): Sharpness score to store with it. Defaults to None.
+
+        Returns:
+            int: ID of the stored tile.
+        """
+        # Opening reads only the header: size and EXIF come without decoding the pixels
+        with open_image(tile.data) as image:
+            (width, height), exif = image.size, image.info.get("exif")
+        pos = tile.pos or {}
+        with self._lock:
+            offset, length = self._append(tile.data)
+            with self._db:
+                cursor = self._db.execute(
+                    "INSERT INTO tiles"
+                    " (scan_id, tile_index, x, y, z, focus, captured_at, width, height, offset, length, exif)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        scan_id, tile.index, pos.get("x"), pos.get("y"), pos.get("z"), focus, time.time(),
+                        width, height, offset, length, exif,
+                    ),
+                )
+        ARCHIVE_TILES.inc(kind="tile")
+        return cursor.lastrowid
+
+    def scans(self) -> List[Dict]:
+        """Every scan in the archive, oldest first, with its tile count."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT s.id, s.name, s.microscope, s.started_at, s.finished_at, s.metadata, COUNT(t.id)"
+                " FROM scans s LEFT JOIN tiles t ON t.scan_id = s.id GROUP BY s.id ORDER BY s.id"
+            ).fetchall()
+        return [
+            {
+                "id": scan_id, "name": name, "microscope": microscope, "started_at": started_at,
+                "finished_at": finished_at, "metadata": json.loads(metadata or "{}"), "tiles": count,
+            }
+            for scan_id, name, microscope, started_at, finished_at, metadata, count in rows
+        ]
+
+    def tiles(
+        self,
+        scan_id: Optional[int] = None,
+        region: Optional[Tuple[int, int, int, int]] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+    ) -> List[ArchivedTile]:
+        """
+        Look up tiles by scan, stage region and capture time.
+
+        Args:
+            scan_id (Optional[int], optional): Only this scan. Defaults to every scan.
+            region (Optional[Tuple[int, int, int, int]], optional): Stage area (x1, y1, x2, y2) the tile
+                positions fall in, inclusive. Defaults to anywhere.
+            since (Optional[float], optional): Earliest capture time, as a Unix timestamp. Defaults to None.
+            until (Optional[float], optional): Latest capture time. Defaults to None.
+
+        Returns:
+            List[ArchivedTile]: Matching tiles, ordered by scan and index.
+        """
+        clauses, params = [], []
+        if scan_id is not None:
+            clauses.append("scan_id = ?")
+            params.append(scan_id)
+        if region is not None:
+            x1, y1, x2, y2 = region
+            clauses.append("x BETWEEN ? AND ? AND y BETWEEN ? AND ?")
+            params += [min(x1, x2), max(x1, x2), min(y1, y2), max(y1, y2)]
+        if since is not None:
+            clauses.append("captured_at >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("captured_at <= ?")
+            params.append(until)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT {TILE_COLUMNS} FROM tiles{where} ORDER BY scan_id, tile_index", params
+            ).fetchall()
+        return [ArchivedTile.from_row(row) for row in rows]
+
+    def tile(self, tile_id: int) -> ArchivedTile:
+        with self._lock:
+            row = self._db.execute(f"SELECT {TILE_COLUMNS} FROM tiles WHERE id = ?", (tile_id,)).fetchone()
+        if row is None:
+            raise KeyError(f"No tile {tile_id} in {self.directory}")
+        return ArchivedTile.from_row(row)
+
+    def exif(self, tile: Union[int, ArchivedTile]) -> Optional[bytes]:
+        """Raw EXIF block the tile was captured with, if it had one."""
+        tile_id = tile.id if isinstance(tile, ArchivedTile) else tile
+        with self._lock:
+            row = self._db.execute("SELECT exif FROM tiles WHERE id = ?", (tile_id,)).fetchone()
+        return row[0] if row else None
+
+    def data(self, tile: Union[int, ArchivedTile], level: int = 0) -> memoryview:
+        """
+        Encoded bytes of a tile, or of its copy reduced 2^level times.
+
+        Returns a read-only view of the memory-mapped archive; nothing is
+        copied until the bytes are read. Reduced copies are built on first use.
+        """
+        if not isinstance(tile, ArchivedTile):
+            tile = self.tile(tile)
+        if level == 0:
+            return self._view(tile.offset, tile.length)
+        with self._lock:
+            row = self._db.execute(
+                "SELECT offset, length FROM levels WHERE tile_id = ? AND level = ?", (tile.id, level)
+            ).fetchone()
+        if row is not None:
+            return self._view(*row)
+        reduced = self._reduce(self._view(tile.offset, tile.length), level)
+        with self._lock:
+            offset, length = self._append(reduced)
+            with self._db:
+                self._db.execute(
+                    "INSERT OR IGNORE INTO levels (tile_id, level, offset, length) VALUES (?, ?, ?, ?)",
+                    (tile.id, level, offset, length),
+                )
+        ARCHIVE_TILES.inc(kind="level")
+        return self._view(offset, length)
+
+    def load(self, scan_id: int, region: Optional[Tuple[int, int, int, int]] = None, level: int = 0) -> List[Tile]:
+        """Tiles of a scan as image_transport Tiles, ready to stitch again; their data are views of the archive."""
+        return [
+            Tile(tile.index, tile.pos, self.data(tile, level))
+            for tile in self.tiles(scan_id, region=region)
+        ]
+
+    async def restitch(self, scan_id: int, output: str, **kwargs) -> str:
+        """Stitch a stored scan again, e.g. with other stitching options. Keyword arguments go to stitch_to_file."""
+        from stitching import stitch_to_file
+
+        tiles = self.load(scan_id)
+        return await asyncio.to_thread(stitch_to_file, tiles, output, **kwargs)
+
+    def recorder(
+        self, name: str, microscope: Optional[str] = None, metadata: Optional[Dict] = None, score_focus: bool = True
+    ) -> "ScanRecorder":
+        """Return a sink that stores tiles in a new scan as they arrive; see ScanRecorder."""
+        return ScanRecorder(self, name, microscope, metadata, score_focus)
+
+    @staticmethod
+    def _reduce(data: BytesLike, level: int, quality: int = 85) -> bytes:
+        factor = 2 ** level
+        with open_image(data) as image:
+            size = (max(image.width // factor, 1), max(image.height // factor, 1))
+            # Let the JPEG decoder do most of the reduction
+            image.draft("RGB", size)
+            reduced = image.convert("RGB").resize(size)
+        buffer = io.BytesIO()
+        reduced.save(buffer, format="JPEG", quality=quality)
+        return buffer.getvalue()
+
+    def _append(self, data: BytesLike) -> Tuple[int, int]:
+        """Append bytes to tiles.bin. Called with the lock held."""
+        self._data.seek(0, os.SEEK_END)
+        offset = self._data.tell()
+        length = self._data.write(data)
+        self._data.flush()
+        ARCHIVE_BYTES.inc(length)
+        return offset, length
+
+    def _view(self, offset: int, length: int) -> memoryview:
+        with self._lock:
+            if self._map is None or offset + length > len(self._map):
+                # The file has grown since it was mapped; map it again. Old views keep the old map alive.
+                self._map = mmap.mmap(self._data.fileno(), 0, access=mmap.ACCESS_READ)
+            return memoryview(self._map)[offset:offset + length].toreadonly()
+
+class ScanRecorder:
+    """
+    Store tiles in a new archive scan as they arrive, with the same put/close interface as TileSink.
+
+    Each tile is appended on a worker thread, and optionally scored for
+    focus from a heavily reduced decode, so the event loop never waits on
+    the disk. The scan is created by the first put() and marked finished
+    by close().
+    """
+
+    def __init__(
+        self,
+        archive: ScanArchive,
+        name: str,
+        microscope: Optional[str] = None,
+        metadata: Optional[Dict] = None,
+        score_focus: bool = True,
+    ):
+        self.archive = archive
+        self.name = name
+        self.microscope = microscope
+        self.metadata = metadata
+        self.score_focus = score_focus
+        self.scan_id: Optional[int] = None
+
+    def start(self):
+        if self.scan_id is None:
+            self.scan_id = self.archive.begin_scan(self.name, self.microscope, self.metadata)
+
+    async def put(self, tile: Tile) -> int:
+        """Store a tile, returning its archive ID."""
+        self.start()
+        return await asyncio.to_thread(self._store, tile)
+
+    def _store(self, tile: Tile) -> int:
+        focus = None
+        if self.score_focus:
+            # numpy is only needed once a scan is being recorded
+            from autofocus import sharpness
+
+            focus = sharpness(tile.data, downsample=8)
+        return self.archive.add_tile(self.scan_id, tile, focus)
+
+    async def close(self) -> int:
+        """Mark the scan finished and return its ID."""
+        self.start()
+        await asyncio.to_thread(self.archive.finish_scan, self.scan_id)
+        logger.info(f"Archived scan {self.scan_id} ({self.name}) in {self.archive.directory}")
+        return self.scan_id
+
+    async def abort(self):
+        """Leave the scan unfinished; the tiles stored so far stay readable."""
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            await self.close()
+        else:
+            await self.abort()
@@ -0,0 +1,439 @@
+import asyncio
+import json
+import logging
+import math
+import time
+from typing import AsyncIterator, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+import metrics
+from autofocus import grayscale, laplacian_variance
+from image_transport import Tile
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+PLANNED_TILES = metrics.counter(
+    "scan_planner_tiles_total", "Tiles of executed scan plans by outcome (scanned, skipped)", ["result"]
+)
+
+ORDERS = ("serpentine", "shortest")
+
+class Survey(NamedTuple):
+    """
+    Low-resolution pre-pass over a scan area: one preview per cell of a grid without overlap.
+
+    ``contrast`` and ``texture`` are (rows, cols) arrays, row 0 at the smallest y.
+    """
+
+    origin: Tuple[float, float]  # stage x, y of the centre of cell (0, 0)
+    cell: Tuple[float, float]  # cell width and height in stage steps
+    contrast: np.ndarray
+    texture: np.ndarray
+
+class ScanPlan(NamedTuple):
+    """Where a scan will capture, in visiting order, and what it is expected to cost."""
+
+    positions: List[Dict[str, int]]
+    skipped: List[Dict[str, int]]
+    travel: float  # stage steps, counting the longest axis of each move
+    estimated_seconds: float
+    focus_every: int = 0
+
+def local_contrast(gray: np.ndarray, block: int = 16) -> float:
+    """
+    Standard deviation of grey levels within small blocks, taken at the 99th percentile over the blocks.
+
+    Slow illumination gradients and vignetting barely register, while a
+    feature covering even a few blocks of an otherwise empty field does.
+    """
+    height, width = gray.shape[0] // block * block, gray.shape[1] // block * block
+    blocks = gray[:height, :width].reshape(height // block, block, width // block, block)
+    return float(np.percentile(blocks.std(axis=(1, 3)), 99))
+
+def chebyshev(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Distance for a stage that drives every axis at once: the longest axis of the move."""
+    return np.abs(a - b).max(axis=-1)
+
+def nearest_neighbour(points: np.ndarray, start: np.ndarray) -> List[int]:
+    """Visiting order that always goes to the closest point not yet visited."""
+    remaining = np.ones(len(points), dtype=bool)
+    order = []
+    current = start
+    for _ in range(len(points)):
+        distances = np.where(remaining, chebyshev(points, current), np.inf)
+        nearest = int(np.argmin(distances))
+        order.append(nearest)
+        remaining[nearest] = False
+        current = points[nearest]
+    return order
+
+def two_opt(points: np.ndarray, order: Sequence[int], start: np.ndarray, max_passes: int = 20) -> List[int]:
+    """
+    Shorten an open path from ``start`` by reversing sections of it while that removes travel.
+
+    Args:
+        points (np.ndarray): (n, 2) positions.
+        order (Sequence[int]): Starting visiting order, e.g. from nearest_neighbour.
+        start (np.ndarray): Where the stage is before the first point; it stays first.
+        max_passes (int, optional): Full passes over the path before giving up. Defaults to 20.
+
+    Returns:
+        List[int]: Improved visiting order.
+    """
+    path = np.vstack([start[None, :], points[list(order)]])
+    route = np.arange(len(path))
+    for _ in range(max_passes):
+        improved = False
+        for i in range(1, len(route) - 1):
+            a, b = path[route[i - 1]], path[route[i]]
+            # Replacing edges (i-1, i) and (j, j+1) by (i-1, j) and (i, j+1) reverses route[i:j+1]
+            c, d = path[route[i + 1:-1]], path[route[i + 2:]]
+            gains = chebyshev(a, b) + chebyshev(c, d) - chebyshev(a, c) - chebyshev(b, d)
+            # The path is open, so the tail can also be reversed outright
+            tail_gain = chebyshev(a, b) - chebyshev(a, path[route[-1]])
+            j = int(np.argmax(gains)) if len(gains) else -1
+            if j >= 0 and gains[j] > max(tail_gain, 1e-9):
+                route[i:i + j + 2] = route[i:i + j + 2][::-1].copy()
+                improved = True
+            elif tail_gain > 1e-9:
+                route[i:] = route[i:][::-1].copy()
+                improved = True
+        if not improved:
+            break
+    return [int(order[k - 1]) for k in route[1:]]
+
+class ScanPlanner:
+    """
+    Plan scans that skip empty background, reorder fields for less stage travel, and adapt their overlap.
+
+    A survey captures one preview per field of view over the area, without
+    overlap, in a single batch. Fields whose previews show no contrast above
+    ``blank_threshold`` are left out of the plan. Overlap shrinks towards
+    ``min_overlap`` where the survey found plenty of texture for stitching to
+    register against, and grows to ``max_overlap`` where it found little.
+    The remaining fields are visited row by row in alternating directions
+    ("serpentine"), or along a nearest-neighbour path improved by 2-opt
+    ("shortest"), which pays off when skipped fields leave islands. Plans are
+    ordinary values, so callers can show the positions and estimated time
+    before running one with execute().
+    """
+
+    def __init__(
+        self,
+        field_of_view: Tuple[int, int] = (1640, 1232),
+        min_overlap: float = 0.15,
+        max_overlap: float = 0.4,
+        order: str = "serpentine",
+        blank_threshold: float = 1.5,
+        texture_threshold: float = 50.0,
+        stage_speed: float = 2000.0,
+        capture_seconds: float = 0.5,
+        focus_seconds: float = 3.0,
+    ):
+        """
+        Initialize the planner.
+
+        Args:
+            field_of_view (Tuple[int, int], optional): Width and height one frame covers, in stage steps.
+                Defaults to (1640, 1232).
+            min_overlap (float, optional): Overlap between neighbouring fields with plenty of texture, as a
+                fraction of the field. Defaults to 0.15.
+            max_overlap (float, optional): Overlap where texture is sparse, or unknown. Defaults to 0.4.
+            order (str, optional): "serpentine" or "shortest". Defaults to "serpentine".
+            blank_threshold (float, optional): Local contrast (grey levels) below which a surveyed cell
+                counts as background. Defaults to 1.5.
+            texture_threshold (float, optional): Laplacian variance of a preview above which a cell gets the
+                minimum overlap. Defaults to 50.
+            stage_speed (float, optional): Stage steps per second along the longest axis. Defaults to 2000.
+            capture_seconds (float, optional): Settling, capture and transfer time per field. Defaults to 0.5.
+            focus_seconds (float, optional): Time per autofocus. Defaults to 3.
+        """
+        if order not in ORDERS:
+            raise ValueError(f"Unknown scan order {order!r}; expected one of {ORDERS}")
+        if not 0 <= min_overlap <= max_overlap < 1:
+            raise ValueError("Overlaps must satisfy 0 <= min_overlap <= max_overlap < 1")
+        self.field_of_view = field_of_view
+        self.min_overlap = min_overlap
+        self.max_overlap = max_overlap
+        self.order = order
+        self.blank_threshold = blank_threshold
+        self.texture_threshold = texture_threshold
+        self.stage_speed = stage_speed
+        self.capture_seconds = capture_seconds
+        self.focus_seconds = focus_seconds
+
+    @staticmethod
+    def _corners(c1: Union[str, List[int]], c2: Union[str, List[int]]) -> Tuple[float, float, float, float]:
+        # Corners may come as the "[x, y]" strings the scan command also accepts
+        c1 = json.loads(c1) if isinstance(c1, str) else c1
+        c2 = json.loads(c2) if isinstance(c2, str) else c2
+        return min(c1[0], c2[0]), min(c1[1], c2[1]), max(c1[0], c2[0]), max(c1[1], c2[1])
+
+    def survey_positions(self, c1: Union[str, List[int]], c2: Union[str, List[int]]) -> List[List[Dict[str, int]]]:
+        """Rows of survey cell centres: fields of view edge to edge, covering every field between the corners."""
+        x1, y1, x2, y2 = self._corners(c1, c2)
+        width, height = self.field_of_view
+        cols = math.ceil((x2 - x1) / width) + 1
+        rows = math.ceil((y2 - y1) / height) + 1
+        return [[{"x": int(x1 + col * width), "y": int(y1 + row * height)} for col in range(cols)] for row in range(rows)]
+
+    async def survey(
+        self,
+        microscope,
+        c1: Union[str, List[int]],
+        c2: Union[str, List[int]],
+        z: Optional[int] = None,
+        timeout: Optional[float] = None,
+    ) -> Survey:
+        """
+        Capture and score a preview of every survey cell, in one serpentine batch.
+
+        Args:
+            microscope (MicroscopeDemo): Connected client of the microscope.
+            c1 (Union[str, List[int]]): First corner, as for MicroscopeDemo.scan.
+            c2 (Union[str, List[int]]): Second corner.
+            z (Optional[int], optional): Stage height for the survey. Defaults to the current one.
+            timeout (Optional[float], optional): Seconds to wait for each result. Defaults to the client timeout.
+
+        Returns:
+            Survey: Contrast and texture of each cell.
+        """
+        rows = self.survey_positions(c1, c2)
+        cells = [
+            (row, col)
+            for row in range(len(rows))
+            for col in (range(len(rows[row])) if row % 2 == 0 else reversed(range(len(rows[row]))))
+        ]
+        steps = []
+        for row, col in cells:
+            move = {"command": "move", **rows[row][col]}
+            if z is not None:
+                move["z"] = int(z)
+            steps.append(move)
+            steps.append({"command": "take_image"})
+        contrast = np.zeros((len(rows), len(rows[0])))
+        texture = np.zeros_like(contrast)
+        loop = asyncio.get_running_loop()
+        scores = []
+        started = time.perf_counter()
+        async for result in microscope.batch(steps, timeout=timeout, resolution="preview"):
+            if "error" in result:
+                raise RuntimeError(f"Survey step {result.get('step')} failed: {result['error']}")
+            if "data" in result:
+                scores.append((cells[result["step"] // 2], loop.run_in_executor(None, self._score, result)))
+        for (row, col), score in scores:
+            contrast[row, col], texture[row, col] = await score
+        blank = int((contrast < self.blank_threshold).sum())
+        logger.info(
+            f"Surveyed {len(cells)} fields in {time.perf_counter() - started:.1f}s; {blank} look like background"
+        )
+        width, height = self.field_of_view
+        return Survey((rows[0][0]["x"], rows[0][0]["y"]), (width, height), contrast, texture)
+
+    @staticmethod
+    def _score(result: Dict) -> Tuple[float, float]:
+        try:
+            gray = grayscale(result["data"], downsample=1)
+            return local_contrast(gray), laplacian_variance(gray)
+        finally:
+            frame = result.get("frame")
+            if frame is not None:
+                frame.release()
+
+    def _cells(self, survey: Survey, x: float, y: float) -> Tuple[slice, slice]:
+        """Survey rows and columns that the field of view centred on (x, y) overlaps."""
+        (ox, oy), (cw, ch) = survey.origin, survey.cell
+        width, height = self.field_of_view
+        rows, cols = survey.contrast.shape
+        # A field just touching a cell edge does not count as overlapping it
+        col_lo = max(math.floor((x - width / 2 - ox) / cw + 0.5 + 1e-6), 0)
+        col_hi = min(math.ceil((x + width / 2 - ox) / cw + 0.5 - 1e-6), cols)
+        row_lo = max(math.floor((y - height / 2 - oy) / ch + 0.5 + 1e-6), 0)
+        row_hi = min(math.ceil((y + height / 2 - oy) / ch + 0.5 - 1e-6), rows)
+        return slice(row_lo, row_hi), slice(col_lo, col_hi)
+
+    def _overlap(self, survey: Survey, rows: slice, cols: slice) -> float:
+        occupied = survey.contrast[rows, cols] >= self.blank_threshold
+        if not occupied.any():
+            return self.min_overlap
+        # The sparsest occupied cell decides: registration needs features in the shared strip
+        texture = survey.texture[rows, cols][occupied].min()
+        weight = min(max(texture / self.texture_threshold, 0.0), 1.0)
+        return self.max_overlap - weight * (self.max_overlap - self.min_overlap)
+
+    def _blank(self, survey: Optional[Survey], x: float, y: float) -> bool:
+        if survey is None:
+            return False
+        rows, cols = self._cells(survey, x, y)
+        return not (survey.contrast[rows, cols] >= self.blank_threshold).any()
+
+    @staticmethod
+    def _axis(start: float, stop: float, size: float, overlap_at: Callable[[float], float]) -> List[float]:
+        """Field centres from start to stop, spaced by the overlap each place needs, then squeezed to end on stop."""
+        centres = [start]
+        while centres[-1] < stop:
+            centres.append(centres[-1] + size * (1 - overlap_at(centres[-1])))
+        if len(centres) > 1:
+            # Squeezing only adds overlap, and avoids a last field that is almost a copy of the one before
+            scale = (stop - start) / (centres[-1] - start)
+            centres = [start + (centre - start) * scale for centre in centres]
+        return centres
+
+    def grid(
+        self, c1: Union[str, List[int]], c2: Union[str, List[int]], survey: Optional[Survey] = None
+    ) -> List[List[Dict[str, int]]]:
+        """
+        Rows of field centres covering the area, spaced by the overlap each place needs.
+
+        Spacing between rows follows the sparsest part of the row, and spacing
+        within a row follows each field, so rows need not line up. Without a
+        survey every field uses ``max_overlap``.
+        """
+        x1, y1, x2, y2 = self._corners(c1, c2)
+        width, height = self.field_of_view
+
+        def row_overlap(y: float) -> float:
+            if survey is None:
+                return self.max_overlap
+            # The next row shares this row's lower strip
+            band, _ = self._cells(survey, x1, y + height / 2)
+            return self._overlap(survey, band, slice(None))
+
+        def field_overlap(y: float) -> Callable[[float], float]:
+            def overlap(x: float) -> float:
+                if survey is None:
+                    return self.max_overlap
+                # The next field shares this field's right-hand strip
+                return self._overlap(survey, *self._cells(survey, x + width / 2, y))
+            return overlap
+
+        return [
+            [{"x": int(round(x)), "y": int(round(y))} for x in self._axis(x1, x2, width, field_overlap(y))]
+            for y in self._axis(y1, y2, height, row_overlap)
+        ]
+
+    def plan(
+        self,
+        c1: Union[str, List[int]],
+        c2: Union[str, List[int]],
+        survey: Optional[Survey] = None,
+        start: Optional[Dict[str, int]] = None,
+        z: Optional[int] = None,
+        focus_every: int = 0,
+    ) -> ScanPlan:
+        """
+        Lay out a scan of the area between two corners.
+
+        Args:
+            c1 (Union[str, List[int]]): First corner, as for MicroscopeDemo.scan.
+            c2 (Union[str, List[int]]): Second corner.
+            survey (Optional[Survey], optional): Pre-pass used to skip background and adapt overlap.
+                Defaults to None (every field, at max_overlap).
+            start (Optional[Dict[str, int]], optional): Stage position before the scan. Defaults to c1.
+            z (Optional[int], optional): Stage height to scan at. Defaults to leaving z alone.
+            focus_every (int, optional): Autofocus before every n-th field; 0 never. Defaults to 0.
+
+        Returns:
+            ScanPlan: Positions in visiting order, skipped fields, travel and estimated duration.
+        """
+        rows = self.grid(c1, c2, survey)
+        kept, skipped = [], []
+        for index, row in enumerate(rows):
+            fields = [pos for pos in row if not self._blank(survey, pos["x"], pos["y"])]
+            skipped.extend(pos for pos in row if self._blank(survey, pos["x"], pos["y"]))
+            kept.append(fields[::-1] if index % 2 else fields)
+        positions = [pos for row in kept for pos in row]
+        x1, y1, _, _ = self._corners(c1, c2)
+        origin = np.array([start["x"], start["y"]] if start else [x1, y1], dtype=np.float64)
+        if self.order == "shortest" and len(positions) > 2:
+            points = np.array([[pos["x"], pos["y"]] for pos in positions], dtype=np.float64)
+            order = two_opt(points, nearest_neighbour(points, origin), origin)
+            positions = [positions[i] for i in order]
+        if z is not None:
+            positions = [{**pos, "z": int(z)} for pos in positions]
+        path = np.array([origin] + [[pos["x"], pos["y"]] for pos in positions], dtype=np.float64)
+        travel = float(chebyshev(path[1:], path[:-1]).sum()) if len(positions) else 0.0
+        focuses = len(positions) // focus_every if focus_every else 0
+        estimated = travel / self.stage_speed + len(positions) * self.capture_seconds + focuses * self.focus_seconds
+        return ScanPlan(positions, skipped, travel, estimated, focus_every)
+
+    async def prepare(
+        self,
+        microscope,
+        c1: Union[str, List[int]],
+        c2: Union[str, List[int]],
+        survey: bool = True,
+        focus_every: int = 0,
+        timeout: Optional[float] = None,
+    ) -> ScanPlan:
+        """Survey the area (unless ``survey`` is False) and plan a scan from the stage's current position."""
+        start = await microscope.get_pos(timeout=timeout)
+        found = await self.survey(microscope, c1, c2, z=start["z"], timeout=timeout) if survey else None
+        plan = self.plan(c1, c2, found, start=start, z=start["z"], focus_every=focus_every)
+        logger.info(
+            f"Planned {len(plan.positions)} fields ({len(plan.skipped)} skipped), "
+            f"{plan.travel:.0f} steps of travel, about {plan.estimated_seconds:.0f}s"
+        )
+        return plan
+
+async def execute(
+    microscope,
+    plan: ScanPlan,
+    window: int = 4,
+    timeout: Optional[float] = None,
+    resolution: str = "full",
+) -> AsyncIterator[Tile]:
+    """
+    Run a scan plan as one batch, yielding each tile as it arrives.
+
+    Tiles are indexed by their place in ``plan.positions`` and carry the
+    position the stage reported for the capture. Release each tile when done
+    with it, as for MicroscopeDemo.scan_iter.
+
+    Raises:
+        RuntimeError: If a step of the plan fails on the device.
+    """
+    steps, fields = [], {}
+    for index, pos in enumerate(plan.positions):
+        steps.append({"command": "move", **pos})
+        if plan.focus_every and index % plan.focus_every == 0:
+            steps.append({"command": "focus", "amount": "fast"})
+        fields[len(steps)] = index
+        steps.append({"command": "take_image"})
+    PLANNED_TILES.inc(len(plan.skipped), result="skipped")
+    started = time.perf_counter()
+    async for result in microscope.batch(steps, window=window, timeout=timeout, resolution=resolution):
+        if "error" in result:
+            raise RuntimeError(f"Scan step {result.get('step')} failed: {result['error']}")
+        if "data" in result:
+            index = fields[result["step"]]
+            PLANNED_TILES.inc(result="scanned")
+            yield Tile(index, result.get("pos") or plan.positions[index], result["data"], result.get("frame"))
+    logger.info(
+        f"Scanned {len(plan.positions)} fields in {time.perf_counter() - started:.1f}s "
+        f"(estimated {plan.estimated_seconds:.1f}s)"
+    )
+
+# Example usage, against the simulator
+async def main():
+    from microscope_demo_client import MicroscopeDemo
+    from simulator import LoopbackBroker, LoopbackClient, SimulatedMicroscope
+
+    broker = LoopbackBroker()
+    client = LoopbackClient(broker)
+    client.connect()
+    # The sample only covers the lower left of a 12 x 12 field area
+    with SimulatedMicroscope(broker, latency=0.01, sample_region=(0, 0, 6000, 4000)) as device:
+        async with MicroscopeDemo("loopback", 0, "user", "key", device.name, client=client) as microscope:
+            planner = ScanPlanner(order="shortest")
+            full = planner.plan([0, 0], [18000, 13000])
+            plan = await planner.prepare(microscope, [0, 0], [18000, 13000])
+            print(f"Without a survey: {len(full.positions)} fields, about {full.estimated_seconds:.0f}s")
+            print(f"With a survey: {len(plan.positions)} fields, about {plan.estimated_seconds:.0f}s")
+            async for tile in execute(microscope, plan, resolution="preview"):
+                tile.release()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,115 @@
+import logging
+import os
+from typing import Dict, Optional
+
+import gradio as gr
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Where scan_and_stitch(..., pyramid=...) pyramids are looked for
+PYRAMID_DIR = os.getenv("PYRAMID_DIR", "pyramids")
+VIEW_SIZE = (960, 720)
+# Share of the view one pan button moves by
+PAN_STEP = 0.5
+
+_server = None
+
+def tile_server():
+    """The tile server shared by every viewer. pyramid (and numpy) are only imported when a scan is first viewed."""
+    global _server
+    if _server is None:
+        from pyramid import TileServer
+
+        _server = TileServer(PYRAMID_DIR)
+    return _server
+
+def _render(state: Dict):
+    width, height = VIEW_SIZE
+    return tile_server().view(state["name"], state["level"], state["cx"], state["cy"], width, height)
+
+def _label(state: Dict) -> str:
+    info = tile_server().info(state["name"])
+    zoom = 2 ** (state["level"] - info.top)
+    centre = f"({state['cx']:.0f}, {state['cy']:.0f})"
+    return f"{state['name']}: {info.width} x {info.height} px, zoom {zoom:g}x, centre {centre}"
+
+def list_scans():
+    names = tile_server().pyramids()
+    return gr.update(choices=names, value=names[0] if names else None)
+
+def open_scan(name: Optional[str]):
+    """Show a whole scan: the deepest level that still fits the view."""
+    if not name:
+        return None, "", None
+    info = tile_server().info(name)
+    width, height = VIEW_SIZE
+    level = info.top
+    while level > 0 and (info.level_size(level)[0] > width or info.level_size(level)[1] > height):
+        level -= 1
+    state = {"name": name, "level": level, "cx": info.width / 2, "cy": info.height / 2}
+    return _render(state), _label(state), state
+
+def zoom(state: Optional[Dict], levels: int):
+    if not state:
+        return None, "", state
+    info = tile_server().info(state["name"])
+    state = {**state, "level": min(max(state["level"] + levels, 0), info.top)}
+    return _render(state), _label(state), state
+
+def pan(state: Optional[Dict], dx: float, dy: float):
+    """Move the view by a fraction of its size."""
+    if not state:
+        return None, "", state
+    info = tile_server().info(state["name"])
+    scale = 2 ** (info.top - state["level"])
+    width, height = VIEW_SIZE
+    cx = min(max(state["cx"] + dx * width * scale, 0), info.width)
+    cy = min(max(state["cy"] + dy * height * scale, 0), info.height)
+    state = {**state, "cx": cx, "cy": cy}
+    return _render(state), _label(state), state
+
+def recentre(state: Optional[Dict], event: gr.SelectData):
+    """Centre the view on the clicked point."""
+    if not state:
+        return None, "", state
+    x, y = event.index
+    width, height = VIEW_SIZE
+    return pan(state, (x - width / 2) / width, (y - height / 2) / height)
+
+def show():
+    with gr.Blocks() as demo:
+        gr.Markdown("# Scan Viewer")
+        gr.Markdown(
+            "Browse stitched scans. Only the part of the scan in view is sent, at the zoom shown; "
+            "click the image to centre it there."
+        )
+        state = gr.State(None)
+        with gr.Row():
+            scan_selection = gr.Dropdown(choices=[], label="Scan")
+            refresh_button = gr.Button("Refresh list")
+        view_label = gr.Markdown()
+        view = gr.Image(label="Scan", type="pil", interactive=False)
+        with gr.Row():
+            zoom_out_button = gr.Button("Zoom out")
+            zoom_in_button = gr.Button("Zoom in")
+            left_button = gr.Button("←")
+            up_button = gr.Button("↑")
+            down_button = gr.Button("↓")
+            right_button = gr.Button("→")
+
+        outputs = [view, view_label, state]
+        refresh_button.click(list_scans, inputs=[], outputs=scan_selection)
+        scan_selection.change(open_scan, inputs=scan_selection, outputs=outputs)
+        zoom_in_button.click(lambda s: zoom(s, 1), inputs=state, outputs=outputs)
+        zoom_out_button.click(lambda s: zoom(s, -1), inputs=state, outputs=outputs)
+        left_button.click(lambda s: pan(s, -PAN_STEP, 0), inputs=state, outputs=outputs)
+        right_button.click(lambda s: pan(s, PAN_STEP, 0), inputs=state, outputs=outputs)
+        up_button.click(lambda s: pan(s, 0, -PAN_STEP), inputs=state, outputs=outputs)
+        down_button.click(lambda s: pan(s, 0, PAN_STEP), inputs=state, outputs=outputs)
+        view.select(recentre, inputs=state, outputs=outputs)
+
+    return demo
+
+if __name__ == "__main__":
+    show().launch()
@@ -0,0 +1,245 @@
+import asyncio
+import logging
+import secrets
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Callable, Deque, Dict, NamedTuple, Optional
+
+import metrics
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+QUEUE_LENGTH = metrics.gauge("scheduler_waiting_users", "Users waiting for a microscope", ["device"])
+LEASE_SECONDS = metrics.histogram(
+    "scheduler_lease_seconds", "How long leases were held", ["device"], buckets=(10, 30, 60, 120, 180, 300, 600)
+)
+# Times a request stores a key before giving up, should its lease keep ending while the key is written
+ISSUE_ATTEMPTS = 3
+
+class Ticket(NamedTuple):
+    """A user's place for a device: a granted lease with its key, or a queue position with a wait estimate."""
+
+    # "granted", "ready" (turn has come, claim with request()), "waiting"
+    # or "released" (given up while its key was being issued)
+    status: str
+    key: Optional[str] = None
+    expires_at: Optional[float] = None
+    position: Optional[int] = None
+    wait: Optional[float] = None
+
+class Lease:
+    def __init__(self, user: str, granted_at: float, expires_at: float):
+        self.user = user
+        self.key: Optional[str] = None  # issued when the user claims the lease
+        self.granted_at = granted_at
+        self.expires_at = expires_at
+
+class _Device:
+    def __init__(self, typical_lease: float):
+        self.lease: Optional[Lease] = None
+        self.waiting: Deque[str] = deque()
+        self.typical_lease = typical_lease
+        self.command_lock: Optional[asyncio.Lock] = None
+        # Set while a key for this device is being stored or revoked, outside the scheduler lock
+        self.writing_key = False
+
+class DeviceScheduler:
+    """
+    One user at a time per microscope, with everyone else queued in turn.
+
+    A user holds a device through a lease bound to the access key issued for
+    it. Other users join a queue with at most one place each, and a user whose
+    lease has ended goes to the back, so the device rotates round-robin. A
+    user promoted while away has ``claim_seconds`` to come back before the
+    next user is promoted. Waits are estimated from an exponentially weighted
+    average of how long recent leases were actually held. Commands from the
+    holder run one at a time, in the order they were sent.
+
+    Keys are issued and revoked outside the scheduler lock, since storing them
+    can mean a database round-trip; a device whose key is being written
+    answers "ready" to its next claim until the write is done.
+    """
+
+    def __init__(
+        self,
+        issue_key: Callable[[str, float], str],
+        revoke_key: Optional[Callable[[str], None]] = None,
+        lease_seconds: float = 180.0,
+        claim_seconds: float = 60.0,
+        smoothing: float = 0.3,
+    ):
+        """
+        Initialize the scheduler.
+
+        Args:
+            issue_key (Callable[[str, float], str]): Called with (device, seconds) to create and store an access key.
+            revoke_key (Optional[Callable[[str], None]], optional): Called with the device when a lease ends early.
+            lease_seconds (float, optional): Length of a lease. Defaults to 180.
+            claim_seconds (float, optional): Time a promoted user has to claim the lease. Defaults to 60.
+            smoothing (float, optional): Weight of the latest lease in the average lease length. Defaults to 0.3.
+        """
+        self.issue_key = issue_key
+        self.revoke_key = revoke_key
+        self.lease_seconds = lease_seconds
+        self.claim_seconds = claim_seconds
+        self.smoothing = smoothing
+        self._devices: Dict[str, _Device] = {}
+        self._lock = threading.Lock()
+
+    def _device(self, device: str) -> _Device:
+        state = self._devices.get(device)
+        if state is None:
+            state = self._devices[device] = _Device(self.lease_seconds)
+        return state
+
+    def request(self, device: str, user: str) -> Ticket:
+        """Ask for a device: claims the lease if it is this user's turn, otherwise joins or reports the queue."""
+        join = True
+        for _ in range(ISSUE_ATTEMPTS):
+            now = time.time()
+            with self._lock:
+                state = self._device(device)
+                self._advance(device, state, now)
+                lease = state.lease
+                if lease is None and join:
+                    lease = state.lease = Lease(user, now, now + self.claim_seconds)
+                if lease is None or lease.user != user:
+                    if join and user not in state.waiting:
+                        state.waiting.append(user)
+                        QUEUE_LENGTH.set(len(state.waiting), device=device)
+                    if user in state.waiting:
+                        return self._waiting_ticket(state, user, now)
+                    return Ticket("released")
+                if lease.key is not None or state.writing_key:
+                    return Ticket("granted" if lease.key else "ready", lease.key, lease.expires_at)
+                # Reserve the lease, then store its key without holding up every other device
+                state.writing_key = True
+                lease.granted_at, lease.expires_at = now, now + self.lease_seconds
+            try:
+                key = self.issue_key(device, self.lease_seconds)
+            except BaseException:
+                with self._lock:
+                    state.writing_key = False
+                raise
+            with self._lock:
+                if state.lease is lease:
+                    state.writing_key = False
+                    lease.key = key
+                    logger.info(f"Lease on {device} granted")
+                    return Ticket("granted", key, lease.expires_at)
+            # Released while the key was stored: take the key back before anyone else is issued one
+            logger.info(f"Lease on {device} ended before its key was stored")
+            self._revoke(device, state)
+            # The device has passed to the next user; only a lease this user asked for again in the meantime is claimed
+            join = False
+        with self._lock:
+            return self._ticket(state, user, time.time()) or Ticket("released")
+
+    def status(self, device: str, user: str) -> Optional[Ticket]:
+        """Return the user's current ticket without joining the queue, or None if they have no place."""
+        now = time.time()
+        with self._lock:
+            state = self._device(device)
+            self._advance(device, state, now)
+            return self._ticket(state, user, now)
+
+    def release(self, device: str, user: str) -> bool:
+        """Give up a lease or a place in the queue. Returns True if the user had either."""
+        now = time.time()
+        with self._lock:
+            state = self._device(device)
+            if user in state.waiting:
+                state.waiting.remove(user)
+                QUEUE_LENGTH.set(len(state.waiting), device=device)
+                return True
+            lease = state.lease
+            if lease is None or lease.user != user:
+                return False
+            self._end_lease(device, state, now)
+            revoke = lease.key is not None and self.revoke_key is not None
+            # The next user's key waits until this one is revoked, or the revocation would clear it
+            state.writing_key = state.writing_key or revoke
+            self._advance(device, state, now)
+        if revoke:
+            self._revoke(device, state)
+        return True
+
+    def holds(self, device: str, key: str) -> bool:
+        """Return True if ``key`` belongs to the current, unexpired lease on ``device``."""
+        now = time.time()
+        with self._lock:
+            state = self._device(device)
+            self._advance(device, state, now)
+            lease = state.lease
+            return bool(lease and lease.key and key) and secrets.compare_digest(lease.key, key)
+
+    @asynccontextmanager
+    async def command(self, device: str, key: str):
+        """
+        Run one command as the lease holder; commands queue in order on the device.
+
+        Raises:
+            PermissionError: If ``key`` does not hold the lease on ``device``.
+        """
+        if not self.holds(device, key):
+            raise PermissionError(f"This key does not hold {device}; request access and wait for your turn")
+        with self._lock:
+            state = self._device(device)
+            if state.command_lock is None:
+                state.command_lock = asyncio.Lock()
+            command_lock = state.command_lock
+        async with command_lock:
+            # The lease may have run out while earlier commands were queued
+            if not self.holds(device, key):
+                raise PermissionError(f"The lease on {device} has expired")
+            yield
+
+    def _ticket(self, state: _Device, user: str, now: float) -> Optional[Ticket]:
+        lease = state.lease
+        if lease is not None and lease.user == user:
+            return Ticket("granted" if lease.key else "ready", lease.key, lease.expires_at)
+        if user in state.waiting:
+            return self._waiting_ticket(state, user, now)
+        return None
+
+    def _waiting_ticket(self, state: _Device, user: str, now: float) -> Ticket:
+        position = state.waiting.index(user) + 1
+        lease = state.lease
+        remaining = 0.0
+        if lease is not None:
+            # Leases usually end before they run out, so expect the typical length unless it has already passed
+            expected_end = lease.expires_at if lease.key is None else min(lease.expires_at, lease.granted_at + state.typical_lease)
+            remaining = max(expected_end - now, 0.0)
+        return Ticket("waiting", position=position, wait=remaining + (position - 1) * state.typical_lease)
+
+    def _advance(self, device: str, state: _Device, now: float):
+        if state.lease is not None and state.lease.expires_at <= now:
+            if state.lease.key is None:
+                logger.info(f"Lease on {device} was not claimed in time")
+            self._end_lease(device, state, now)
+        if state.lease is None and state.waiting:
+            user = state.waiting.popleft()
+            QUEUE_LENGTH.set(len(state.waiting), device=device)
+            state.lease = Lease(user, now, now + self.claim_seconds)
+            logger.info(f"Next user promoted on {device}; {len(state.waiting)} still waiting")
+
+    def _end_lease(self, device: str, state: _Device, now: float):
+        lease = state.lease
+        state.lease = None
+        if lease.key is None:
+            return
+        held = min(now, lease.expires_at) - lease.granted_at
+        LEASE_SECONDS.observe(held, device=device)
+        state.typical_lease += self.smoothing * (held - state.typical_lease)
+
+    def _revoke(self, device: str, state: _Device):
+        """Revoke the device's key outside the lock, then let the next key be issued."""
+        try:
+            if self.revoke_key is not None:
+                self.revoke_key(device)
+        finally:
+            with self._lock:
+                state.writing_key = False
@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Optional, Tuple
+
+from frame_buffer import FrameRing
+from frame_cache import frame_cache_for
+from microscope_demo_client import MicroscopeDemo
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class _PooledSession:
+    def __init__(self, microscope: MicroscopeDemo):
+        self.microscope = microscope
+        self.in_use = 0
+        self.last_used = time.monotonic()
+        self.retired = False
+
+class SessionPool:
+    """
+    Keep authenticated MicroscopeDemo connections warm between requests.
+
+    Sessions are keyed by (microscope, access key), so each user keeps their own
+    credentials while repeated clicks reuse the same TLS connection and
+    subscriptions. Sessions left idle for longer than ``idle_timeout`` are closed.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        idle_timeout: float = 300.0,
+        max_sessions: int = 32,
+        connect_timeout: float = 15.0,
+        cache_frames: bool = False,
+        frame_ring: Optional[FrameRing] = None,
+    ):
+        """
+        Initialize the pool.
+
+        Args:
+            host (str): MQTT broker host.
+            port (int): MQTT broker port.
+            idle_timeout (float, optional): Seconds an unused session is kept open. Defaults to 300.
+            max_sessions (int, optional): Open sessions kept before the least recently used idle one is closed. Defaults to 32.
+            connect_timeout (float, optional): Seconds to wait for the broker to accept a new session. Defaults to 15.
+            cache_frames (bool, optional): Share a frame cache between all sessions on the same microscope,
+                so repeated captures of an unchanged stage are not sent again. Defaults to False.
+            frame_ring (Optional[FrameRing], optional): Ring that every session receives images into. Defaults to None.
+        """
+        self.host = host
+        self.port = port
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.connect_timeout = connect_timeout
+        self.cache_frames = cache_frames
+        self.frame_ring = frame_ring
+        self._sessions: Dict[Tuple[str, str], _PooledSession] = {}
+        self._connecting: Dict[Tuple[str, str], asyncio.Future] = {}
+        self._reaper = None
+
+    @asynccontextmanager
+    async def session(self, microscope: str, access_key: str):
+        """
+        Borrow a connected MicroscopeDemo for the duration of the block.
+
+        Args:
+            microscope (str): Microscope identifier.
+            access_key (str): Access key used as the MQTT password.
+        """
+        key = (microscope, access_key)
+        entry = await self._acquire(key)
+        entry.in_use += 1
+        try:
+            yield entry.microscope
+        finally:
+            entry.in_use -= 1
+            entry.last_used = time.monotonic()
+            if not entry.microscope.is_connected():
+                await self._retire(key, entry)
+            elif entry.retired and entry.in_use == 0:
+                await self._shutdown(entry)
+
+    async def _acquire(self, key: Tuple[str, str]) -> _PooledSession:
+        self._start_reaper()
+        entry = self._sessions.get(key)
+        if entry is not None and entry.microscope.is_connected():
+            return entry
+        if entry is not None:
+            await self._retire(key, entry)
+
+        # Concurrent clicks for the same key share one connection attempt
+        pending = self._connecting.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        self._connecting[key] = future
+        try:
+            # The TLS handshake blocks, so it runs off the event loop
+            entry = _PooledSession(await asyncio.to_thread(self._connect, *key))
+            self._sessions[key] = entry
+            logger.info(f"Opened pooled session for {key[0]}")
+            future.set_result(entry)
+            await self._trim()
+            return entry
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved when nobody else was waiting on it
+            future.exception()
+            raise
+        finally:
+            del self._connecting[key]
+
+    def _connect(self, microscope: str, access_key: str) -> MicroscopeDemo:
+        demo = MicroscopeDemo(
+            self.host, self.port, f"{microscope}clientuser", access_key, microscope,
+            frame_cache=frame_cache_for(microscope) if self.cache_frames else None,
+            frame_ring=self.frame_ring,
+        )
+        if not demo.client.wait_for_connection(self.connect_timeout):
+            demo.end_connection()
+            raise ConnectionError(f"Broker did not accept a session for {microscope}")
+        return demo
+
+    async def _trim(self):
+        idle = sorted(
+            (entry.last_used, key) for key, entry in self._sessions.items() if entry.in_use == 0
+        )
+        excess = len(self._sessions) - self.max_sessions
+        for _, key in idle[:max(excess, 0)]:
+            entry = self._sessions.get(key)
+            if entry is not None and entry.in_use == 0:
+                await self._retire(key, entry)
+
+    async def evict_idle(self):
+        """Close every session that has been idle for longer than the idle timeout."""
+        now = time.monotonic()
+        expired = [
+            key for key, entry in self._sessions.items()
+            if entry.in_use == 0 and now - entry.last_used > self.idle_timeout
+        ]
+        for key in expired:
+            entry = self._sessions.get(key)
+            if entry is not None and entry.in_use == 0:
+                logger.info(f"Closing idle session for {key[0]}")
+                await self._retire(key, entry)
+
+    def _start_reaper(self):
+        if self._reaper is None or self._reaper.done():
+            self._reaper = asyncio.create_task(self._reap())
+
+    async def _reap(self):
+        while True:
+            await asyncio.sleep(max(self.idle_timeout / 4, 1.0))
+            await self.evict_idle()
+
+    async def _retire(self, key: Tuple[str, str], entry: _PooledSession):
+        """Remove a session from the pool, closing it once its last borrower is done."""
+        if self._sessions.get(key) is entry:
+            del self._sessions[key]
+        entry.retired = True
+        if entry.in_use == 0:
+            await self._shutdown(entry)
+
+    async def _shutdown(self, entry: _PooledSession):
+        # Stopping paho's network thread joins it, so keep that off the event loop
+        await asyncio.to_thread(entry.microscope.end_connection)
+
+    async def close_all(self):
+        """Close every pooled session."""
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+        for key, entry in list(self._sessions.items()):
+            await self._retire(key, entry)
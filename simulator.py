@@ -0,0 +1,546 @@
+import asyncio
+import base64
+import hashlib
+import io
+import itertools
+import json
+import math
+import logging
+import queue
+import random
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from paho.mqtt.client import topic_matches_sub
+from PIL import Image, ImageFilter
+
+from image_transport import encode_frame, preview_jpeg
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Encoded fields of view kept for repeated captures at the same place
+JPEG_CACHE_SIZE = 64
+# Border rendered around each field before blurring, so the blur has real neighbours at the edges
+BLUR_MARGIN = 32
+
+class LoopbackMessage:
+    def __init__(self, topic: str, payload: bytes, qos: int):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.properties = None
+
+class LoopbackMessageInfo:
+    """Stands in for paho's MQTTMessageInfo; loopback delivery is acknowledged immediately."""
+
+    rc = 0
+
+    def __init__(self, mid: int):
+        self.mid = mid
+
+    def wait_for_publish(self, timeout=None):
+        pass
+
+    def is_published(self) -> bool:
+        return True
+
+class LoopbackBroker:
+    """
+    In-process stand-in for the MQTT broker.
+
+    Routes every publish to the inboxes of the clients whose subscriptions
+    match, and counts the bytes that would have crossed the wire. Like a real
+    broker, it drops a connected client when another connects with its ID.
+    """
+
+    def __init__(self):
+        self._subscriptions: List[Tuple[str, "LoopbackClient"]] = []
+        self._clients: Dict[str, "LoopbackClient"] = {}
+        self._lock = threading.Lock()
+        self.messages = 0
+        self.bytes_published = 0
+
+    def connect(self, client: "LoopbackClient"):
+        with self._lock:
+            previous = self._clients.get(client.client_id)
+            self._clients[client.client_id] = client
+        if previous is not None and previous is not client:
+            logger.warning(f"Client ID {client.client_id} connected again; dropping the earlier connection")
+            previous.connected.clear()
+            self.unsubscribe_all(previous)
+
+    def disconnect(self, client: "LoopbackClient"):
+        with self._lock:
+            if self._clients.get(client.client_id) is client:
+                del self._clients[client.client_id]
+
+    def subscribe(self, topic: str, client: "LoopbackClient"):
+        with self._lock:
+            if (topic, client) not in self._subscriptions:
+                self._subscriptions.append((topic, client))
+
+    def unsubscribe_all(self, client: "LoopbackClient"):
+        with self._lock:
+            self._subscriptions = [(t, c) for t, c in self._subscriptions if c is not client]
+
+    def publish(self, topic: str, payload: bytes, qos: int):
+        with self._lock:
+            self.messages += 1
+            self.bytes_published += len(payload)
+            targets = {c for t, c in self._subscriptions if topic_matches_sub(t, topic)}
+        for client in targets:
+            client._inbox.put(LoopbackMessage(topic, payload, qos))
+
+class LoopbackClient:
+    """
+    MQTTClient look-alike that talks to a LoopbackBroker.
+
+    Like paho, each client delivers messages to its callbacks on its own
+    network thread, so the thread-crossing in MicroscopeDemo is exercised too.
+    """
+
+    _mids = itertools.count(1)
+
+    def __init__(self, broker: LoopbackBroker, client_id: Optional[str] = None):
+        self.broker = broker
+        self.client_id = client_id or f"loopback-{next(self._mids)}"
+        self.subscriptions = {}
+        self.connected = threading.Event()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._handlers: List[Tuple[str, callable]] = []
+        self._inbox: "queue.Queue[Optional[LoopbackMessage]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+
+    def connect(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name=f"{self.client_id}-network", daemon=True)
+            self._thread.start()
+        self.broker.connect(self)
+        self.connected.set()
+
+    connect_async = connect
+
+    def disconnect(self):
+        self.connected.clear()
+        self.broker.unsubscribe_all(self)
+        self.broker.disconnect(self)
+        if self._thread is not None:
+            self._inbox.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def is_connected(self) -> bool:
+        return self.connected.is_set()
+
+    def wait_for_connection(self, timeout=None) -> bool:
+        return self.connected.wait(timeout)
+
+    def subscribe(self, topic: str, qos: int = 1):
+        self.subscriptions[topic] = qos
+        self.broker.subscribe(topic, self)
+
+    def add_handler(self, topic: str, callback):
+        self._handlers.append((topic, callback))
+
+    def remove_handler(self, topic: str):
+        self._handlers = [(t, cb) for t, cb in self._handlers if t != topic]
+
+    def publish(self, topic: str, message, qos: int = 1) -> LoopbackMessageInfo:
+        payload = message.encode("utf-8") if isinstance(message, str) else bytes(message)
+        self.bytes_out += len(payload)
+        self.broker.publish(topic, payload, qos)
+        return LoopbackMessageInfo(next(self._mids))
+
+    async def publish_async(self, topic: str, message, qos: int = 1, timeout: float = 10) -> int:
+        return self.publish(topic, message, qos).mid
+
+    def on_message(self, client, userdata, message):
+        pass
+
+    def _loop(self):
+        while True:
+            message = self._inbox.get()
+            if message is None:
+                return
+            self.bytes_in += len(message.payload)
+            callbacks = [cb for t, cb in self._handlers if topic_matches_sub(t, message.topic)]
+            for callback in callbacks or [self.on_message]:
+                try:
+                    callback(self, None, message)
+                except Exception as e:
+                    logger.error(f"Error in callback for {message.topic}: {e}")
+
+class _Credit:
+    """Replies a stream may still send, topped up by the client's credit messages."""
+
+    def __init__(self, window: int):
+        self.available = window
+        self.cancelled = False
+        self._condition = threading.Condition()
+
+    def give(self, amount: int):
+        with self._condition:
+            self.available += amount
+            self._condition.notify_all()
+
+    def cancel(self):
+        with self._condition:
+            self.cancelled = True
+            self._condition.notify_all()
+
+    def take(self, timeout: float) -> bool:
+        """Wait for a credit and use it. False if the stream was cancelled or no credit came in time."""
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.available > 0 or self.cancelled, timeout):
+                return False
+            if self.cancelled:
+                return False
+            self.available -= 1
+            return True
+
+class SimulatedMicroscope:
+    """
+    A fake microscope answering MicroscopeDemo commands over a LoopbackBroker.
+
+    Supports move, focus, get_pos, take_image (including "not modified"
+    answers to cached etags), scan and batch, in both the JSON and binary image
+    formats, at full or preview resolution and with streamed scans, with
+    configurable latency and image size. Streams follow the credit protocol:
+    no more than the command's ``window`` replies are sent ahead of the
+    client's credits, and a cancel stops them. Images larger than
+    ``max_chunk`` bytes are sent in chunks, optionally out of order.
+    """
+
+    _samples: Dict[tuple, Image.Image] = {}
+    _samples_lock = threading.Lock()
+
+    def __init__(
+        self,
+        broker: LoopbackBroker,
+        name: str = "microscope",
+        latency: float = 0.05,
+        focus_latency: float = 0.5,
+        image_size: Tuple[int, int] = (1640, 1232),
+        quality: int = 85,
+        workers: int = 1,
+        focal_plane: int = 0,
+        depth_of_field: float = 100.0,
+        sample_region: Optional[Tuple[int, int, int, int]] = None,
+        max_chunk: Optional[int] = None,
+        shuffle_chunks: bool = False,
+        credit_timeout: float = 30.0,
+        sample_size: Tuple[int, int] = (2048, 2048),
+    ):
+        """
+        Initialize the simulated microscope.
+
+        Args:
+            broker (LoopbackBroker): Broker to listen on.
+            name (str, optional): Microscope identifier used in topics. Defaults to "microscope".
+            latency (float, optional): Seconds spent handling each command. Defaults to 0.05.
+            focus_latency (float, optional): Seconds spent on each autofocus. Defaults to 0.5.
+            image_size (Tuple[int, int], optional): Captured image size. Defaults to (1640, 1232).
+            quality (int, optional): JPEG quality of captured images. Defaults to 85.
+            workers (int, optional): Commands handled at once. A real stage is 1. Defaults to 1.
+            focal_plane (int, optional): Stage z at which the sample is sharp. Defaults to 0.
+            depth_of_field (float, optional): z steps per pixel of blur away from the focal plane. Defaults to 100.
+            sample_region (Optional[Tuple[int, int, int, int]], optional): Stage area (x1, y1, x2, y2) holding the
+                sample; fields of view outside it show blank background. Defaults to None (sample everywhere).
+            max_chunk (Optional[int], optional): Largest image part sent in one message; larger images are split
+                into chunks. Defaults to None (never split).
+            shuffle_chunks (bool, optional): Send the chunks of an image in random order. Defaults to False.
+            credit_timeout (float, optional): Seconds a stream waits for credit before giving up. Defaults to 30.
+            sample_size (Tuple[int, int], optional): Stage steps the generated sample spans before it repeats.
+                Defaults to (2048, 2048).
+        """
+        self.name = name
+        self.latency = latency
+        self.focus_latency = focus_latency
+        self.image_size = image_size
+        self.quality = quality
+        self.focal_plane = focal_plane
+        self.depth_of_field = depth_of_field
+        self.sample_region = sample_region
+        self.max_chunk = max_chunk
+        self.shuffle_chunks = shuffle_chunks
+        self.credit_timeout = credit_timeout
+        self.sample_size = sample_size
+        self._credits: Dict[str, _Credit] = {}
+        self._random = random.Random(0)
+        self.position = {"x": 0, "y": 0, "z": 0}
+        self.commands = 0
+        self._sample: Optional[Image.Image] = None
+        self._jpegs: "OrderedDict[tuple, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"{name}-device")
+        self.client = LoopbackClient(broker, f"{name}-device")
+        self.client.add_handler(f"{name}/command", self._on_command)
+        self.client.subscribe(f"{name}/command")
+        self.client.connect()
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self.client.disconnect()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def blank(self, pos: Optional[Dict[str, int]] = None) -> bool:
+        """True if the field of view at ``pos`` (by default the current one) misses the sample region."""
+        if self.sample_region is None:
+            return False
+        pos = pos or self.position
+        # One stage step moves the image by one pixel
+        half_width, half_height = self.image_size[0] / 2, self.image_size[1] / 2
+        x1, y1, x2, y2 = self.sample_region
+        return (
+            pos["x"] + half_width < min(x1, x2) or pos["x"] - half_width > max(x1, x2)
+            or pos["y"] + half_height < min(y1, y2) or pos["y"] - half_height > max(y1, y2)
+        )
+
+    def jpeg(
+        self,
+        resolution: str = "full",
+        z: Optional[int] = None,
+        blank: bool = False,
+        pos: Optional[Dict[str, int]] = None,
+    ) -> bytes:
+        """
+        Encoded frame captured at stage position ``pos`` and height ``z`` (by default the current ones).
+
+        Each field of view is the crop of one large sample centred on the
+        stage position, one stage step to a pixel, so overlapping fields share
+        content and can be registered. The sample is textured noise, so it
+        compresses like a real one, and is blurred the further z is from the
+        focal plane. Blank frames are an even background with faint sensor noise.
+        """
+        if blank:
+            return self._cached(("blank", resolution), lambda: self._encode(
+                Image.effect_noise(self.image_size, 2).point(lambda v: v + 72), resolution
+            ))
+        pos = pos or self.position
+        z = pos.get("z", self.position["z"]) if z is None else z
+        blur = min(round(abs(z - self.focal_plane) / self.depth_of_field * 4) / 4, 10.0)
+        left = (pos["x"] - self.image_size[0] // 2) % self.sample_size[0]
+        top = (pos["y"] - self.image_size[1] // 2) % self.sample_size[1]
+        return self._cached(("sample", resolution, blur, left, top), lambda: self._encode(
+            self._field(left, top, blur), resolution
+        ))
+
+    def _cached(self, key: tuple, render) -> bytes:
+        with self._lock:
+            if key in self._jpegs:
+                self._jpegs.move_to_end(key)
+                return self._jpegs[key]
+        jpeg = render()
+        with self._lock:
+            self._jpegs[key] = jpeg
+            if len(self._jpegs) > JPEG_CACHE_SIZE:
+                self._jpegs.popitem(last=False)
+        return jpeg
+
+    def _encode(self, gray: Image.Image, resolution: str) -> bytes:
+        buffer = io.BytesIO()
+        Image.merge("RGB", (gray, gray, gray)).save(buffer, format="JPEG", quality=self.quality)
+        return preview_jpeg(buffer.getvalue()) if resolution == "preview" else buffer.getvalue()
+
+    def _field(self, left: int, top: int, blur: float) -> Image.Image:
+        """The field of view with its top-left corner at (left, top) on the sample."""
+        with self._samples_lock:
+            if self._sample is None:
+                # Generating one takes a while, so simulators of the same size share it
+                key = (self.sample_size, self.image_size)
+                if key not in self._samples:
+                    self._samples[key] = self._generate_sample()
+                self._sample = self._samples[key]
+        width, height = self.image_size
+        m = BLUR_MARGIN
+        field = self._sample.crop((left, top, left + width + 2 * m, top + height + 2 * m))
+        # Defocus adds to the sample's own softness of 2 pixels
+        field = field.filter(ImageFilter.GaussianBlur(math.hypot(2, blur)))
+        return field.crop((m, m, m + width, m + height))
+
+    def _generate_sample(self) -> Image.Image:
+        """
+        Noise with coarse structure as well as fine grain, so fields still register once downsampled.
+
+        It is tiled past its edges by a field of view and the blur margin, so
+        every crop is a plain slice even where the sample wraps around.
+        """
+        width, height = self.sample_size
+        coarse = Image.effect_noise((max(width // 8, 1), max(height // 8, 1)), 64)
+        coarse = coarse.resize((width, height), Image.BICUBIC)
+        base = Image.blend(coarse, Image.effect_noise((width, height), 64), 0.5)
+        padded_width = width + self.image_size[0] + 2 * BLUR_MARGIN
+        padded_height = height + self.image_size[1] + 2 * BLUR_MARGIN
+        sample = Image.new("L", (padded_width, padded_height))
+        for x in range(0, padded_width, width):
+            for y in range(0, padded_height, height):
+                sample.paste(base, (x, y))
+        return sample
+
+    def _on_command(self, client, userdata, message):
+        try:
+            command = json.loads(message.payload)
+        except ValueError:
+            logger.error(f"Simulator got malformed command on {message.topic}")
+            return
+        name, request_id = command.get("command"), command.get("request_id")
+        if name in ("credit", "cancel"):
+            # Handled on arrival, as the stream they are for is keeping a worker busy
+            credit = self._credits.get(request_id)
+            if credit is not None and name == "credit":
+                credit.give(int(command.get("credit", 1)))
+            elif credit is not None:
+                credit.cancel()
+            return
+        if command.get("stream"):
+            # Registered before queueing, so credit sent while the command waits for a worker is not lost
+            self._credits[request_id] = _Credit(int(command.get("window", 4)))
+        self._executor.submit(self._handle, command)
+
+    def _take_credit(self, request_id: str) -> bool:
+        credit = self._credits.get(request_id)
+        if credit is None:
+            return True
+        if credit.take(self.credit_timeout):
+            return True
+        if not credit.cancelled:
+            logger.warning(f"Simulator stream {request_id} got no credit for {self.credit_timeout}s; stopping")
+        return False
+
+    def _reply(self, payload: Dict):
+        self.client.publish(f"{self.name}/return", json.dumps(payload), qos=2)
+
+    def _send_image(self, command: Dict, metadata: Dict):
+        jpeg = self.jpeg(command.get("resolution", "full"), blank=self.blank())
+        size = self.max_chunk or len(jpeg)
+        parts = [jpeg[start:start + size] for start in range(0, len(jpeg), size)]
+        order = list(range(len(parts)))
+        if self.shuffle_chunks:
+            self._random.shuffle(order)
+        for k in order:
+            part_metadata = metadata if len(parts) == 1 else {**metadata, "chunk": k, "chunks": len(parts)}
+            if command.get("binary"):
+                self.client.publish(f"{self.name}/return/image", encode_frame(part_metadata, parts[k]), qos=1)
+            else:
+                self._reply({**part_metadata, "image": base64.b64encode(parts[k]).decode("ascii")})
+
+    def _handle(self, command: Dict):
+        self.commands += 1
+        request_id = command.get("request_id")
+        name = command.get("command")
+        try:
+            handler = getattr(self, f"_do_{name}")
+        except AttributeError:
+            self._reply({"request_id": request_id, "error": f"Unknown command {name}"})
+            return
+        try:
+            handler(command, {"request_id": request_id})
+        except Exception as e:
+            logger.error(f"Simulator failed on {name}: {e}")
+            self._reply({"request_id": request_id, "error": str(e)})
+        finally:
+            self._credits.pop(request_id, None)
+
+    # Handlers get the command and the metadata (request ID, and step for batches) their replies carry
+    def _do_move(self, command: Dict, meta: Dict):
+        time.sleep(self.latency)
+        for axis in ("x", "y", "z"):
+            value = command.get(axis)
+            if value is not None:
+                self.position[axis] = self.position[axis] + value if command.get("relative") else value
+        self._reply({**meta, "pos": dict(self.position)})
+
+    def _do_focus(self, command: Dict, meta: Dict):
+        time.sleep(self.focus_latency)
+        self.position["z"] = self.focal_plane
+        self._reply({**meta, "pos": dict(self.position)})
+
+    def _do_get_pos(self, command: Dict, meta: Dict):
+        time.sleep(self.latency)
+        self._reply({**meta, "pos": dict(self.position)})
+
+    def etag(self, command: Dict) -> str:
+        """Identifies the frame a capture would return: the stage position and the camera settings."""
+        settings = {k: v for k, v in command.items() if k not in ("command", "request_id", "binary", "if_none_match")}
+        state = json.dumps([self.position, settings, self.image_size, self.quality, self.focal_plane], sort_keys=True)
+        return hashlib.sha1(state.encode("utf-8")).hexdigest()
+
+    def _do_take_image(self, command: Dict, meta: Dict):
+        time.sleep(self.latency)
+        etag = self.etag(command)
+        metadata = {**meta, "pos": dict(self.position), "etag": etag}
+        if etag in (command.get("if_none_match") or []):
+            self._reply({**metadata, "not_modified": True})
+        else:
+            self._send_image(command, metadata)
+
+    def scan_positions(self, c1, c2, ov: int) -> List[Dict[str, int]]:
+        """Raster positions between two corners, one field of view minus the overlap apart."""
+        step = max(self.image_size[0] - ov, 1)
+        (x1, y1), (x2, y2) = c1[:2], c2[:2]
+        xs = range(min(x1, x2), max(x1, x2) + 1, step)
+        ys = range(min(y1, y2), max(y1, y2) + 1, step)
+        return [{"x": x, "y": y, "z": self.position["z"]} for y in ys for x in xs]
+
+    def _do_scan(self, command: Dict, meta: Dict):
+        request_id = meta["request_id"]
+        positions = self.scan_positions(command["c1"], command["c2"], command.get("ov", 1200))
+        if not command.get("stream"):
+            images = []
+            for pos in positions:
+                time.sleep(self.latency)
+                self.position.update(pos)
+                images.append(base64.b64encode(self.jpeg(command.get("resolution", "full"))).decode("ascii"))
+            self._reply({"request_id": request_id, "images": images})
+            return
+        for index, pos in enumerate(positions):
+            if not self._take_credit(request_id):
+                return
+            time.sleep(self.latency)
+            self.position.update(pos)
+            self._send_image(command, {"request_id": request_id, "index": index, "pos": pos})
+        self._reply({"request_id": request_id, "done": True, "count": len(positions)})
+
+    def _do_batch(self, command: Dict, meta: Dict):
+        # Image options of the batch apply to every capture in it, whatever a step says
+        options = {"binary": command.get("binary", False), "resolution": command.get("resolution", "full")}
+        sent = 0
+        for index, step in enumerate(command.get("steps", [])):
+            name = step.get("command")
+            step_meta = {**meta, "step": index, "command": name}
+            if not self._take_credit(meta["request_id"]):
+                return
+            sent += 1
+            try:
+                if name not in ("move", "focus", "get_pos", "take_image"):
+                    raise ValueError(f"{name} cannot run in a batch")
+                getattr(self, f"_do_{name}")({**step, **options}, step_meta)
+            except Exception as e:
+                self._reply({**step_meta, "error": str(e)})
+                if command.get("stop_on_error", True):
+                    break
+        self._reply({**meta, "done": True, "count": sent})
+
+async def main():
+    from microscope_demo_client import MicroscopeDemo
+
+    broker = LoopbackBroker()
+    client = LoopbackClient(broker)
+    client.connect()
+    with SimulatedMicroscope(broker, latency=0.01, focus_latency=0.1) as device:
+        async with MicroscopeDemo("loopback", 0, "user", "key", device.name, client=client) as microscope:
+            position, image = await asyncio.gather(microscope.get_pos(), microscope.take_image())
+            print(f"Position: {position}, image size: {image.size}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
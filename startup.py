@@ -0,0 +1,31 @@
+import logging
+import os
+import time
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+STARTUP_BUDGET = float(os.getenv("STARTUP_BUDGET_SECONDS", 5))
+
+_started = time.perf_counter()
+_last = _started
+_stages = []
+
+def checkpoint(stage):
+    """Record the time spent since the previous checkpoint (or since this module was imported) under ``stage``."""
+    global _last
+    now = time.perf_counter()
+    _stages.append((stage, now - _last))
+    _last = now
+
+def report(budget=STARTUP_BUDGET):
+    """Log each recorded stage and the total startup time against the budget."""
+    total = _last - _started
+    lines = [f"{stage:<30} {seconds * 1000:8.1f} ms" for stage, seconds in _stages]
+    lines.append(f"{'total':<30} {total * 1000:8.1f} ms (budget {budget * 1000:.0f} ms)")
+    text = "\n".join(lines)
+    if total > budget:
+        logger.warning(f"Startup over budget:\n{text}")
+    else:
+        logger.info(f"Startup timings:\n{text}")
+    return text
@@ -0,0 +1,246 @@
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image
+
+from image_transport import Tile, exif_stage_position
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def phase_correlation(a: np.ndarray, b: np.ndarray) -> Tuple[int, int, float]:
+    """
+    Estimate the translation between two equally sized grayscale images.
+
+    Args:
+        a (np.ndarray): Reference image.
+        b (np.ndarray): Moving image.
+
+    Returns:
+        Tuple[int, int, float]: (dy, dx, peak) where b's origin sits at (dy, dx)
+        in a's frame, modulo the image size, and peak is the correlation peak height.
+    """
+    # No apodisation window: between scan tiles the shared content sits at the edges a window would suppress
+    fa = np.fft.rfft2(a - a.mean())
+    fb = np.fft.rfft2(b - b.mean())
+    cross = fa * np.conj(fb)
+    cross /= np.abs(cross) + 1e-9
+    correlation = np.fft.irfft2(cross, s=a.shape)
+    dy, dx = np.unravel_index(np.argmax(correlation), correlation.shape)
+    return int(dy), int(dx), float(correlation[dy, dx])
+
+def _overlap_score(a: np.ndarray, b: np.ndarray, dy: int, dx: int) -> float:
+    """Normalised cross-correlation of the region where b overlaps a when placed at (dy, dx)."""
+    h, w = a.shape
+    if abs(dy) >= h or abs(dx) >= w:
+        return -1.0
+    region_a = a[max(dy, 0):h + min(dy, 0), max(dx, 0):w + min(dx, 0)]
+    region_b = b[max(-dy, 0):h + min(-dy, 0), max(-dx, 0):w + min(-dx, 0)]
+    # Slivers of a few pixels correlate well by chance, so require a real overlap
+    if region_a.size < 0.02 * a.size:
+        return -1.0
+    region_a = region_a - region_a.mean()
+    region_b = region_b - region_b.mean()
+    norm = np.sqrt((region_a * region_a).sum() * (region_b * region_b).sum())
+    return float((region_a * region_b).sum() / norm) if norm > 0 else -1.0
+
+def register_pair(a: np.ndarray, b: np.ndarray) -> Tuple[int, int, float]:
+    """
+    Find the offset of image b relative to image a.
+
+    Phase correlation only gives the shift modulo the image size, so each of
+    the four wrap-around candidates is checked against the pixels it overlaps.
+
+    Returns:
+        Tuple[int, int, float]: (dy, dx, score) with score the overlap correlation in [-1, 1].
+    """
+    dy, dx, _ = phase_correlation(a, b)
+    h, w = a.shape
+    candidates = [(y, x) for y in (dy, dy - h) for x in (dx, dx - w)]
+    scores = [_overlap_score(a, b, y, x) for y, x in candidates]
+    best = int(np.argmax(scores))
+    return candidates[best][0], candidates[best][1], scores[best]
+
+def _register_pairs(arrays: Sequence[np.ndarray], pairs: Sequence[Tuple[int, int]], workers: Optional[int]):
+    if workers == 1 or len(pairs) < 2:
+        return [register_pair(arrays[i], arrays[j]) for i, j in pairs]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(register_pair, [arrays[i] for i, _ in pairs], [arrays[j] for _, j in pairs]))
+
+def neighbour_pairs(stage: np.ndarray, tolerance: float = 1.5) -> List[Tuple[int, int]]:
+    """Pair each tile with the tiles no further than ``tolerance`` times its nearest neighbour."""
+    distances = np.linalg.norm(stage[:, None, :] - stage[None, :, :], axis=-1)
+    np.fill_diagonal(distances, np.inf)
+    nearest = distances.min(axis=1)
+    pairs = []
+    for i in range(len(stage)):
+        for j in range(i + 1, len(stage)):
+            if distances[i, j] <= tolerance * min(nearest[i], nearest[j]):
+                pairs.append((i, j))
+    return pairs
+
+def _stage_positions(tiles: Sequence[Tile]) -> np.ndarray:
+    """Stage positions as (y, x), taken from the EXIF metadata for tiles that arrived without one."""
+    positions = []
+    for tile in tiles:
+        pos = tile.pos if tile.pos is not None else exif_stage_position(tile.data)
+        if pos is None:
+            raise ValueError(f"Tile {tile.index} has no stage position, in its reply or its EXIF")
+        positions.append([pos["y"], pos["x"]])
+    return np.array(positions, dtype=np.float64)
+
+def solve_positions(
+    stage: np.ndarray,
+    pairs: Sequence[Tuple[int, int]],
+    shifts: Sequence[Tuple[float, float, float]],
+    pixels_per_step: Optional[float] = None,
+    min_score: float = 0.2,
+) -> np.ndarray:
+    """
+    Turn stage coordinates and pairwise image offsets into global pixel positions.
+
+    A 2x2 matrix mapping stage steps to pixels is fitted from the reliable pairs
+    (so camera rotation and axis flips are handled) unless ``pixels_per_step``
+    is given. Positions are then solved in a least-squares sense, with the
+    stage-derived placement as a weak prior that also anchors tiles without a
+    reliable neighbour.
+
+    Args:
+        stage (np.ndarray): (n, 2) stage positions as (y, x).
+        pairs (Sequence[Tuple[int, int]]): Neighbouring tile indices.
+        shifts (Sequence[Tuple[float, float, float]]): (dy, dx, score) pixel offset of each pair.
+        pixels_per_step (Optional[float], optional): Fixed stage-to-pixel scale. Defaults to fitting it.
+        min_score (float, optional): Overlap correlation below which a pair is ignored. Defaults to 0.2.
+
+    Returns:
+        np.ndarray: (n, 2) pixel positions as (y, x), with the top-left tile at the origin.
+    """
+    good = [(i, j, dy, dx, score) for (i, j), (dy, dx, score) in zip(pairs, shifts) if score >= min_score]
+    if pixels_per_step is not None:
+        transform = np.eye(2) * pixels_per_step
+    else:
+        if len(good) < 2:
+            raise ValueError("Not enough overlapping tiles to calibrate stage steps to pixels; pass pixels_per_step")
+        stage_deltas = np.array([stage[j] - stage[i] for i, j, *_ in good])
+        pixel_deltas = np.array([[dy, dx] for _, _, dy, dx, _ in good])
+        solution, _, rank, _ = np.linalg.lstsq(stage_deltas, pixel_deltas, rcond=None)
+        if rank < 2:
+            # Only a single row or column of tiles: assume square pixels with no rotation
+            scale = np.median(np.linalg.norm(pixel_deltas, axis=1) / np.linalg.norm(stage_deltas, axis=1))
+            transform = np.eye(2) * scale
+        else:
+            transform = solution.T
+    predicted = stage @ transform.T
+
+    n = len(stage)
+    prior_weight = 0.05
+    rows = len(good) + n
+    design = np.zeros((rows, n))
+    targets = np.zeros((rows, 2))
+    for row, (i, j, dy, dx, score) in enumerate(good):
+        design[row, i], design[row, j] = -score, score
+        targets[row] = (dy * score, dx * score)
+    for k in range(n):
+        design[len(good) + k, k] = prior_weight
+        targets[len(good) + k] = predicted[k] * prior_weight
+    positions, *_ = np.linalg.lstsq(design, targets, rcond=None)
+    return positions - positions.min(axis=0)
+
+def compose(tiles: Sequence[Tile], positions: np.ndarray) -> Image.Image:
+    """
+    Paste tiles onto a canvas at their pixel positions.
+
+    Tiles are decoded one at a time, but the whole canvas is held in memory,
+    so this suits scans that fit in RAM. For tiled output, where the stitched
+    image is never held whole, use stitch_to_pyramid.
+    """
+    origins = np.rint(positions).astype(int)
+    width, height = tiles[0].image.size
+    canvas = Image.new("RGB", (int(origins[:, 1].max()) + width, int(origins[:, 0].max()) + height))
+    for tile, (y, x) in zip(tiles, origins):
+        with tile.image as image:
+            canvas.paste(image.convert("RGB"), (int(x), int(y)))
+    return canvas
+
+def stitch_positions(
+    tiles: Sequence[Tile],
+    pixels_per_step: Optional[float] = None,
+    downsample: int = 4,
+    workers: Optional[int] = None,
+) -> np.ndarray:
+    """
+    Work out where each tile goes in the stitched image.
+
+    Tiles are first placed by stage coordinates. Neighbouring tiles are then
+    registered by phase correlation on downsampled copies across a process
+    pool, and the pairwise offsets are combined into global positions.
+
+    Args:
+        tiles (Sequence[Tile]): Tiles with stage positions, e.g. from MicroscopeDemo.scan_iter.
+        pixels_per_step (Optional[float], optional): Stage-to-pixel scale. Defaults to fitting it from the overlaps.
+        downsample (int, optional): Reduction factor used for registration. Defaults to 4.
+        workers (Optional[int], optional): Registration processes; 1 runs in-process. Defaults to the CPU count.
+
+    Returns:
+        np.ndarray: (n, 2) pixel positions as (y, x), with the top-left tile at the origin.
+    """
+    if not tiles:
+        raise ValueError("Nothing to stitch")
+    stage = _stage_positions(tiles)
+    if len(tiles) == 1:
+        return np.zeros((1, 2))
+
+    arrays = []
+    for tile in tiles:
+        with tile.image as image:
+            full_width = image.width
+            # draft() lets the JPEG decoder scale down by DCT, far cheaper than a full decode and resize
+            image.draft("L", (image.width // downsample, image.height // downsample))
+            gray = image.convert("L")
+            gray = gray.reduce(max(gray.width * downsample // full_width, 1))
+            arrays.append(np.asarray(gray, dtype=np.float32))
+    scale = full_width / arrays[0].shape[1]
+
+    pairs = neighbour_pairs(stage)
+    shifts = [(dy * scale, dx * scale, score) for dy, dx, score in _register_pairs(arrays, pairs, workers)]
+    logger.info(f"Registered {len(pairs)} tile pairs")
+    return solve_positions(stage, pairs, shifts, pixels_per_step)
+
+def stitch(tiles: Sequence[Tile], **kwargs) -> Image.Image:
+    """
+    Stitch scan tiles held in memory into a single image.
+
+    Keyword arguments are passed on to stitch_positions.
+
+    Returns:
+        Image.Image: Stitched image.
+    """
+    return compose(tiles, stitch_positions(tiles, **kwargs))
+
+def stitch_to_file(tiles: Sequence[Tile], output: str, **kwargs) -> str:
+    """
+    Stitch tiles and save the result as a single JPEG. Returns the output path.
+
+    The image is composed whole before it is saved; stitch_to_pyramid is the
+    tiled writer for scans too large for that.
+    """
+    directory = os.path.dirname(output)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    stitch(tiles, **kwargs).save(output, format="JPEG", quality=90)
+    return output
+
+def stitch_to_pyramid(tiles: Sequence[Tile], directory: str, name: str, **kwargs) -> str:
+    """
+    Stitch tiles into a DeepZoom pyramid rather than one large image; see pyramid.PyramidBuilder.
+
+    The stitched image is never held whole: tiles are pasted onto pyramid
+    tiles that are written as soon as they are complete. Keyword arguments
+    are passed on to stitch_positions. Returns the path of the .dzi file.
+    """
+    from pyramid import build_pyramid
+
+    return build_pyramid(tiles, stitch_positions(tiles, **kwargs), directory, name)
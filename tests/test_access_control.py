@@ -0,0 +1,83 @@
+import time
+
+import pytest
+
+import access_control
+from access_control import KeyRegistry
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A simulated clock for the registry, moved forward by the test."""
+    now = [1000.0]
+    monkeypatch.setattr(access_control.time, "time", lambda: now[0])
+    return now
+
+def test_keys_issued_in_the_same_second_are_distinct(clock):
+    registry = KeyRegistry()
+    keys = [registry.issue("microscope", 60) for _ in range(1000)]
+    assert len(set(keys)) == 1000
+    assert all(registry.validate(key) == "microscope" for key in keys)
+
+def test_check_access(clock, monkeypatch):
+    monkeypatch.setattr(access_control, "registry", KeyRegistry())
+    key = access_control.generate_temp_key("microscope", duration=60)
+    assert access_control.check_access(key, "microscope")
+    assert not access_control.check_access(key, "microscope2")
+    assert not access_control.check_access("temp_microscope_guess", "microscope")
+    clock[0] += 60
+    assert not access_control.check_access(key, "microscope")
+
+def test_expired_key_is_removed_on_validation(clock):
+    registry = KeyRegistry()
+    key = registry.issue("microscope", 30)
+    clock[0] += 29
+    assert registry.validate(key) == "microscope"
+    clock[0] += 1
+    assert registry.validate(key) is None
+    assert len(registry) == 0
+
+def test_keys_for_device(clock):
+    registry = KeyRegistry()
+    short = registry.issue("microscope", 10)
+    long = registry.issue("microscope", 100)
+    other = registry.issue("microscope2", 100)
+    assert sorted(registry.keys_for("microscope")) == sorted([short, long])
+    clock[0] += 10
+    assert registry.keys_for("microscope") == [long]
+    assert registry.keys_for("microscope2") == [other]
+    assert registry.keys_for("microscope3") == []
+
+def test_unused_keys_do_not_accumulate(clock):
+    """A day of keys that are never checked again, one every 17 seconds, each valid for 30 minutes."""
+    registry = KeyRegistry()
+    peak = 0
+    for _ in range(24 * 3600 // 17):
+        registry.issue("microscope", 1800)
+        peak = max(peak, len(registry), len(registry._expiry))
+        clock[0] += 17
+    assert peak <= 1800 // 17 + 1
+    clock[0] += 1800
+    assert registry.sweep() == 1800 // 17 + 1
+    assert len(registry) == 0
+    assert not registry._by_device
+
+def test_revoked_keys_do_not_grow_the_heap(clock):
+    registry = KeyRegistry()
+    for _ in range(1000):
+        registry.revoke(registry.issue("microscope", 3600))
+    assert len(registry) == 0
+    assert len(registry._expiry) <= 65
+
+def test_background_sweeper():
+    registry = KeyRegistry()
+    for _ in range(100):
+        registry.issue("microscope", 0.2)
+    assert len(registry) == 100
+    registry.start_sweeper(interval=0.01)
+    try:
+        deadline = time.monotonic() + 5
+        while len(registry) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert len(registry) == 0
+    finally:
+        registry.stop_sweeper()
@@ -0,0 +1,115 @@
+import logging
+from datetime import datetime, timedelta, timezone
+
+from key_request import InMemoryCollection, KeyStore, _document_value
+
+class _CountingCollection(InMemoryCollection):
+    def __init__(self):
+        super().__init__()
+        self.lookups = 0
+
+    def find_one(self, query):
+        self.lookups += 1
+        return super().find_one(query)
+
+class _IndexlessCollection(InMemoryCollection):
+    """A collection whose user may not create indexes."""
+
+    def __init__(self):
+        super().__init__()
+        self.attempts = 0
+
+    def create_index(self, keys, **kwargs):
+        self.attempts += 1
+        raise PermissionError("not authorized to create indexes")
+
+def _key(key, seconds):
+    expiration = datetime.now(timezone.utc) + timedelta(seconds=seconds)
+    return {"key": key, "expiration": expiration}, expiration
+
+def test_indexes_created_once():
+    collection = InMemoryCollection()
+    store = KeyStore(collection)
+    store.set("a", 1)
+    store.get("b")
+    assert collection.indexes == [("variable_name", {"unique": True}), ("expires_at", {"expireAfterSeconds": 0})]
+
+def test_reads_are_cached():
+    collection = _CountingCollection()
+    store = KeyStore(collection)
+    store.set("microscope_key", {"key": "abc"})
+    for _ in range(10):
+        assert store.get("microscope_key") == {"key": "abc"}
+    assert collection.lookups == 0
+
+    store = KeyStore(collection, cache_ttl=0)
+    store.get("microscope_key")
+    store.get("microscope_key")
+    assert collection.lookups == 2
+
+def test_prefetch_fills_cache():
+    collection = _CountingCollection()
+    KeyStore(collection).set("a_key", 1)
+    store = KeyStore(collection)
+    store.prefetch(["a_key", "b_key"])
+    assert (store.get("a_key"), store.get("b_key")) == (1, None)
+    assert collection.lookups == 0
+
+def test_validate_key():
+    store = KeyStore(InMemoryCollection())
+    value, expires_at = _key("secret", 60)
+    store.set("microscope_key", value, expires_at)
+    assert store.validate_key("microscope", "secret")
+    assert not store.validate_key("microscope", "guess")
+    assert not store.validate_key("microscope", "")
+    assert not store.validate_key("microscope2", "secret")
+
+def test_expired_key_is_rejected_before_ttl_removes_it():
+    store = KeyStore(InMemoryCollection())
+    value, _ = _key("secret", -1)
+    # Still stored, as the TTL monitor has not run yet
+    store.set("microscope_key", value)
+    assert not store.validate_key("microscope", "secret")
+
+def test_ttl_expiry_removes_key():
+    collection = InMemoryCollection()
+    value, expires_at = _key("secret", -1)
+    KeyStore(collection).set("microscope_key", value, expires_at)
+    store = KeyStore(collection)
+    assert store.get("microscope_key") is None
+    assert not store.validate_key("microscope", "secret")
+
+def test_legacy_naive_local_expiration():
+    local = datetime.now().replace(microsecond=0) + timedelta(minutes=3)
+    value = _document_value({"variable_name": "microscope_key", "value": {"key": "k", "expiration": local}})
+    assert value["expiration"].tzinfo is not None
+    assert value["expiration"] == local.astimezone(timezone.utc)
+    assert value["expiration"].timestamp() == local.timestamp()
+
+    # Documents written by KeyStore are stored naive in UTC by pymongo and left as they are
+    utc = datetime.now(timezone.utc).replace(tzinfo=None)
+    document = {"variable_name": "microscope_key", "value": {"key": "k", "expiration": utc}, "expires_at": utc}
+    assert _document_value(document)["expiration"] is utc
+
+def test_legacy_key_validates():
+    collection = InMemoryCollection()
+    local = datetime.now() + timedelta(minutes=3)
+    collection.update_one({"variable_name": "microscope_key"}, {"$set": {"value": {"key": "k", "expiration": local}}}, upsert=True)
+    assert KeyStore(collection).validate_key("microscope", "k")
+
+def test_index_failure_backs_off(caplog, monkeypatch):
+    collection = _IndexlessCollection()
+    store = KeyStore(collection, index_retry=60)
+    now = [1000.0]
+    monkeypatch.setattr("key_request.time.monotonic", lambda: now[0])
+    with caplog.at_level(logging.ERROR, logger="key_request"):
+        for _ in range(5):
+            store.set("a", 1)
+            store.get("a")
+        assert collection.attempts == 1
+        now[0] += 61
+        store.get("a")
+        assert collection.attempts == 2
+    assert len([r for r in caplog.records if "indexes" in r.getMessage()]) == 1
+    # Lookups still work without the indexes
+    assert store.get("a") == 1
@@ -0,0 +1,15 @@
+from metrics import Counter, Histogram
+
+def test_label_values_are_escaped():
+    counter = Counter("errors_total", "Errors by message", ["message"])
+    counter.inc(message='path "C:\\scans"\nnot found')
+    assert counter.render().splitlines()[-1] == 'errors_total{message="path \\"C:\\\\scans\\"\\nnot found"} 1'
+
+def test_help_text_is_escaped():
+    counter = Counter("scans_total", "Scans\nsee C:\\docs")
+    assert counter.render().splitlines()[0] == "# HELP scans_total Scans\\nsee C:\\\\docs"
+
+def test_histogram_labels_are_escaped():
+    histogram = Histogram("latency_seconds", "Latency", ["device"], buckets=(1,))
+    histogram.observe(0.5, device='a"b')
+    assert 'latency_seconds_bucket{device="a\\"b",le="1"} 1' in histogram.render().splitlines()
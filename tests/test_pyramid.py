@@ -0,0 +1,66 @@
+import io
+import os
+
+import numpy as np
+from PIL import Image
+
+from image_transport import Tile
+from pyramid import PyramidBuilder, TileServer, build_pyramid
+from stitching import compose
+
+RED, GREEN, BLUE, YELLOW = (220, 30, 30), (30, 200, 30), (30, 30, 220), (230, 220, 30)
+
+def _solid(colour, size=(200, 150)):
+    image = Image.new("RGB", size, colour)
+    data = io.BytesIO()
+    image.save(data, format="JPEG", quality=95)
+    return data.getvalue()
+
+def _level(directory, name, level=None):
+    """A whole pyramid level drawn from its tile files."""
+    server = TileServer(directory)
+    info = server.info(name)
+    level = info.top if level is None else level
+    width, height = info.level_size(level)
+    scale = 2 ** (info.top - level)
+    return np.asarray(server.view(name, level, width * scale / 2, height * scale / 2, width, height), dtype=int)
+
+def _mismatch(a, b):
+    """Fraction of pixels that differ by more than JPEG noise along colour edges."""
+    return (np.abs(a - b).max(axis=-1) > 60).mean()
+
+def test_overlaps_match_compose(tmp_path):
+    # Later tiles cover earlier ones, also where that is not top-to-bottom order
+    tiles = [Tile(i, None, _solid(colour)) for i, colour in enumerate([RED, GREEN, BLUE, YELLOW])]
+    positions = np.array([[0, 0], [100, 120], [0, 150], [60, 40]])
+    expected = np.asarray(compose(tiles, positions), dtype=int)
+    path = build_pyramid(tiles, positions, str(tmp_path), "scan", tile_size=64, quality=95)
+    assert os.path.exists(path)
+    assert _mismatch(_level(str(tmp_path), "scan"), expected) < 0.01
+
+def test_reserved_tiles_are_written_once(tmp_path):
+    builder = PyramidBuilder(str(tmp_path), "scan", 128, 128, tile_size=64)
+    builder.reserve(0, 0, 128, 128)
+    builder.reserve(32, 32, 64, 64)
+    builder.add(Image.new("RGB", (128, 128), RED), 0, 0)
+    # Covered, but held for the second image
+    assert builder.tiles_written == 0
+    builder.add(Image.new("RGB", (64, 64), BLUE), 32, 32)
+    # Four full-resolution tiles, then one per level above
+    assert builder.tiles_written == 4 + builder.info.top
+    builder.finish()
+    assert builder.tiles_written == 4 + builder.info.top
+
+def test_late_image_redraws_written_tiles(tmp_path):
+    builder = PyramidBuilder(str(tmp_path), "scan", 128, 128, tile_size=64, quality=95)
+    builder.add(Image.new("RGB", (128, 128), RED), 0, 0)
+    written = builder.tiles_written
+    assert written == 4 + builder.info.top
+    builder.add(Image.new("RGB", (64, 64), BLUE), 32, 32)
+    builder.finish()
+    expected = np.full((128, 128, 3), RED)
+    expected[32:96, 32:96] = BLUE
+    assert _mismatch(_level(str(tmp_path), "scan"), expected) < 0.01
+    # The levels above are patched as well
+    half = _level(str(tmp_path), "scan", builder.info.top - 1)
+    assert _mismatch(half, expected[::2, ::2]) < 0.05
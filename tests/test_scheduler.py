@@ -0,0 +1,162 @@
+import pytest
+
+import scheduler
+from scheduler import DeviceScheduler
+
+class _Keys:
+    """Key store stand-in recording what was written for each device, in order."""
+
+    def __init__(self):
+        self.current = {}
+        self.log = []
+        self.issued = 0
+
+    def issue(self, device, seconds):
+        self.issued += 1
+        key = f"key-{self.issued}"
+        self.current[device] = key
+        self.log.append(("issue", key))
+        return key
+
+    def revoke(self, device):
+        self.current[device] = ""
+        self.log.append(("revoke", device))
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(scheduler.time, "time", lambda: now[0])
+    return now
+
+def _scheduler(keys, **options):
+    return DeviceScheduler(keys.issue, keys.revoke, lease_seconds=100, claim_seconds=20, **options)
+
+def _take_turns(devices, users, rounds):
+    """Each round, whoever holds the device releases it and asks again; return who held it, in order."""
+    holders = []
+    for user in users:
+        devices.request("m", user)
+    for _ in range(rounds):
+        holder = next(user for user in users if devices.request("m", user).status == "granted")
+        holders.append(holder)
+        devices.release("m", holder)
+        devices.request("m", holder)
+    return holders
+
+def test_queue_is_first_come_first_served(clock):
+    keys = _Keys()
+    devices = _scheduler(keys)
+    assert devices.request("m", "a").status == "granted"
+    tickets = [devices.request("m", user) for user in "bcd"]
+    assert [ticket.position for ticket in tickets] == [1, 2, 3]
+    assert [ticket.wait for ticket in tickets] == [100, 200, 300]
+    # Asking again keeps the user's place rather than adding a second one
+    assert devices.request("m", "c").position == 2
+
+    granted = []
+    for user in "bcd":
+        devices.release("m", devices._devices["m"].lease.user)
+        assert devices.status("m", user).status == "ready"
+        assert devices.request("m", user).status == "granted"
+        granted.append(user)
+    assert granted == list("bcd")
+
+def test_users_take_turns_round_robin(clock):
+    devices = _scheduler(_Keys())
+    assert _take_turns(devices, ["a", "b", "c"], 7) == ["a", "b", "c", "a", "b", "c", "a"]
+
+def test_lease_expires(clock):
+    keys = _Keys()
+    devices = _scheduler(keys)
+    key = devices.request("m", "a").key
+    devices.request("m", "b")
+    clock[0] += 99
+    assert devices.holds("m", key)
+    clock[0] += 1
+    assert not devices.holds("m", key)
+    assert devices.status("m", "b").status == "ready"
+    assert devices.status("m", "a") is None
+
+def test_unclaimed_turn_passes_on(clock):
+    devices = _scheduler(_Keys())
+    devices.request("m", "a")
+    devices.request("m", "b")
+    devices.request("m", "c")
+    devices.release("m", "a")
+    clock[0] += 20
+    assert devices.status("m", "b") is None
+    assert devices.request("m", "c").status == "granted"
+
+def test_wait_estimate_follows_lease_length(clock):
+    devices = _scheduler(_Keys(), smoothing=1.0)
+    devices.request("m", "a")
+    clock[0] += 40
+    devices.release("m", "a")
+    devices.request("m", "b")
+    devices.request("m", "c")
+    assert devices.request("m", "c").wait == 40
+
+def test_release_during_key_issue_hands_device_on(clock):
+    keys = _Keys()
+    devices = _scheduler(keys)
+
+    def released_meanwhile(device, seconds):
+        key = keys.issue(device, seconds)
+        # The user gives up while their key is still being stored
+        devices.release(device, "a")
+        return key
+
+    for user in "bac":
+        devices.request("m", user)
+    devices.release("m", "b")
+    devices.issue_key = released_meanwhile
+    assert devices.request("m", "a").status == "released"
+    devices.issue_key = keys.issue
+
+    # "a" is not put back in the queue, and the device goes to "c"
+    assert devices.status("m", "a") is None
+    ticket = devices.request("m", "c")
+    assert ticket.status == "granted"
+    # The released key was revoked before the next one was issued, so the new key is the one stored
+    assert keys.log[-3:] == [("issue", "key-2"), ("revoke", "m"), ("issue", "key-3")]
+    assert keys.current["m"] == ticket.key
+    assert not devices.holds("m", "key-2")
+
+def test_release_during_key_issue_with_nobody_waiting(clock):
+    keys = _Keys()
+    devices = _scheduler(keys)
+    devices.issue_key = lambda device, seconds: (devices.release(device, "a"), keys.issue(device, seconds))[1]
+    assert devices.request("m", "a").status == "released"
+    assert devices._devices["m"].lease is None
+    assert keys.current["m"] == ""
+
+def test_request_again_during_key_issue(clock):
+    """A user who releases and asks again while their key is stored gets a fresh key, not the revoked one."""
+    keys = _Keys()
+    devices = _scheduler(keys)
+
+    def rerequested_meanwhile(device, seconds):
+        key = keys.issue(device, seconds)
+        if keys.issued == 1:
+            devices.release(device, "a")
+            assert devices.request(device, "a").status == "ready"
+        return key
+
+    devices.issue_key = rerequested_meanwhile
+    ticket = devices.request("m", "a")
+    assert ticket.status == "granted"
+    assert ticket.key == keys.current["m"] == "key-2"
+
+def test_key_issue_gives_up_after_repeated_releases(clock):
+    keys = _Keys()
+    devices = _scheduler(keys)
+
+    def always_released(device, seconds):
+        key = keys.issue(device, seconds)
+        devices.release(device, "a")
+        devices.request(device, "a")
+        return key
+
+    devices.issue_key = always_released
+    assert devices.request("m", "a").status == "ready"
+    assert keys.issued == scheduler.ISSUE_ATTEMPTS
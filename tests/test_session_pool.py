@@ -0,0 +1,30 @@
+import asyncio
+
+import microscope_demo_client
+from session_pool import SessionPool
+from simulator import LoopbackBroker, LoopbackClient, SimulatedMicroscope
+
+def test_sessions_on_one_microscope_stay_connected(monkeypatch):
+    """After a lease changes hands, the old user's idle session and the new one must not share a client ID."""
+    broker = LoopbackBroker()
+    monkeypatch.setattr(
+        microscope_demo_client, "MQTTClient",
+        lambda host, port, client_id, username, password: LoopbackClient(broker, client_id),
+    )
+
+    async def body():
+        pool = SessionPool("loopback", 0)
+        with SimulatedMicroscope(broker, latency=0.001, image_size=(160, 120)) as device:
+            try:
+                async with pool.session(device.name, "old-key") as old:
+                    await old.get_pos()
+                async with pool.session(device.name, "new-key") as new:
+                    await new.get_pos()
+                async with pool.session(device.name, "old-key") as again:
+                    assert again is old
+                    await again.get_pos(timeout=1)
+                assert old.is_connected() and new.is_connected()
+            finally:
+                await pool.close_all()
+
+    asyncio.run(body())
@@ -0,0 +1,77 @@
+import asyncio
+import random
+
+import numpy as np
+import pytest
+
+from image_transport import Tile
+from microscope_demo_client import MicroscopeDemo
+from simulator import LoopbackBroker, LoopbackClient, SimulatedMicroscope
+from stitching import compose, stitch_positions
+
+IMAGE_SIZE = (320, 240)
+SAMPLE_SIZE = (1024, 1024)
+C1, C2, OV = [0, 0], [500, 400], 160
+
+def _device(broker, **options):
+    return SimulatedMicroscope(broker, latency=0.001, image_size=IMAGE_SIZE, sample_size=SAMPLE_SIZE, **options)
+
+def _offsets(positions):
+    """Pixel offsets (y, x) of the fields, one stage step being one pixel in the simulator."""
+    offsets = np.array([[pos["y"], pos["x"]] for pos in positions], dtype=np.float64)
+    return offsets - offsets.min(axis=0)
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_registration_corrects_stage_error(workers):
+    """The stage reports positions up to 15 steps out; registration must find where the fields really are."""
+    with _device(LoopbackBroker()) as device:
+        positions = device.scan_positions(C1, C2, OV)
+        jitter = random.Random(1)
+        tiles = [
+            Tile(i, {"x": pos["x"] + jitter.randint(-15, 15), "y": pos["y"] + jitter.randint(-15, 15)}, device.jpeg(pos=pos))
+            for i, pos in enumerate(positions)
+        ]
+    found = stitch_positions(tiles, workers=workers)
+    assert len(tiles) == 12
+    assert np.abs(found - _offsets(positions)).max() < 1.0
+
+def test_stage_scale_is_fitted():
+    """Stage steps need not be pixels: the scale is fitted from the overlaps."""
+    with _device(LoopbackBroker()) as device:
+        positions = device.scan_positions(C1, C2, OV)
+        tiles = [
+            Tile(i, {"x": pos["x"] / 4, "y": pos["y"] / 4}, device.jpeg(pos=pos)) for i, pos in enumerate(positions)
+        ]
+    assert np.abs(stitch_positions(tiles, workers=1) - _offsets(positions)).max() < 1.0
+
+def test_composed_scan_matches_fields():
+    with _device(LoopbackBroker()) as device:
+        positions = device.scan_positions(C1, C2, OV)
+        tiles = [Tile(i, pos, device.jpeg(pos=pos)) for i, pos in enumerate(positions)]
+    canvas = compose(tiles, stitch_positions(tiles, workers=1))
+    offsets = _offsets(positions).astype(int)
+    # The last tile is pasted last, so it shows unchanged apart from JPEG noise
+    y, x = offsets[-1]
+    with tiles[-1].image as image:
+        expected = np.asarray(image.convert("L"), dtype=np.float64)
+    region = np.asarray(canvas.convert("L"), dtype=np.float64)[y:y + IMAGE_SIZE[1], x:x + IMAGE_SIZE[0]]
+    assert np.abs(region - expected).mean() < 1.0
+
+class _LegacyMicroscope(SimulatedMicroscope):
+    def _do_scan(self, command, meta):
+        # Older firmware answers with every image in one reply and no positions
+        super()._do_scan({**command, "stream": False}, meta)
+
+@pytest.mark.parametrize("device_class", [SimulatedMicroscope, _LegacyMicroscope])
+def test_scan_stitches_offline(device_class):
+    async def body():
+        broker = LoopbackBroker()
+        client = LoopbackClient(broker)
+        client.connect()
+        with device_class(broker, latency=0.001, image_size=IMAGE_SIZE, sample_size=SAMPLE_SIZE) as device:
+            async with MicroscopeDemo("loopback", 0, "user", "key", device.name, timeout=5, client=client) as microscope:
+                tiles = [tile async for tile in microscope.scan_iter(C1, C2, OV)]
+            return tiles, device.scan_positions(C1, C2, OV)
+
+    tiles, positions = asyncio.run(body())
+    assert np.abs(stitch_positions(tiles, workers=2) - _offsets(positions)).max() < 1.0
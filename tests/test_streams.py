@@ -0,0 +1,117 @@
+import asyncio
+
+import pytest
+
+from frame_buffer import FrameRing
+from microscope_demo_client import MicroscopeDemo, _Stream
+from simulator import LoopbackBroker, LoopbackClient, SimulatedMicroscope
+
+# Short enough that a stalled dispatcher fails the test instead of hanging it
+TIMEOUT = 5
+
+async def _with_microscope(body, device_class=SimulatedMicroscope, binary=False, frame_ring=None, **options):
+    broker = LoopbackBroker()
+    client = LoopbackClient(broker)
+    client.connect()
+    options = {"latency": 0.01, "image_size": (160, 120), **options}
+    with device_class(broker, **options) as device:
+        microscope = MicroscopeDemo(
+            "loopback", 0, "user", "key", device.name, timeout=TIMEOUT, binary=binary, client=client,
+            frame_ring=frame_ring,
+        )
+        async with microscope:
+            return await body(microscope, device)
+
+def _buffered(microscope) -> int:
+    return max((waiter.held for waiter in microscope._pending.values() if isinstance(waiter, _Stream)), default=0)
+
+def test_command_inside_scan_iter():
+    """A command issued mid-scan is answered while the scan waits for the consumer."""
+    async def body(microscope, device):
+        tiles = 0
+        async for tile in microscope.scan_iter([0, 0], [400, 400], ov=60, window=2):
+            await microscope.get_pos()
+            tile.release()
+            tiles += 1
+        return tiles
+
+    assert asyncio.run(_with_microscope(body, workers=2)) == 25
+
+def test_command_inside_batch():
+    async def body(microscope, device):
+        steps = [{"command": "take_image"}] * 6
+        results = 0
+        async for result in microscope.batch(steps, window=2):
+            await microscope.get_pos()
+            results += 1
+        return results
+
+    assert asyncio.run(_with_microscope(body, workers=2)) == 6
+
+def test_slow_consumer_stays_within_window():
+    async def body(microscope, device):
+        peak, tiles = 0, 0
+        async for tile in microscope.scan_iter([0, 0], [400, 200], ov=60, window=3):
+            # Give the device time to send everything it is allowed to
+            await asyncio.sleep(0.05)
+            peak = max(peak, _buffered(microscope))
+            tile.release()
+            tiles += 1
+        return peak, tiles
+
+    peak, tiles = asyncio.run(_with_microscope(body, latency=0.001))
+    assert tiles == 15
+    assert 0 < peak <= 3
+
+class _CreditIgnoringMicroscope(SimulatedMicroscope):
+    def _take_credit(self, request_id):
+        return True
+
+def test_overrun_fails_stream():
+    async def body(microscope, device):
+        async for tile in microscope.scan_iter([0, 0], [400, 400], ov=60, window=2):
+            await asyncio.sleep(0.05)
+            tile.release()
+
+    with pytest.raises(RuntimeError, match="overran"):
+        asyncio.run(_with_microscope(body, _CreditIgnoringMicroscope, latency=0.001))
+
+def test_cancelled_stream_frees_device():
+    """Leaving a scan early cancels it, so the device is free for the next command."""
+    async def body(microscope, device):
+        async for tile in microscope.scan_iter([0, 0], [400, 400], ov=60, window=2):
+            tile.release()
+            break
+        return await microscope.get_pos(timeout=1)
+
+    assert "x" in asyncio.run(_with_microscope(body))
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_chunked_tiles_reassemble(binary):
+    async def body(microscope, device):
+        device.max_chunk = None
+        whole = [bytes(tile.data) async for tile in microscope.scan_iter([0, 0], [200, 100], ov=60)]
+        device.max_chunk = 700
+        chunked = []
+        async for tile in microscope.scan_iter([0, 0], [200, 100], ov=60, window=2):
+            chunked.append(bytes(tile.data))
+            tile.release()
+        return whole, chunked
+
+    ring = FrameRing(slots=8, slot_size=1 << 16)
+    whole, chunked = asyncio.run(_with_microscope(body, binary=binary, frame_ring=ring, shuffle_chunks=True))
+    assert len(whole) == 6
+    assert chunked == whole
+    assert ring.in_use == 0
+
+class _BadChunkMicroscope(SimulatedMicroscope):
+    def _send_image(self, command, metadata):
+        self._reply({**metadata, "chunk": 3, "chunks": 2, "image": ""})
+
+def test_invalid_chunk_fails_stream():
+    async def body(microscope, device):
+        async for tile in microscope.scan_iter([0, 0], [200, 100], ov=60):
+            tile.release()
+
+    with pytest.raises(ValueError, match="Invalid chunk"):
+        asyncio.run(_with_microscope(body, _BadChunkMicroscope))
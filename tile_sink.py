@@ -0,0 +1,157 @@
+import asyncio
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from PIL import Image
+
+import metrics
+from image_transport import Tile, open_image
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+TILE_WRITE_SECONDS = metrics.histogram(
+    "tile_sink_write_seconds", "Time to write one scan tile to disk", ["mode"]
+)
+
+MANIFEST_NAME = "manifest.json"
+
+class TileSink:
+    """
+    Write scan tiles to a directory as they arrive, off the event loop.
+
+    Without a transform the received JPEG bytes are written unchanged, so
+    tiles keep their original quality and nothing is decoded. With a
+    transform, tiles are decoded, transformed and re-encoded on a thread pool.
+    At most ``max_pending`` tiles wait in the queue, and ``put`` blocks when
+    it is full, so a fast scan cannot outrun the disk by more than that.
+    ``close`` writes ``manifest.json``, which maps each tile index to its file
+    and stage position.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        transform: Optional[Callable[[Image.Image], Image.Image]] = None,
+        quality: int = 90,
+        max_pending: int = 8,
+        workers: Optional[int] = None,
+    ):
+        """
+        Initialize the sink.
+
+        Args:
+            directory (str): Directory for the tiles and manifest; created if missing, never emptied.
+            transform (Optional[Callable[[Image.Image], Image.Image]], optional): Applied to each decoded tile
+                before it is re-encoded. Defaults to None (write the received bytes).
+            quality (int, optional): JPEG quality when re-encoding. Defaults to 90.
+            max_pending (int, optional): Tiles queued before put() waits. Defaults to 8.
+            workers (Optional[int], optional): Writer threads. Defaults to up to 4, one per CPU.
+        """
+        self.directory = directory
+        self.transform = transform
+        self.quality = quality
+        self.workers = workers or min(4, os.cpu_count() or 1)
+        self.manifest: Dict[int, Dict] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._max_pending = max_pending
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._writers: List[asyncio.Task] = []
+        self._error: Optional[BaseException] = None
+
+    def start(self):
+        """Start the writers. Called by the first put()."""
+        if self._writers:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._queue = asyncio.Queue(maxsize=self._max_pending)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="tile-sink")
+        self._writers = [asyncio.create_task(self._drain()) for _ in range(self.workers)]
+
+    async def put(self, tile: Tile):
+        """Queue a tile for writing, waiting while the queue is full."""
+        if self._error is not None:
+            raise self._error
+        self.start()
+        await self._queue.put(tile)
+
+    async def close(self) -> str:
+        """
+        Wait for every queued tile to be written, then write the manifest.
+
+        Returns:
+            str: Path of the manifest.
+
+        Raises:
+            Exception: The first error a writer hit, if any.
+        """
+        self.start()
+        for _ in self._writers:
+            await self._queue.put(None)
+        await asyncio.gather(*self._writers)
+        self._executor.shutdown(wait=True)
+        if self._error is not None:
+            raise self._error
+        return await asyncio.to_thread(self._write_manifest)
+
+    async def abort(self):
+        """Stop without waiting for queued tiles or writing a manifest."""
+        for writer in self._writers:
+            writer.cancel()
+        await asyncio.gather(*self._writers, return_exceptions=True)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            await self.close()
+        else:
+            await self.abort()
+
+    async def _drain(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            tile = await self._queue.get()
+            if tile is None:
+                return
+            # After an error, keep taking tiles so put() never blocks forever
+            if self._error is not None:
+                continue
+            try:
+                name = await loop.run_in_executor(self._executor, self._write, tile)
+                self.manifest[tile.index] = {"file": name, "pos": tile.pos}
+            except Exception as e:
+                logger.error(f"Failed to write tile {tile.index}: {e}")
+                self._error = e
+
+    def _write(self, tile: Tile) -> str:
+        name = f"{tile.index}.jpeg"
+        path = os.path.join(self.directory, name)
+        partial = path + ".part"
+        if self.transform is None:
+            with TILE_WRITE_SECONDS.time(mode="copy"):
+                with open(partial, "wb") as f:
+                    f.write(tile.data)
+        else:
+            with TILE_WRITE_SECONDS.time(mode="encode"):
+                with open_image(tile.data) as image:
+                    options = {"exif": image.info["exif"]} if "exif" in image.info else {}
+                    self.transform(image).convert("RGB").save(partial, format="JPEG", quality=self.quality, **options)
+        # Readers never see a half-written tile
+        os.replace(partial, path)
+        return name
+
+    def _write_manifest(self) -> str:
+        path = os.path.join(self.directory, MANIFEST_NAME)
+        tiles = [{"index": index, **self.manifest[index]} for index in sorted(self.manifest)]
+        with open(path + ".part", "w") as f:
+            json.dump({"tiles": tiles}, f, indent=2)
+        os.replace(path + ".part", path)
+        return path